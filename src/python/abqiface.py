@@ -6,14 +6,28 @@ Intelligent Systems Division
 NASA Ames Research Center
 """
 
+import copy
 import os
 import re
 import shutil
+import tempfile
 import math
-#import numpy
-#import scipy.sparse
+import sys
+import threading
+import numpy
+import scipy.sparse
 
-print('abqiface.py')
+import lazyimport
+import ratelog
+
+# only needed by LoadSuperposition.solveUnitCases
+dense_linalg  = lazyimport.lazy_import('scipy.linalg')
+sparse_linalg = lazyimport.lazy_import('scipy.sparse.linalg')
+
+# only needed by the NodeIndex distance queries
+spatial = lazyimport.lazy_import('scipy.spatial')
+
+log = ratelog.get_logger(__name__)
 
 class ABAQUS_mesh:
     """ 
@@ -27,6 +41,8 @@ class ABAQUS_mesh:
         self.elemList = []       # list of element input sections
         self.nsetList = {}       # dictionary: name, member ids
         self.elsetList = {}      # list dictionary pairs: name, member ids
+        self.nodeIndexCache = {} # dictionary: node set, (number of nodes, NodeIndex)
+        self.crackNodePairs = [] # list of (original, duplicate) node ids, see insertCrack
 
     def addNode(self, nodeCoordList):        #nodeCoordList : [x,y,z]
         self.nodeList.append(nodeCoordList)
@@ -71,7 +87,7 @@ class ABAQUS_mesh:
         fileHandle.write('*NSET, NSET=%s\n'%(name))
         nPrint = 0
         nodeList = self.nsetList[name]
-        print nodeList
+        log.debug('nset %s: %s', name, nodeList)
         numNodes = len(nodeList)
         for i in range(numNodes):
             nPrint = nPrint + 1
@@ -105,14 +121,41 @@ class ABAQUS_mesh:
         if needReturn:
             fileHandle.write('\n')
 
-    def findNodes_coord_locations(self, coord, coordValue, tol=0.001):
-        nodesFound = []
-        for i in range(len(self.connectionNodeList)):
-            node = self.connectionNodeList[i]
-            if abs(node[coord]-coordValue) <= tol:
-                nodeId = self.connectionNodeMap[i]
-                nodesFound.append(nodeId)
-        return nodesFound
+    def nodeIndex(self, allNodes=False):
+        """
+        Return the NodeIndex of the connection nodes (ids from
+        connectionNodeMap), or of all nodes. The index is cached, and
+        rebuilt when nodes have been added.
+        """
+        if allNodes:
+            key, nodes, ids = 'all', self.nodeList, None
+        else:
+            key, nodes, ids = 'connection', self.connectionNodeList, self.connectionNodeMap
+        entry = self.nodeIndexCache.get(key)
+        if entry is None or entry[0] != len(nodes):
+            entry = (len(nodes), NodeIndex(nodes, ids))
+            self.nodeIndexCache[key] = entry
+        return entry[1]
+
+    def findNodes_coord_locations(self, coord, coordValue, tol=0.001, allNodes=False):
+        """
+        Return the ids of the connection nodes (or all nodes) whose
+        coordinate coord is within tol of coordValue, in increasing order.
+        coordValue may also be a list of values, to get a list of node id
+        lists from one index.
+        """
+        index = self.nodeIndex(allNodes)
+        if numpy.ndim(coordValue) > 0:
+            return [ids.tolist() for ids in index.planes(coord, coordValue, tol)]
+        return index.plane(coord, coordValue, tol).tolist()
+
+    def findNodes_box(self, box, allNodes=False):
+        """Return the ids of the connection nodes (or all nodes) in box."""
+        return self.nodeIndex(allNodes).box(box).tolist()
+
+    def findNodes_sphere(self, center, radius, allNodes=False):
+        """Return the ids of the connection nodes (or all nodes) within radius of center."""
+        return self.nodeIndex(allNodes).sphere(center, radius).tolist()
 
     def printNodeList(self):
         print('printing nodeList, length: ',len(self.nodeList))
@@ -157,61 +200,40 @@ class ABAQUS_mesh:
 
     def addKagome1LatticeMesh(self, numX, numY, numBeamsPerStrut, cX, cY, cZ, length, theta_d, inclusionBox = None, noMergeBox = None):
         # numX and numY grows in the positive x and y direction respectively
-        numVoxels = 0
-        numSharedCorners = 0
-        noNumZ = True
+        # only the cells whose centroid is in the inclusionBox region are added (see inRegion)
         theta = math.radians(theta_d)
-        for i in range(numX):
-            for j in range(numY):
-                if noNumZ:
-                    x = cX + length*(i)+  length*math.cos(theta)*(j)
-                    y = cY + length*math.sin(theta)*(j)
-                    z = cZ
-                    inside = isNodeInBox([x,y,z], inclusionBox)
-                    inSide = True
-                    if inclusionBox != None:
-                        inSide = isNodeInBox([x,y,z], inclusionBox)
-                    if inSide:
-                        numVoxels = numVoxels + 1
-                        #print('adding kagome element ',numVoxels,x,y,z)
-                        kagome = Kagome_1(x, y, z, numBeamsPerStrut,length, theta_d)
-                        includeCentroid = False
-                        sharedNodes = self.addSuperElement(kagome, includeCentroid, noMergeBox)
-                        numSharedCorners = numSharedCorners + sharedNodes
-                        #print('connection list:')
-                        #print(self.connectionNodeList)                    
-                        #print('Num shared corners: ', numSharedCorners)
-        print('end addKagome1LatticeMesh')
+        i, j = gridIndices(numX, numY)
+        x = cX + length*i + length*math.cos(theta)*j
+        y = cY + length*math.sin(theta)*j
+        numSharedCorners = 0
+        progress = ratelog.RateLogger(log, 'kagome cells')
+        for x, y in latticeCells(x, y, cZ, inclusionBox):
+            kagome = Kagome_1(x, y, cZ, numBeamsPerStrut,length, theta_d)
+            includeCentroid = False
+            sharedNodes = self.addSuperElement(kagome, includeCentroid, noMergeBox)
+            numSharedCorners = numSharedCorners + sharedNodes
+            progress.tick()
+        progress.done()
+        log.debug('end addKagome1LatticeMesh, num shared corners: %d', numSharedCorners)
 
 
     def addHoneycomb1LatticeMesh(self, numX, numY, numBeamsPerStrut, cX, cY, cZ, length, inclusionBox = None, noMergeBox = None):
         # numX and numY grows in the positive x and y direction respectively
-        numVoxels = 0
-        numSharedCorners = 0
-        noNumZ = True
+        # only the cells whose centre is in the inclusionBox region are added (see inRegion)
         theta = math.radians(30)
-        for i in range(numX):
-            for j in range(numY):
-                if noNumZ:
-                    x = cX + length*math.cos(theta)*(i)
-                    y = cY + (length+length*math.cos(theta))*(j)
-                    z = cZ
-                    inside = isNodeInBox([x,y,z], inclusionBox)
-                    inSide = True
-                    if inclusionBox != None:
-                        inSide = isNodeInBox([x,y,z], inclusionBox)
-                    inside = True
-                    if inSide:
-                        numVoxels = numVoxels + 1
-                        #print('adding kagome element ',numVoxels,x,y,z)
-                        honeycomb = Honeycomb_1(x, y, z, numBeamsPerStrut,length)
-                        includeCentroid = False
-                        sharedNodes = self.addSuperElement(honeycomb, includeCentroid, noMergeBox)
-                        numSharedCorners = numSharedCorners + sharedNodes
-                        #print('connection list:')
-                        #print(self.connectionNodeList)                    
-                        #print('Num shared corners: ', numSharedCorners)
-        print('end addHoneycomb1LatticeMesh')        
+        i, j = gridIndices(numX, numY)
+        x = cX + length*math.cos(theta)*i
+        y = cY + (length+length*math.cos(theta))*j
+        numSharedCorners = 0
+        progress = ratelog.RateLogger(log, 'honeycomb cells')
+        for x, y in latticeCells(x, y, cZ, inclusionBox):
+            honeycomb = Honeycomb_1(x, y, cZ, numBeamsPerStrut,length)
+            includeCentroid = False
+            sharedNodes = self.addSuperElement(honeycomb, includeCentroid, noMergeBox)
+            numSharedCorners = numSharedCorners + sharedNodes
+            progress.tick()
+        progress.done()
+        log.debug('end addHoneycomb1LatticeMesh, num shared corners: %d', numSharedCorners)
 
 
     def addVoxelLatticeMesh(self, numX, numY, numZ, numBeamsPerStrut, elemType, offX, offY, offZ, includeCentroid = True, inclusionBox = None):
@@ -220,6 +242,7 @@ class ABAQUS_mesh:
         pitch = 3.
         numVoxels = 0
         numSharedCorners = 0
+        progress = ratelog.RateLogger(log, 'voxels')
         for i in range(numX):
             for j in range(numY):
                 for k in range(numZ):
@@ -237,8 +260,122 @@ class ABAQUS_mesh:
                     numSharedCorners = numSharedCorners + sharedNodes
                     #print('connection list:')
                     #print(self.connectionNodeList)                    
-                    print('Num shared corners: ', numSharedCorners)
-
+                    log.debug('Num shared corners: %d', numSharedCorners)
+                    progress.tick()
+        progress.done()
+
+
+    def copyMesh(self):
+        """Return a copy of the mesh that can be changed independently."""
+        mesh = ABAQUS_mesh()
+        mesh.nodeList = [node[:] for node in self.nodeList]
+        mesh.connectionNodeList = [mesh.nodeList[i] for i in self.connectionNodeMap]
+        mesh.connectionNodeMap = list(self.connectionNodeMap)
+        mesh.elemList = [elem[:] for elem in self.elemList]
+        mesh.nsetList = copy.deepcopy(self.nsetList)
+        mesh.elsetList = copy.deepcopy(self.elsetList)
+        mesh.crackNodePairs = list(self.crackNodePairs)
+        return mesh
+
+    def insertCrack(self, crack, tol=0.001, side=1, inPlace=False):
+        """
+        Insert a crack into the merged mesh, as a post-pass instead of the
+        noMergeBox argument of the lattice generators.
+
+        crack is a polyline [[x, y], ...] (a z coordinate is ignored): the
+        crack surface is the polyline swept along z. Nodes within tol of
+        the polyline are seam nodes, except at the crack front: the ends of
+        the polyline inside the mesh (more than tol inside the bounding box
+        of the nodes), where the crack faces meet. Each seam node is
+        duplicated, and the struts (first two element nodes) on the given
+        side of the crack (1: left of the polyline direction, -1: right) are
+        connected to the duplicate. Struts that cross the crack between their nodes are cut:
+        their end on that side gets a node of its own. Struts along the
+        crack keep the original nodes.
+
+        The (original, duplicate) node id pairs are appended to
+        crackNodePairs. Node and element sets are not changed, so sets that
+        should include the new nodes are best built after the crack is
+        inserted (e.g. with findNodes_coord_locations).
+
+        Returns a cracked copy of the mesh, so that several crack
+        configurations can be derived from one base mesh, or the mesh
+        itself if inPlace is True.
+        """
+        mesh = self if inPlace else self.copyMesh()
+        points = numpy.asarray(crack, dtype=numpy.float64)[:,:2]
+        coords = numpy.asarray(mesh.nodeList, dtype=numpy.float64).reshape((-1, 3))[:,:2]
+        struts = [i for i, elem in enumerate(mesh.elemList) if len(elem) >= 2]
+        ends = numpy.array([mesh.elemList[i][:2] for i in struts],
+                           dtype=numpy.int64).reshape((-1, 2))
+        isConnectionNode = numpy.zeros(len(coords), dtype=bool)
+        isConnectionNode[mesh.connectionNodeMap] = True
+        newEnds = ends.copy()
+
+        # signed distance of the nodes from each crack segment line
+        # (positive on the given side) and position along the segment, in
+        # units of the segment length; seam nodes are assigned to the first
+        # segment they are on
+        dist = []
+        pos = []
+        seam = numpy.zeros(len(coords), dtype=bool)
+        seamSegment = numpy.zeros(len(coords), dtype=numpy.int64)
+        for k in range(len(points) - 1):
+            a = points[k]
+            d = points[k+1] - a
+            length = math.sqrt(d.dot(d))
+            rel = coords - a
+            dist.append(side*(d[0]*rel[:,1] - d[1]*rel[:,0])/length)
+            pos.append(rel.dot(d)/length**2)
+            onSegment = (numpy.abs(dist[k]) <= tol) & (pos[k] >= -tol/length) & \
+                        (pos[k] <= 1 + tol/length) & ~seam
+            seam |= onSegment
+            seamSegment[onSegment] = k
+
+        # the crack does not open at the crack front
+        lower, upper = coords.min(axis=0) + tol, coords.max(axis=0) - tol
+        for tip in (points[0], points[-1]):
+            if numpy.all(tip > lower) and numpy.all(tip < upper):
+                seam &= numpy.sum((coords - tip)**2, axis=1) > tol**2
+
+        # struts with one end on the seam and the other on the crack side
+        duplicates = {}
+        for end in range(2):
+            this, other = ends[:,end], ends[:,1-end]
+            for i in numpy.nonzero(seam[this] & ~seam[other])[0]:
+                node = this[i]
+                if dist[seamSegment[node]][other[i]] > tol:
+                    if node not in duplicates:
+                        duplicates[node] = mesh.addCrackNode(node, isConnectionNode[node])
+                    newEnds[i,end] = duplicates[node]
+
+        # struts crossing a crack segment between their nodes
+        for k in range(len(dist)):
+            d0, d1 = dist[k][ends[:,0]], dist[k][ends[:,1]]
+            crossing = (d0*d1 < 0) & (numpy.abs(d0) > tol) & (numpy.abs(d1) > tol)
+            fraction = d0/numpy.where(crossing, d0 - d1, 1.)
+            p0, p1 = pos[k][ends[:,0]], pos[k][ends[:,1]]
+            at = p0 + fraction*(p1 - p0)
+            crossing &= (at >= 0) & (at <= 1)
+            for i in numpy.nonzero(crossing)[0]:
+                end = 0 if d0[i] > 0 else 1
+                newEnds[i,end] = mesh.addCrackNode(ends[i,end], isConnectionNode[ends[i,end]])
+
+        for i in numpy.nonzero(numpy.any(newEnds != ends, axis=1))[0]:
+            mesh.elemList[struts[i]][:2] = newEnds[i].tolist()
+        log.info('insertCrack: %d seam nodes, %d new nodes',
+                 numpy.count_nonzero(seam), len(mesh.nodeList) - len(coords))
+        return mesh
+
+    def addCrackNode(self, node, connection):
+        """Add a duplicate of node for insertCrack, and return its id."""
+        if connection:
+            self.addConnectionNode(list(self.nodeList[node]))
+        else:
+            self.addNode(list(self.nodeList[node]))
+        duplicate = len(self.nodeList) - 1
+        self.crackNodePairs.append((int(node), duplicate))
+        return duplicate
 
     def addSuperElement(self,superElem, includeCentroid=True, noMergeBox = None):
         # append nodeList
@@ -296,7 +433,390 @@ class ABAQUS_mesh:
         return sharedNodes 
 
 
-    
+
+
+
+class NodeIndex:
+    """
+    Coordinate query index over a set of mesh nodes.
+
+    Holds the node coordinates as an (n, 3) array, the nodes sorted along
+    each axis (for plane and box queries by binary search), and a KD-tree
+    (scipy.spatial.cKDTree, built on the first sphere or nearest query) for
+    distance queries. Without scipy.spatial, distance queries fall back to
+    vectorized brute force.
+
+    Queries return the ids of the matching nodes (indices into the mesh
+    nodeList, or the ids passed to the constructor) as sorted arrays. The
+    index is a snapshot: build a new one after the nodes change (see
+    ABAQUS_mesh.nodeIndex, which does this).
+    """
+
+    def __init__(self, coords, ids=None):
+        self.coords = numpy.asarray(coords, dtype=numpy.float64).reshape((-1, 3))
+        if ids is None:
+            ids = numpy.arange(len(self.coords))
+        self.ids = numpy.asarray(ids, dtype=numpy.int64)
+        # nodes sorted along each axis
+        self.order = [numpy.argsort(self.coords[:,axis], kind='mergesort')
+                      for axis in range(3)]
+        self.sorted = [self.coords[self.order[axis],axis] for axis in range(3)]
+        self.tree = None
+
+    def __len__(self):
+        return len(self.coords)
+
+    def axisRange(self, axis, low, high):
+        """Return the positions (in self.order[axis]) of low <= x <= high."""
+        values = self.sorted[axis]
+        return numpy.searchsorted(values, low, 'left'), \
+               numpy.searchsorted(values, high, 'right')
+
+    def plane(self, axis, value, tol=0.001):
+        """Return the nodes with abs(coordinate axis - value) <= tol."""
+        # widen the binary search by tol, and test the candidates exactly
+        start, stop = self.axisRange(axis, value - 2*tol, value + 2*tol)
+        rows = self.order[axis][start:stop]
+        rows = rows[numpy.abs(self.coords[rows,axis] - value) <= tol]
+        return numpy.sort(self.ids[rows])
+
+    def planes(self, axis, values, tol=0.001):
+        """Return the plane query results for each of values."""
+        return [self.plane(axis, value, tol) for value in values]
+
+    def box(self, box):
+        """
+        Return the nodes in box, ([min x, min y, min z], [max x, max y,
+        max z]), bounds included as in isNodeInBox.
+        """
+        low = numpy.asarray(box[0], dtype=numpy.float64)
+        high = numpy.asarray(box[1], dtype=numpy.float64)
+        # search along the most selective axis, and test the others
+        ranges = [self.axisRange(axis, low[axis], high[axis]) for axis in range(3)]
+        axis = min(range(3), key=lambda a: ranges[a][1] - ranges[a][0])
+        rows = self.order[axis][ranges[axis][0]:ranges[axis][1]]
+        points = self.coords[rows]
+        inside = numpy.all((points >= low) & (points <= high), axis=1)
+        return numpy.sort(self.ids[rows[inside]])
+
+    def kdTree(self):
+        """Return the KD-tree of the nodes, or None without scipy.spatial."""
+        if self.tree is None and len(self.coords) > 0:
+            try:
+                self.tree = spatial.cKDTree(self.coords)
+            except ImportError:
+                self.tree = False
+        return self.tree or None
+
+    def sphere(self, center, radius):
+        """Return the nodes within distance radius of center."""
+        center = numpy.asarray(center, dtype=numpy.float64)
+        tree = self.kdTree()
+        if tree is not None:
+            rows = numpy.asarray(tree.query_ball_point(center, radius), dtype=numpy.int64)
+        else:
+            distance = numpy.sqrt(((self.coords - center)**2).sum(axis=1))
+            rows = numpy.nonzero(distance <= radius)[0]
+        return numpy.sort(self.ids[rows])
+
+    def spheres(self, centers, radius):
+        """Return the sphere query results for each of centers."""
+        tree = self.kdTree()
+        if tree is None:
+            return [self.sphere(center, radius) for center in centers]
+        centers = numpy.asarray(centers, dtype=numpy.float64).reshape((-1, 3))
+        return [numpy.sort(self.ids[numpy.asarray(rows, dtype=numpy.int64)])
+                for rows in tree.query_ball_point(centers, radius)]
+
+    def nearest(self, point, k=1):
+        """Return the ids and distances of the k nodes nearest to point."""
+        point = numpy.asarray(point, dtype=numpy.float64)
+        k = min(k, len(self.coords))
+        tree = self.kdTree()
+        if tree is not None:
+            distance, rows = tree.query(point, k)
+            distance = numpy.atleast_1d(distance)
+            rows = numpy.atleast_1d(rows)
+        else:
+            squared = ((self.coords - point)**2).sum(axis=1)
+            rows = numpy.argsort(squared, kind='mergesort')[:k]
+            distance = numpy.sqrt(squared[rows])
+        return self.ids[rows], distance
+
+    def where(self, predicate):
+        """
+        Return the nodes for which predicate(x, y, z) is true, where x, y
+        and z are the coordinate arrays of all nodes, e.g.
+        index.where(lambda x, y, z: x**2 + y**2 <= 1.0).
+        """
+        mask = numpy.asarray(predicate(self.coords[:,0], self.coords[:,1],
+                                       self.coords[:,2]), dtype=bool)
+        return numpy.sort(self.ids[mask])
+
+
+def atomicWrite(fileName, write):
+    """
+    Write a file with write(outFile), through a uniquely named temporary
+    file in the same directory that is renamed over fileName when complete.
+    Concurrent runs never share a temporary file, and readers never see a
+    partially written file. On Windows, where os.rename does not replace
+    an existing file, the old file is removed first, so fileName is briefly
+    missing (but still never partially written).
+    """
+    fileName = os.path.abspath(fileName)
+    fd, tempName = tempfile.mkstemp(prefix='.' + os.path.basename(fileName) + '.',
+                                    dir=os.path.dirname(fileName))
+    try:
+        outFile = os.fdopen(fd, 'wb')
+        try:
+            write(outFile)
+        finally:
+            outFile.close()
+        if os.path.exists(fileName):
+            shutil.copymode(fileName, tempName)
+        else:
+            os.chmod(tempName, 0o644)
+        try:
+            os.rename(tempName, fileName)
+        except OSError:
+            if os.name != 'nt' or not os.path.exists(fileName):
+                raise
+            os.remove(fileName)
+            os.rename(tempName, fileName)
+    except:
+        if os.path.exists(tempName):
+            os.remove(tempName)
+        raise
+
+
+def fileSignature(fileName):
+    """Return the (modification time, size, inode) of a file, or None."""
+    try:
+        st = os.stat(fileName)
+    except OSError:
+        return None
+    return (st.st_mtime, st.st_size, st.st_ino)
+
+
+class FragmentCache:
+    """
+    Cache of ABAQUS input deck fragment files.
+
+    A fragment is only re-read when its file signature (modification time,
+    size and inode) has changed. Fragments up to maxTextSize bytes are kept
+    in memory. Larger ones, e.g. a mesh geometry of hundreds of MB, are only
+    tracked, and are streamed into the deck with shutil.copyfileobj.
+
+    The cache is shared by the job threads of abqjobs.JobQueue, so the
+    entries are looked up and updated under a lock.
+    """
+
+    def __init__(self, maxTextSize = 16*2**20):
+        self.maxTextSize = maxTextSize
+        self.entries = {}        # dictionary: absolute path, (signature, text)
+        self.readCount = 0
+        self.lock = threading.Lock()
+
+    def lookup(self, fileName):
+        """Return the (signature, text) of a fragment, text is None if large."""
+        path = os.path.abspath(fileName)
+        signature = fileSignature(path)
+        if signature is None:
+            raise IOError('Fragment file %s not found' % fileName)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is None or entry[0] != signature:
+                text = None
+                if signature[1] <= self.maxTextSize:
+                    fragmentFile = open(path, 'rb')
+                    try:
+                        text = fragmentFile.read()
+                    finally:
+                        fragmentFile.close()
+                    self.readCount = self.readCount + 1
+                entry = (signature, text)
+                self.entries[path] = entry
+        return entry
+
+    def copyTo(self, fileName, outFile):
+        """Write the fragment to the open file outFile."""
+        signature, text = self.lookup(fileName)
+        if text is None:
+            fragmentFile = open(fileName, 'rb')
+            try:
+                shutil.copyfileobj(fragmentFile, outFile, 2**20)
+            finally:
+                fragmentFile.close()
+        else:
+            outFile.write(text)
+
+    def clear(self):
+        with self.lock:
+            self.entries = {}
+
+
+def parseKeywordLine(line):
+    """Split an ABAQUS keyword line into its upper case keyword and parameters."""
+    fields = [field.strip() for field in line.strip().split(',')]
+    parameters = {}
+    for field in fields[1:]:
+        if field == '':
+            continue
+        name, sep, value = field.partition('=')
+        parameters[name.strip().upper()] = value.strip().strip('"')
+    return fields[0].upper(), parameters
+
+
+class InpDeck:
+    """
+    Keyword block model of an ABAQUS input deck fragment.
+
+    The fragment is parsed once into its lines and keyword blocks, and the
+    *MATERIAL, *ELASTIC, *SURFACE INTERACTION, *COHESIVE BEHAVIOR and *DSLOAD
+    blocks are indexed by name (names are case insensitive, as in ABAQUS).
+    A parameter edit then only replaces the affected data line in memory;
+    the fragment text is serialized when the deck is written.
+
+    Each block is a list [keyword, parameters, keyword line index, data line
+    indices]. version counts the edits since the fragment was parsed.
+    """
+
+    def __init__(self, fileName, text = None, signature = None):
+        if text is None:
+            fragmentFile = open(fileName, 'rb')
+            try:
+                text = fragmentFile.read()
+            finally:
+                fragmentFile.close()
+        self.fileName = fileName
+        self.signature = signature       # file signature of the parsed text
+        self.lines = text.splitlines(True)
+        self.version = 0
+        self.savedVersion = 0
+        self.parse()
+
+    def parse(self):
+        self.blocks = []
+        self.materials = {}              # dictionary: material name, *MATERIAL block
+        self.elastic = {}                # dictionary: material name, *ELASTIC block
+        self.interactions = {}           # dictionary: interaction name, *SURFACE INTERACTION block
+        self.cohesive = {}               # dictionary: interaction name, *COHESIVE BEHAVIOR block
+        self.dsloads = []                # list of *DSLOAD blocks
+        material = None
+        interaction = None
+        continued = False
+        for i, line in enumerate(self.lines):
+            stripped = line.strip()
+            if stripped == '' or stripped.startswith('**'):
+                continue
+            if continued:
+                # keyword line continued on this line
+                self.blocks[-1][1].update(parseKeywordLine('*,' + stripped)[1])
+                continued = stripped.endswith(',')
+                continue
+            if not stripped.startswith('*'):
+                if self.blocks:
+                    self.blocks[-1][3].append(i)
+                continue
+
+            keyword, parameters = parseKeywordLine(stripped)
+            block = [keyword, parameters, i, []]
+            self.blocks.append(block)
+            continued = stripped.endswith(',')
+            name = parameters.get('NAME', '').upper()
+            if keyword == '*MATERIAL':
+                material, interaction = name, None
+                self.materials[name] = block
+            elif keyword == '*SURFACE INTERACTION':
+                material, interaction = None, name
+                self.interactions[name] = block
+            elif keyword == '*ELASTIC' and material is not None:
+                self.elastic.setdefault(material, block)
+            elif keyword == '*COHESIVE BEHAVIOR' and interaction is not None:
+                self.cohesive.setdefault(interaction, block)
+            elif keyword == '*DSLOAD':
+                self.dsloads.append(block)
+
+    def dataLine(self, block):
+        """Return the index of the first data line of a block."""
+        if block is None or not block[3]:
+            return None
+        return block[3][0]
+
+    def setLine(self, index, line):
+        self.lines[index] = line
+        self.version = self.version + 1
+
+    def setElastic(self, matl, E = None, nu = None):
+        """Set Young's modulus and/or Poisson's ratio, return False if matl is not found."""
+        index = self.dataLine(self.elastic.get(matl.upper()))
+        if index is None:
+            return False
+        values = self.lines[index].split(',')
+        if E is not None:
+            # values[1] includes the end of line
+            values[0] = str(E)
+            values[1] = ' ' + values[1]
+        if nu is not None:
+            values[1] = ' ' + str(nu) + (os.linesep if len(values) == 2 else '')
+        self.setLine(index, ','.join(values))
+        return True
+
+    def setCohesiveStiffness(self, interaction, Knn_Kss_Ktt):
+        """Set the traction separation stiffnesses, return False if not found."""
+        index = self.dataLine(self.cohesive.get(interaction.upper()))
+        if index is None:
+            return False
+        self.setLine(index, ', '.join([str(K) for K in Knn_Kss_Ktt[:3]]) + os.linesep)
+        return True
+
+    def setInteractionThickness(self, interaction, thickness):
+        """Set the surface interaction thickness, return False if not found."""
+        index = self.dataLine(self.interactions.get(interaction.upper()))
+        if index is None:
+            return False
+        self.setLine(index, str(thickness) + os.linesep)
+        return True
+
+    def setSurfacePressure(self, surfaceName, pressureValue):
+        """
+        Set the pressure on a surface in every *DSLOAD block, adding a
+        load line to blocks that do not load the surface yet.
+        """
+        newLine = surfaceName + ', P, ' + str(pressureValue) + os.linesep
+        inserted = False
+        # Last block first, so that an inserted line does not shift the
+        # line indices of the blocks still to be visited
+        for block in reversed(self.dsloads):
+            for index in block[3]:
+                if self.lines[index].split(',')[0].strip().upper() == surfaceName.upper():
+                    self.setLine(index, newLine)
+                    break
+            else:
+                index = block[3][-1] if block[3] else block[2]
+                self.lines.insert(index + 1, newLine)
+                self.version = self.version + 1
+                inserted = True
+        if inserted:
+            self.parse()
+        return len(self.dsloads) > 0
+
+    def write(self, outFile):
+        outFile.write(''.join(self.lines))
+
+    def save(self, fileName = None):
+        """Write the edited fragment to fileName (default: back to its file)."""
+        if fileName is None:
+            atomicWrite(self.fileName, self.write)
+            self.signature = fileSignature(self.fileName)
+        else:
+            atomicWrite(fileName, self.write)
+        self.savedVersion = self.version
+
+
+# Fragment cache shared by all ABAQUS_run objects
+fragmentCache = FragmentCache()
+
 
 class ABAQUS_run:  
     """ 
@@ -304,8 +824,9 @@ class ABAQUS_run:
     """
     
     numInpOutputs = 0
-    def __init__(self, inpFileName):
+    def __init__(self, inpFileName, workDir = None):
         self.inpFileName = inpFileName       # string
+        self.workDir = workDir               # directory of the input deck, default: current directory
         self.geom = None                     # text file, part of ABAQUS input deck
         self.elements = None                 # text file, part of ABAQUS input deck
         self.materials = None                # text file, part of ABAQUS input deck
@@ -320,6 +841,10 @@ class ABAQUS_run:
         self.flag_writeStatic = 0
         self.flag_writeStiffness = 0
         self.flag_writeLoad = 0
+        self.deckLayout = None               # (fragment, signature, offset) of the last deck written
+        self.deckSignature = None
+        self.deckSize = 0
+        self.decks = {}                      # dictionary: fragment file name, InpDeck
       
     def setGeometry(self, fileName):
         self.geom = fileName
@@ -352,187 +877,100 @@ class ABAQUS_run:
         self.writeLoadStep = fileName
         
 
+    def setWorkspace(self, baseDir = None):
+        """
+        Create an isolated, uniquely named workspace directory for the run
+        (in baseDir, default: the system temporary directory). The input
+        deck and any edited fragments that are not part of the deck are
+        written there, so many runs can generate deck variants concurrently
+        from the same fragment files.
+        """
+        self.workDir = tempfile.mkdtemp(prefix=self.inpFileName + '_', dir=baseDir)
+        self.deckLayout = None
+        return self.workDir
+
+    def removeWorkspace(self):
+        if self.workDir is not None:
+            shutil.rmtree(self.workDir, ignore_errors=True)
+            self.workDir = None
+            self.deckLayout = None
+
+    def workPath(self, fileName):
+        if self.workDir is None:
+            return fileName
+        return os.path.join(self.workDir, os.path.basename(fileName))
+
+    def getInpFilePath(self):
+        return self.workPath(self.inpFileName + '.inp')
+
     def getInpFileName(self):
         #curDir = os.getcwd()
         inpFileName = self.inpFileName+'.inp'
-        print("inpFileName:  %s" % inpFileName)
+        log.info('inpFileName:  %s', inpFileName)
         return self.inpFileName
 
+    def fragmentDeck(self, fileName):
+        """
+        Return the parsed keyword model of a fragment.
+
+        The fragment is parsed on first use, and parsed again if the file
+        has been changed on disk since (which discards earlier edits).
+        """
+        deck = self.decks.get(fileName)
+        if deck is None or deck.signature != fileSignature(fileName):
+            signature, text = fragmentCache.lookup(fileName)
+            deck = InpDeck(fileName, text, signature)
+            self.decks[fileName] = deck
+        return deck
+
+    def editedDeck(self, fileName):
+        """Return the parsed fragment if it has edits, else None."""
+        deck = self.decks.get(fileName)
+        if deck is None or deck.version == 0 or \
+           deck.signature != fileSignature(fileName):
+            return None
+        return deck
+
     def setMatlE(self,matl,E):
-        oldMatlFile =  open(self.materials)
-        tempFileName = 'tempMaterials.inp'
-        newMatlFile = open(tempFileName,'w')
-        foundMatl = False
-        replaceEline = -1
-        numLine = 0
-        for line in oldMatlFile:
-            numLine = numLine + 1
-            if numLine == replaceEline:
-                values = line.split(',')
-                #print values
-                #print(len(values)
-                replaceEline = -1
-                # values[1] included a '\n'
-                newLine = str(E)+', '+values[1] 
-                newMatlFile.write(newLine)
-            else:  
-                if matl in line:
-                    foundMatl = True
-                    replaceEline = numLine + 2
-                newMatlFile.write(line)
-        if foundMatl:
-            print('Found material name %s\n'%matl)
-            shutil.move(tempFileName, self.materials)
-        
+        if self.fragmentDeck(self.materials).setElastic(matl, E = E):
+            log.info('Found material name %s', matl)
 
     def setMatlNu(self,matl,nu):
-        oldMatlFile =  open(self.materials)
-        tempFileName = 'tempMaterials.inp'
-        newMatlFile = open(tempFileName,'w')
-        foundMatl = False
-        replaceEline = -1
-        numLine = 0
-        for line in oldMatlFile:
-            numLine = numLine + 1
-            if numLine == replaceEline:
-                values = line.split(',')
-                #print(values
-                #print(len(values)
-                replaceEline = -1
-                newLine = values[0]+', '+str(nu) +os.linesep
-                newMatlFile.write(newLine)
-            else:  
-                if matl in line:
-                    foundMatl = True
-                    replaceEline = numLine + 2
-                newMatlFile.write(line)
-        if foundMatl:
-            print('Found material name %s\n'%matl)
-            shutil.move(tempFileName, self.materials)
+        if self.fragmentDeck(self.materials).setElastic(matl, nu = nu):
+            log.info('Found material name %s', matl)
 
     def modifySurfacePressure(self, loadFile, surfaceName, pressureValue):
         # assume loads are defined in a step
         # assume there is a "*Dsload" line
-        oldLoadFile =  open(loadFile)
-        tempFileName = 'tempLoadFile.inp'
-        newLoadFile = open(tempFileName,'w')
-        dsLoadlineSection = False
-        dsLoadlineNumber = -1
-        modifiedPressure = False
-        numLine = 0
-        changedFile = False
-        for line in oldLoadFile:
-            newLine = line
-            numLine = numLine + 1
-            if "Dsload" in line:
-                dsLoadlineSection = True
-                dsLoadlineNumber = numLine
-                modifiedPressure = False
-
-            if dsLoadlineSection:
-                print(line)
-                if numLine == dsLoadlineNumber:
-                    pass
-                else:
-                    if "*" in line:
-                        print('* in line')
-                        dsLoadlineSection = False
-                        if modifiedPressure == False:
-                            extraLine = surfaceName + ', P, ' + str(pressureValue) +os.linesep
-                            newLoadFile.write(extraLine)
-                            print('*** printing newline cause surf not found ' + extraLine)
-                            changedFile = True
-                            
-                    if surfaceName in line:                    
-                        newLine = surfaceName + ', P, ' + str(pressureValue) +os.linesep
-                        modifiedPressure = True
-                        print('change line to ' + newLine)
-                        changedFile = True
-            newLoadFile.write(newLine)
-            
-        if changedFile:
-            print('Set pressure on surface %s to %f\n'%(surfaceName, pressureValue))
-            shutil.move(tempFileName, loadFile)        
-
+        if self.fragmentDeck(loadFile).setSurfacePressure(surfaceName, pressureValue):
+            log.info('Set pressure on surface %s to %f', surfaceName, pressureValue)
 
     def setTractionSeparationKs(self,interaction,Knn_Kss_Ktt):
-        Knn = Knn_Kss_Ktt[0]
-        Kss = Knn_Kss_Ktt[1]
-        Ktt = Knn_Kss_Ktt[2]
-        oldInteractFile =  open(self.interactions)
-        tempFileName = 'tempInteractions.inp'
-        newInteractFile = open(tempFileName,'w')
-        foundInteract = False
-        replaceEline = -1
-        numLine = 0
-        for line in oldInteractFile:
-            numLine = numLine + 1
-            if numLine == replaceEline:
-                values = line.split(',')
-                print(values)
-                print(len(values))
-                replaceEline = -1
-                # values[1] included a '\n'
-                newLine = str(Knn)+', '+str(Kss) + ', ' + str(Ktt) + os.linesep
-                print('change line to ' + newLine)
-                newInteractFile.write(newLine)
-                #newInteractFile.write(line)
-            else:  
-                if interaction in line:
-                    if '*Surface Interaction' in line:
-                        foundInteract = True
-                        replaceEline = numLine + 3
-                newInteractFile.write(line)
-        if foundInteract:
-            print('Found interaction name %s\n'%interaction)
-            shutil.move(tempFileName, self.interactions)
+        if self.fragmentDeck(self.interactions).setCohesiveStiffness(interaction, Knn_Kss_Ktt):
+            log.info('Found interaction name %s', interaction)
         
     def setSurfaceInteractionThickness(self,interaction,thickness):
-        oldInteractFile =  open(self.interactions)
-        tempFileName = 'tempInteractions.inp'
-        newInteractFile = open(tempFileName,'w')
-        foundInteract = False
-        replaceEline = -1
-        numLine = 0
-        for line in oldInteractFile:
-            numLine = numLine + 1
-            if numLine == replaceEline:
-                values = line.split(',')
-                print(values)
-                print(len(values))
-                replaceEline = -1
-                newLine = str(str(thickness) + os.linesep)
-                print('change line to ' + newLine)
-                newInteractFile.write(newLine)
-                #newInteractFile.write(line)
-            else:  
-                if interaction in line:
-                    if '*Surface Interaction' in line:
-                        foundInteract = True
-                        replaceEline = numLine + 1
-                newInteractFile.write(line)
-        if foundInteract:
-            print('Found interaction name %s\n'%interaction)
-            shutil.move(tempFileName, self.interactions)
+        if self.fragmentDeck(self.interactions).setInteractionThickness(interaction, thickness):
+            log.info('Found interaction name %s', interaction)
 
     def addSteps(self):
-        print('add  steps to run input')
+        log.info('add  steps to run input')
         self.flag_writeSteps = 1
 
     def addStaticStep(self):
-        print('add static step to run input')
+        log.info('add static step to run input')
         self.flag_writeStatic = 1
 
     def addWriteSteps(self):
-        print('add write load step to run input')
+        log.info('add write load step to run input')
         self.flag_writeSteps = 1        
 
     def addWriteStiffnessStep(self):
-        print('add write stiffness step to run input')
+        log.info('add write stiffness step to run input')
         self.flag_writeStiffness = 1
 
     def addWriteLoadStep(self):
-        print('add write load step to run input')
+        log.info('add write load step to run input')
         self.flag_writeLoad = 1
 
     def clearStepFlags(self):
@@ -541,93 +979,105 @@ class ABAQUS_run:
         self.flag_writeStiffness = 0
         self.flag_writeLoad = 0
             
-    def writeInpFile(self):
-        print('write input file %s'% self.inpFileName)
-        fileName = self.inpFileName + '.inp'
-        inpFile = open(fileName,'w')
-
-        # mesh geometry
-        if self.geom != None:
-            geomFile = open(self.geom)
-            str = geomFile.read()
-            inpFile.write(str)
-            geomFile.close()
-
-        # element definitions
-        if self.elements != None:
-            elemFile = open(self.elements)
-            str = elemFile.read()
-            inpFile.write(str)
-            elemFile.close()
-
-        # materials definitions
-        if self.materials != None:
-            matlFile = open(self.materials)
-            str = matlFile.read()
-            inpFile.write(str)
-            matlFile.close()
-
-        # bcs definitions
-        if self.bcs != None:
-            bcsFile = open(self.bcs)
-            str = bcsFile.read()
-            inpFile.write(str)
-            bcsFile.close()
-
-        # interactions definitions
-        if self.interactions != None:
-            interactionsFile = open(self.interactions)
-            str = interactionsFile.read()
-            inpFile.write(str)
-            interactionsFile.close()
-            
+    def deckFragments(self):
+        """Return the ordered list of fragment files that make up the deck."""
+        fragments = []
+        for fragment in (self.geom, self.elements, self.materials, self.bcs,
+                         self.interactions):
+            if fragment != None:
+                fragments.append(fragment)
+
         # steps definitions
+        steps = [(self.flag_writeSteps, 'write step file name: %s', self.steps),
+                 (self.flag_writeStatic, 'write load step file name: %s', self.staticStep),
+                 (self.flag_writeStiffness, 'write load step file name: %s', self.writeStiffnessStep),
+                 (self.flag_writeLoad, 'write load step file name: %s', self.writeLoadStep)]
         numberOfSteps = 0
-        if self.flag_writeSteps == 1:
-            print('write step file name: %s' %self.steps)
-            if self.steps != None:
-                stepFile = open(self.steps)
-                str = stepFile.read()
-                inpFile.write(str)
-                #print str
-                numberOfSteps = numberOfSteps + 1
-                stepFile.close()
-
-        if self.flag_writeStatic== 1:
-            print('write load step file name: %s' %self.staticStep)
-            if self.staticStep != None:
-                stepFile = open(self.staticStep)
-                str = stepFile.read()
-                inpFile.write(str)
-                #print str
-                numberOfSteps = numberOfSteps + 1
-                stepFile.close()
-
-        if self.flag_writeStiffness == 1:
-            print('write load step file name: %s' %self.writeStiffnessStep)
-            if self.writeStiffnessStep != None:
-                stepFile = open(self.writeStiffnessStep)
-                str = stepFile.read()
-                inpFile.write(str)
-                #print str
-                numberOfSteps = numberOfSteps + 1
-                stepFile.close()
-
-        if self.flag_writeLoad == 1:
-            print('write load step file name: %s' %self.writeLoadStep)
-            if self.writeLoadStep != None:
-                stepFile = open(self.writeLoadStep)
-                str = stepFile.read()
-                inpFile.write(str)
-                #print str
-                numberOfSteps = numberOfSteps + 1
-                stepFile.close() 
+        for flag, message, stepFile in steps:
+            if flag == 1:
+                log.info(message, stepFile)
+                if stepFile != None:
+                    fragments.append(stepFile)
+                    numberOfSteps = numberOfSteps + 1
 
         if numberOfSteps < 1:
-            print('Error in ABAQUS input file: no step is defined')
-                
+            log.error('Error in ABAQUS input file: no step is defined')
 
-        inpFile.close()
+        return fragments
+
+    def writeInpFile(self):
+        """
+        Assemble the input deck from the fragment files.
+
+        Fragments are read through the shared fragmentCache, so unchanged
+        fragments are not re-read, and fragments with parameter edits are
+        serialized from their InpDeck. If the deck written by the previous
+        call is still on disk, only the part from the first changed fragment
+        on is rewritten; the (typically large) geometry and element
+        fragments at the start of the deck are left in place.
+
+        Edited fragments that are not part of the deck (e.g. a load file
+        passed to modifySurfacePressure) are written back to their file, or
+        into the workspace if one is set. New decks and fragments are
+        written atomically (see atomicWrite). The tail rewrite is done in
+        place, so it is not atomic: an interrupted rewrite leaves a partial
+        deck, which the next call writes again from the start (its file
+        signature no longer matches).
+        """
+        log.info('write input file %s', self.inpFileName)
+        fileName = self.getInpFilePath()
+
+        fragments = self.deckFragments()
+        decks = [self.editedDeck(f) for f in fragments]
+        signatures = [fragmentCache.lookup(f)[0] if deck is None else
+                      ('InpDeck', id(deck), deck.version)
+                      for f, deck in zip(fragments, decks)]
+
+        for fragment, deck in self.decks.items():
+            if fragment not in fragments and deck is self.editedDeck(fragment) \
+               and deck.savedVersion != deck.version:
+                deck.save(None if self.workDir is None else self.workPath(fragment))
+
+        # Find the first fragment that differs from the previous deck
+        layout = self.deckLayout
+        if layout is None or fileSignature(fileName) != self.deckSignature:
+            layout = []
+        start = 0
+        while start < min(len(layout), len(fragments)) and \
+              layout[start][:2] == (fragments[start], signatures[start]):
+            start = start + 1
+
+        if start == len(fragments) == len(layout):
+            log.info('input file %s is up to date', fileName)
+            return
+
+        offset = layout[start][2] if start < len(layout) else self.deckSize
+        layout = layout[:start]
+
+        def writeFragments(inpFile):
+            for fragment, signature, deck in zip(fragments, signatures, decks)[start:]:
+                layout.append((fragment, signature, inpFile.tell()))
+                if deck is None:
+                    fragmentCache.copyTo(fragment, inpFile)
+                else:
+                    deck.write(inpFile)
+            self.deckSize = inpFile.tell()
+
+        if start > 0:
+            # the deck on disk was written by this run, rewrite its tail in
+            # place (not atomic, see above)
+            inpFile = open(fileName, 'r+b')
+            try:
+                inpFile.seek(offset)
+                inpFile.truncate()
+                writeFragments(inpFile)
+            finally:
+                inpFile.close()
+        else:
+            atomicWrite(fileName, writeFragments)
+
+        self.deckLayout = layout
+        self.deckSignature = fileSignature(fileName)
 
 #
 # End ABAQUS_run
@@ -1079,6 +1529,43 @@ def searchNodeList(node, searchList, tol, exclusionBox = None):
       
     return index
 
+def gridIndices(numX, numY):
+    """Return the i and j index arrays of a numX x numY grid, in (i, j) loop order."""
+    i, j = numpy.indices((numX, numY))
+    return i.ravel(), j.ravel()
+
+def inRegion(x, y, z, region):
+    """
+    Vectorized region test of the points (x, y, z), coordinate arrays (or
+    scalars). region is None (everywhere), a box ([min x, min y, min z],
+    [max x, max y, max z]) with the bounds included as in isNodeInBox, a
+    list of boxes (their union), or a function predicate(x, y, z) that
+    returns a boolean array. Returns a boolean array.
+    """
+    x, y, z = numpy.broadcast_arrays(numpy.asarray(x, dtype=numpy.float64),
+                                     numpy.asarray(y, dtype=numpy.float64),
+                                     numpy.asarray(z, dtype=numpy.float64))
+    if region is None:
+        return numpy.ones(x.shape, dtype=bool)
+    if callable(region):
+        return numpy.asarray(region(x, y, z), dtype=bool) & numpy.ones(x.shape, dtype=bool)
+    boxes = numpy.asarray(region, dtype=numpy.float64)
+    if boxes.ndim == 2:
+        boxes = boxes[numpy.newaxis]
+    inside = numpy.zeros(x.shape, dtype=bool)
+    for low, high in boxes:
+        inside |= (x >= low[0]) & (y >= low[1]) & (z >= low[2]) & \
+                  (x <= high[0]) & (y <= high[1]) & (z <= high[2])
+    return inside
+
+def latticeCells(x, y, z, region=None):
+    """
+    Return the list of [x, y] cell centres (from the arrays x and y, at
+    height z) that are in region (see inRegion), in their original order.
+    """
+    inside = inRegion(x, y, z, region)
+    return numpy.column_stack((x[inside], y[inside])).tolist()
+
 def isNodeInBox(node, box):
     # search to see if the node ([x,y,z] is in the box ([min corner X, min corner Y, min corner Z],[max corner X, max corner Y, max corner Z])
     inside = True
@@ -1104,7 +1591,11 @@ def isNodeInBox(node, box):
     
         
 
-def writeLoadVector(fileName, unitLoadFileName, p1, p2, p3):
+def writeLoadVector(fileName, unitLoadFileName, p1, p2, p3, pOther=1.0):
+    """
+    Write the loads of a unit load file with the loads in dofs 1, 2 and 3
+    scaled by p1, p2 and p3, and the loads in other dofs by pOther.
+    """
     inpFile = open(unitLoadFileName,'r')
     numLine = 0
     newLoadFile = open(fileName, 'w')
@@ -1125,12 +1616,154 @@ def writeLoadVector(fileName, unitLoadFileName, p1, p2, p3):
             newLoad = float(values[2])*p2
         if dof == 3:
             newLoad = float(values[2])*p3            
+        if dof > 3:
+            newLoad = float(values[2])*pOther
                             
         newLine = values[0]+', '+values[1]+', '+str(newLoad) +os.linesep
         newLoadFile.write(newLine)
     inpFile.close()
     newLoadFile.close()
 
+
+class LoadSuperposition:
+    """
+    Responses of a linear step to the loads written by writeLoadVector.
+
+    writeLoadVector scales the loads of a unit load file in dofs 1, 2 and 3
+    by p1, p2 and p3 (loads in other dofs are copied unscaled). For a linear
+    step, the displacement response is therefore U.dot([p1, p2, p3, 1]),
+    where the columns of U are the responses to the dof 1, 2 and 3 unit
+    loads and to the remaining loads. The unit responses are computed once,
+    either by solving with a stiffness matrix factorized once (solveUnitCases)
+    or by reading the displacements of ABAQUS runs of the unit load files
+    (writeUnitLoadFiles, which writes the loads in other dofs to a separate
+    file, and readUnitCases), and any number of load combinations
+    then cost a single matrix product, without writing a deck or running
+    the solver.
+
+    The unit responses can be cached in a .npz file with save and load.
+    """
+
+    def __init__(self, unitLoadFileName, ndof, ndof_per_node=3):
+        self.unitLoadFileName = unitLoadFileName
+        self.ndof = ndof
+        self.ndof_per_node = ndof_per_node
+        self.U = None                        # ndof x 4 unit responses
+        self.F = self.readUnitLoads()        # ndof x 4 unit loads
+
+    def readUnitLoads(self):
+        """Return the unit loads in dofs 1, 2, 3 and the other loads as columns."""
+        F = numpy.zeros((self.ndof, 4))
+        inpFile = open(self.unitLoadFileName, 'r')
+        for line in inpFile:
+            values = line.split(',')
+            if len(values) != 3 or line.startswith('*'):
+                continue
+            dof = int(values[1])
+            row = self.dofIndex(int(values[0]), dof)
+            F[row, min(dof, 4) - 1] += float(values[2])
+        inpFile.close()
+        return F
+
+    def dofIndex(self, node, dof):
+        """
+        Return the row of the (1-based) node and dof in the ndof vectors, as
+        numbered by read_stiff_mtx. Raise ValueError if dof is not one of the
+        ndof_per_node dofs of a node (e.g. a rotation, dof 4 to 6, of a beam
+        deck read with the default ndof_per_node=3).
+        """
+        if dof < 1 or dof > self.ndof_per_node:
+            raise ValueError('dof %d of node %d in %s is not one of the %d dofs per node' %
+                             (dof, node, self.unitLoadFileName, self.ndof_per_node))
+        return (node - 1)*self.ndof_per_node + dof - 1
+
+    def writeUnitLoadFiles(self, prefix):
+        """
+        Write the unit load files prefix_1.inp, prefix_2.inp, prefix_3.inp
+        and prefix_0.inp (the loads in other dofs) for ABAQUS runs of the
+        unit cases, and return their names. The loads in other dofs are
+        only written to prefix_0.inp, so each run responds to one column of
+        the unit loads.
+        """
+        fileNames = []
+        for i, p in enumerate([(1, 0, 0, 0), (0, 1, 0, 0), (0, 0, 1, 0), (0, 0, 0, 1)]):
+            fileName = '%s_%d.inp' % (prefix, (i + 1) % 4)
+            writeLoadVector(fileName, self.unitLoadFileName, *p)
+            fileNames.append(fileName)
+        return fileNames
+
+    def solveUnitCases(self, K, fixedDofs=None):
+        """
+        Compute the unit responses with the stiffness matrix K, a dense
+        array or a sparse matrix (see read_stiff_mtx), factorized once.
+
+        If K does not include the boundary conditions, pass the rows of the
+        fixed (zero displacement) dofs as fixedDofs, e.g. from dofIndex; the
+        responses are then solved for the free dofs only, and are zero in
+        the fixed dofs (the loads in the fixed dofs are reactions).
+        """
+        if fixedDofs is None:
+            free = numpy.arange(self.ndof)
+        else:
+            free = numpy.setdiff1d(numpy.arange(self.ndof), fixedDofs)
+        if scipy.sparse.issparse(K):
+            K = scipy.sparse.csc_matrix(K)
+            if fixedDofs is not None:
+                K = K[free, :][:, free].tocsc()
+            lu = sparse_linalg.splu(K)
+            Uf = lu.solve(self.F[free])
+        else:
+            K = numpy.asarray(K)
+            if fixedDofs is not None:
+                K = K[numpy.ix_(free, free)]
+            Uf = dense_linalg.lu_solve(dense_linalg.lu_factor(K), self.F[free])
+        self.U = numpy.zeros((self.ndof, 4))
+        self.U[free] = Uf
+        return self.U
+
+    def readUnitCases(self, fileNames):
+        """
+        Read the unit responses from the displacement output (.dat) files of
+        the unit load runs, ordered as returned by writeUnitLoadFiles. The
+        last file may be omitted if there are no loads in other dofs.
+        """
+        if len(fileNames) < 4 and numpy.any(self.F[:, 3]):
+            raise ValueError('%s has loads in dofs other than 1, 2 and 3, '
+                             'the response to them (prefix_0) is needed' %
+                             self.unitLoadFileName)
+        U = numpy.zeros((self.ndof, 4))
+        for i, fileName in enumerate(fileNames):
+            U[:, i] = read_displacement_vector(fileName, self.ndof, self.ndof_per_node)
+        self.U = U
+        return self.U
+
+    def response(self, p1, p2, p3):
+        """Return the displacement vector for the load scale factors p1, p2, p3."""
+        return self.U.dot([p1, p2, p3, 1.0])
+
+    def responses(self, P):
+        """
+        Return the displacement vectors for a batch of load scale factors,
+        P is m x 3 with rows [p1, p2, p3], the result is ndof x m.
+        """
+        P = numpy.atleast_2d(P)
+        return self.U[:, :3].dot(P.T) + self.U[:, 3:]
+
+    def loadVector(self, p1, p2, p3):
+        """Return the load vector written by writeLoadVector for p1, p2, p3."""
+        return self.F.dot([p1, p2, p3, 1.0])
+
+    def save(self, fileName):
+        numpy.savez(fileName, U=self.U, F=self.F)
+
+    def load(self, fileName):
+        """Load cached unit responses, return False if they do not match the unit loads."""
+        data = numpy.load(fileName)
+        if data['F'].shape != self.F.shape or not numpy.array_equal(data['F'], self.F):
+            return False
+        self.U = data['U']
+        return True
+
        
 def read_stiff_mtx(filename, ndof, ndof_per_node=3, output_sparse=False):
     """Read abaqus matrix (mtx) file and return the matrix."""
@@ -1252,10 +1885,142 @@ def read_displacement_vector(filename, ndof, ndof_per_node=3):
         except IndexError:
             continue
         except:
-            print("Unexpected error:", sys.exc_info()[0])
+            log.error('Unexpected error: %s', sys.exc_info()[0])
             raise
         
            
     fid.close()
 
     return u
+
+
+
+def test_inp_deck():
+    """Test the parameter edits of InpDeck on a small fragment."""
+
+    text = os.linesep.join(['*Material, name=Steel',
+                            '*Elastic',
+                            '200000., 0.3',
+                            '*Dsload',
+                            'SurfA, P, 1.0',
+                            '*Dsload',
+                            'SurfA, P, 2.0',
+                            'SurfB, P, 5.0',
+                            ''])
+
+    deck = InpDeck('test.inp', text)
+    deck.setElastic('steel', E=210000.)
+    deck.setSurfacePressure('SurfB', 9.0)
+
+    loads = [[deck.lines[i].strip() for i in block[3]] for block in deck.dsloads]
+    elastic = deck.lines[deck.dataLine(deck.elastic['STEEL'])].split(',')
+    print "Elastic line set: {}".format(
+        [float(value) for value in elastic] == [210000., 0.3])
+    print "Pressure set in every *DSLOAD block, without duplicates: {}".format(
+        loads == [['SurfA, P, 1.0', 'SurfB, P, 9.0'],
+                  ['SurfA, P, 2.0', 'SurfB, P, 9.0']])
+
+
+
+def test_load_superposition():
+    """
+    Test that the unit responses read from (simulated) runs of the unit
+    load files match solveUnitCases, for a unit load file with loads in
+    rotational dofs.
+    """
+
+    # Chain of 4 nodes with 6 dofs, springs between neighbours, node 1 fixed
+    nnodes = 4
+    ndof = 6*nnodes
+    K = numpy.zeros((ndof, ndof))
+    for node in range(nnodes - 1):
+        for dof in range(6):
+            i, j = 6*node + dof, 6*(node + 1) + dof
+            K[[i, j, i, j], [i, j, j, i]] += [1., 1., -1., -1.]
+
+    workDir = tempfile.mkdtemp(prefix='loadsup_')
+    try:
+        unitLoadFileName = os.path.join(workDir, 'unit.inp')
+        unitFile = open(unitLoadFileName, 'w')
+        unitFile.write('*CLOAD\n4, 1, 1.0\n4, 2, 2.0\n4, 3, -1.0\n4, 4, 0.5\n3, 5, 0.25\n')
+        unitFile.close()
+
+        S = LoadSuperposition(unitLoadFileName, ndof, ndof_per_node=6)
+        fixedDofs = [S.dofIndex(1, dof) for dof in range(1, 7)]
+        U = S.solveUnitCases(K, fixedDofs).copy()
+
+        # Stand-in for the ABAQUS runs: solve each unit load file, and write
+        # its displacements as a .dat file
+        datFileNames = []
+        for fileName in S.writeUnitLoadFiles(os.path.join(workDir, 'unit')):
+            u = LoadSuperposition(fileName, ndof, 6).solveUnitCases(K, fixedDofs).sum(axis=1)
+            datFileName = fileName.replace('.inp', '.dat')
+            datFile = open(datFileName, 'w')
+            datFile.write('    NODE FOOT-  U1  U2  U3  UR1  UR2  UR3\n')
+            for node in range(nnodes):
+                datFile.write('%d ' % (node + 1) +
+                              ' '.join('%r' % value for value in u[6*node:6*node + 6]) + '\n')
+            datFile.write(' MAXIMUM\n')
+            datFile.close()
+            datFileNames.append(datFileName)
+
+        S.readUnitCases(datFileNames)
+        print "Read and solved unit responses all close: {}".format(
+            numpy.allclose(S.U, U) and
+            numpy.allclose(S.response(2., -1., 3.), U.dot([2., -1., 3., 1.])))
+
+        try:
+            S.readUnitCases(datFileNames[:3])
+            print "Missing response to the rotational loads detected: False"
+        except ValueError:
+            print "Missing response to the rotational loads detected: True"
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+
+
+
+def test_insert_crack():
+    """Test the connectivity of an edge crack at its mouth and at its tip."""
+
+    # 5 x 5 grid of nodes 1.5 apart, node 5*row + column, with struts
+    # between neighbours
+    mesh = ABAQUS_mesh()
+    for row in range(5):
+        for column in range(5):
+            mesh.addConnectionNode([1.5*column, 1.5*row, 0.])
+    for row in range(5):
+        for column in range(5):
+            node = 5*row + column
+            if column < 4:
+                mesh.add2Nodes_Element(node, node + 1)
+            if row < 4:
+                mesh.add2Nodes_Element(node, node + 5)
+
+    # edge crack from node 10 at (0, 3) to its tip, node 12 at (3, 3)
+    cracked = mesh.copyMesh().insertCrack([[0., 3.], [3., 3.]], tol=0.01)
+
+    duplicates = dict(cracked.crackNodePairs)
+    struts = [tuple(elem) for elem in cracked.elemList]
+    print "Crack opens from the mesh edge: {}".format(
+        sorted(duplicates) == [10, 11] and
+        (duplicates[10], 15) in struts and (duplicates[11], 16) in struts and
+        (5, 10) in struts and (6, 11) in struts)
+    print "Crack tip node is not split: {}".format(
+        12 not in duplicates and
+        all(pair in struts for pair in [(7, 12), (11, 12), (12, 13), (12, 17)]))
+
+
+
+if __name__ == "__main__":
+
+    print "Testing InpDeck class ..."
+    test_inp_deck()
+    print "Done with InpDeck class test.\n"
+
+    print "Testing LoadSuperposition class ..."
+    test_load_superposition()
+    print "Done with LoadSuperposition class test.\n"
+
+    print "Testing ABAQUS_mesh.insertCrack ..."
+    test_insert_crack()
+    print "Done with insertCrack test.\n"
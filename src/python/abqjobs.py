@@ -0,0 +1,547 @@
+# -*- coding: utf-8 -*-
+"""
+Local job queue for ABAQUS_run parameter sweeps.
+
+A JobQueue runs many ABAQUS_run decks concurrently. Each job gets its own
+workspace directory (see ABAQUS_run.setWorkspace), so decks and solver
+outputs of different jobs never collide. The number of jobs running at the
+same time is capped by a license token budget and a CPU budget; failed
+jobs (non zero exit code, time out, or missing output files) are retried,
+and the output files of successful jobs are harvested.
+
+The solver is started from a command template, so any executable can take
+the place of ABAQUS. STANDIN_COMMAND runs the stand-in solver in this
+module, which writes stiffness and load matrix files like an ABAQUS
+matrix generation step, for testing a sweep without an ABAQUS license.
+
+Usage:
+-------
+
+queue = abqjobs.JobQueue(tokens=30, cpus=8)
+
+for E in [30.E6, 40.E6, 50.E6]:
+    run = abqiface.ABAQUS_run('beam_E%d' % E)
+    ... set the fragments and steps of run ...
+    run.setMatlE('STEEL', E)
+    queue.submit(run, outputs=['_STIF1.mtx', '_LOAD2.mtx'])
+
+jobs = queue.wait()
+K = abqiface.read_stiff_mtx(jobs[0].files['_STIF1.mtx'], ndof)
+
+queue.close()
+
+The jobs are run by threads of the calling process, which only wait for the
+solver processes, so the deck edits of the ABAQUS_run objects are not
+pickled or shared with other processes.
+"""
+
+import multiprocessing
+import os
+import Queue
+import shutil
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+
+# Command template for ABAQUS; the fields are filled in for every job.
+ABAQUS_COMMAND = ['abaqus', 'job={job}', 'input={inp}', 'cpus={cpus}',
+                  'interactive']
+
+# Command template for the stand-in solver of this module.
+STANDIN_COMMAND = [sys.executable, os.path.abspath(__file__.replace('.pyc', '.py')),
+                   'job={job}', 'input={inp}']
+
+
+def kill_process_group(proc):
+    """
+    Kill proc and the processes it started: its process group on POSIX
+    (see JobQueue.execute), or its process tree with taskkill on Windows.
+    """
+
+    try:
+        if os.name == 'posix':
+            os.killpg(proc.pid, signal.SIGKILL)
+        else:
+            subprocess.call(['taskkill', '/F', '/T', '/PID', str(proc.pid)])
+    except OSError:
+        # the process has exited already
+        pass
+
+
+def abaqus_tokens(cpus):
+    """Number of ABAQUS analysis license tokens needed for a job on cpus cores."""
+
+    return int(5*cpus**0.422)
+
+
+
+class Job(object):
+    """
+    An ABAQUS_run submitted to a JobQueue.
+
+    status is one of 'queued', 'running', 'done' or 'failed'. After the job
+    has finished, files holds the paths of the harvested output files by
+    suffix, result holds the return value of the harvest function, and log
+    is the path of the solver output.
+    """
+
+    def __init__(self, run, name, cpus, tokens, outputs, setup, harvest):
+
+        self.run      = run
+        self.name     = name
+        self.cpus     = cpus
+        self.tokens   = tokens
+        self.outputs  = outputs
+        self.setup    = setup
+        self.harvest  = harvest
+
+        self.status     = 'queued'
+        self.attempts   = 0
+        self.returncode = None
+        self.error      = None
+        self.elapsed    = 0.0
+        self.files      = {}
+        self.result     = None
+        self.log        = None
+
+
+    def __repr__(self):
+        return 'Job(%s, %s, attempts=%d)' % (self.name, self.status,
+                                             self.attempts)
+
+
+
+class JobQueue(object):
+    """
+    Run ABAQUS_run jobs concurrently within token and CPU budgets.
+
+    Inputs:
+    -------
+
+    command: command template, a list of arguments that are formatted with
+    the fields job (job name), inp (absolute path of the deck), cpus and
+    workdir. Default: ABAQUS_COMMAND.
+
+    tokens: license token budget shared by the running jobs (default: no
+    limit).
+
+    cpus: CPU budget shared by the running jobs (default: number of cpus).
+
+    retries: number of times a failed job is run again.
+
+    timeout: time limit in seconds for a single solver run (default: none).
+
+    baseDir: directory for the job workspaces (default: system temporary
+    directory).
+
+    cleanup: remove the workspace of a successful job after harvesting.
+    Only useful with a harvest function, since the harvested files are
+    removed with it.
+
+    The jobs are started in the order submitted. A job whose cpus or tokens
+    exceed the budgets is rejected when submitted.
+    """
+
+    def submit(self, run, name=None, cpus=1, tokens=None, outputs=(),
+               setup=None, harvest=None):
+        """
+        Queue an ABAQUS_run and return its Job.
+
+        The deck is written by the worker when the job starts, after calling
+        setup(run) if given (e.g. to apply parameter edits). outputs lists
+        the suffixes of the files the job must produce, e.g. '_STIF1.mtx';
+        they are harvested into job.files. harvest(job), if given, is called
+        after a successful run and its return value is stored in job.result.
+        """
+
+        if name is None:
+            name = run.inpFileName
+
+        if tokens is None:
+            tokens = abaqus_tokens(cpus) if self.tokens is not None else 0
+
+        if cpus > self.cpus or (self.tokens is not None and tokens > self.tokens):
+            raise ValueError('Job %s needs %d cpus and %d tokens, the budget is '
+                             '%d cpus and %s tokens' % (name, cpus, tokens,
+                                                       self.cpus, self.tokens))
+
+        job = Job(run, name, cpus, tokens, list(outputs), setup, harvest)
+
+        with self.lock:
+            self.jobs.append(job)
+            self.pending = self.pending + 1
+
+        self.queue.put(job)
+
+        return job
+
+
+    def wait(self):
+        """Wait for all submitted jobs and return them in submission order."""
+
+        with self.lock:
+            while self.pending > 0:
+                self.changed.wait(1.0)
+
+        return list(self.jobs)
+
+
+    def failed(self):
+        """Return the jobs that failed after all retries."""
+
+        return [job for job in self.jobs if job.status == 'failed']
+
+
+    def close(self):
+        """Stop the worker threads once the queued jobs are done."""
+
+        for thread in self.threads:
+            self.queue.put(None)
+
+        for thread in self.threads:
+            thread.join()
+
+        self.threads = []
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+    def acquire(self, job):
+        """Wait until the job fits in the token and CPU budgets."""
+
+        with self.lock:
+            while self.used_cpus + job.cpus > self.cpus or \
+                  (self.tokens is not None and
+                   self.used_tokens + job.tokens > self.tokens):
+                self.changed.wait(1.0)
+
+            self.used_cpus   += job.cpus
+            self.used_tokens += job.tokens
+
+
+    def release(self, job):
+
+        with self.lock:
+            self.used_cpus   -= job.cpus
+            self.used_tokens -= job.tokens
+            self.changed.notify_all()
+
+
+    def worker(self):
+
+        while True:
+
+            job = self.queue.get()
+
+            if job is None:
+                return
+
+            try:
+                self.run_job(job)
+            except Exception as e:
+                job.status = 'failed'
+                job.error  = '%s: %s' % (type(e).__name__, e)
+
+            with self.lock:
+                self.pending = self.pending - 1
+                self.changed.notify_all()
+
+
+    def run_job(self, job):
+        """Write the deck of a job, run the solver and harvest the outputs."""
+
+        run = job.run
+
+        if run.workDir is None:
+            run.setWorkspace(self.baseDir)
+
+        if job.setup is not None:
+            job.setup(run)
+
+        run.writeInpFile()
+
+        inp = os.path.abspath(run.getInpFilePath())
+        job.log = os.path.join(run.workDir, job.name + '.log')
+
+        args = [arg.format(job=job.name, inp=inp, cpus=job.cpus,
+                           workdir=run.workDir) for arg in self.command]
+
+        while job.status != 'done' and job.attempts <= self.retries:
+
+            self.remove_outputs(job)
+
+            self.acquire(job)
+            job.status   = 'running'
+            job.attempts = job.attempts + 1
+
+            try:
+                start = time.time()
+                job.returncode = self.execute(args, run.workDir, job.log)
+                job.elapsed = time.time() - start
+            finally:
+                self.release(job)
+
+            missing = [suffix for suffix in job.outputs
+                       if not os.path.exists(self.output_path(job, suffix))]
+
+            if job.returncode == 0 and not missing:
+                job.status = 'done'
+                job.error  = None
+            else:
+                job.status = 'failed'
+                if job.returncode is None:
+                    job.error = 'timed out after %g s' % self.timeout
+                elif job.returncode != 0:
+                    job.error = 'exit code %d' % job.returncode
+                else:
+                    job.error = 'missing outputs %s' % ', '.join(missing)
+
+        if job.status == 'done':
+            job.files = dict((suffix, self.output_path(job, suffix))
+                             for suffix in job.outputs)
+            if job.harvest is not None:
+                job.result = job.harvest(job)
+            if self.cleanup:
+                run.removeWorkspace()
+
+
+    def execute(self, args, cwd, log):
+        """
+        Run a solver command, return its exit code, or None on time out.
+
+        The command is started in its own process group (on POSIX), so that
+        a time out kills the solver processes started by the abaqus 
+        launcher too, and they do not keep holding tokens and CPUs.
+        """
+
+        logFile = open(log, 'a')
+
+        try:
+            if os.name == 'posix':
+                proc = subprocess.Popen(args, cwd=cwd, stdout=logFile,
+                                        stderr=subprocess.STDOUT,
+                                        preexec_fn=os.setsid)
+            else:
+                proc = subprocess.Popen(args, cwd=cwd, stdout=logFile,
+                                        stderr=subprocess.STDOUT)
+
+            # The time out is recorded by the timer callback, under a lock
+            # so that it does not kill the group once the job has finished.
+            # A process that exited on its own with code 0 just as the timer
+            # fired is not reported as timed out.
+            state = {'exited': False, 'timedOut': False}
+            lock = threading.Lock()
+
+            def kill():
+                with lock:
+                    if not state['exited']:
+                        state['timedOut'] = True
+                        kill_process_group(proc)
+
+            timer = None
+            if self.timeout is not None:
+                timer = threading.Timer(self.timeout, kill)
+                timer.start()
+
+            returncode = proc.wait()
+
+            with lock:
+                state['exited'] = True
+
+            if timer is not None:
+                timer.cancel()
+                if state['timedOut'] and returncode != 0:
+                    returncode = None
+        finally:
+            logFile.close()
+
+        return returncode
+
+
+    def output_path(self, job, suffix):
+        return os.path.join(job.run.workDir, job.name + suffix)
+
+
+    def remove_outputs(self, job):
+        """Remove stale outputs, so a retry can not pass on old files."""
+
+        for suffix in job.outputs:
+            fname = self.output_path(job, suffix)
+            if os.path.exists(fname):
+                os.remove(fname)
+
+
+    def __init__(self, command=None, tokens=None, cpus=None, retries=1,
+                 timeout=None, baseDir=None, cleanup=False):
+
+        if command is None:
+            command = ABAQUS_COMMAND
+
+        if cpus is None:
+            cpus = multiprocessing.cpu_count()
+
+        self.command = list(command)
+        self.tokens  = tokens
+        self.cpus    = cpus
+        self.retries = retries
+        self.timeout = timeout
+        self.baseDir = baseDir
+        self.cleanup = cleanup
+
+        # Budget accounting, shared by the worker threads.
+        self.lock        = threading.Lock()
+        self.changed     = threading.Condition(self.lock)
+        self.used_cpus   = 0
+        self.used_tokens = 0
+
+        self.jobs    = []
+        self.pending = 0
+        self.queue   = Queue.Queue()
+
+        # One worker per cpu is enough, since every job needs at least one.
+        self.threads = [threading.Thread(target=self.worker)
+                        for k in range(cpus)]
+
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+        return
+
+
+
+
+#
+# Stand-in solver
+#
+
+def read_deck(fname):
+    """Return the node numbers and first *ELASTIC data of an input deck."""
+
+    nodes   = []
+    elastic = None
+    block   = None
+
+    for line in open(fname):
+        line = line.strip()
+        if line == '' or line.startswith('**'):
+            continue
+        if line.startswith('*'):
+            block = line.split(',')[0].strip().upper()
+            continue
+        if block == '*NODE':
+            nodes.append(int(line.split(',')[0]))
+        elif block == '*ELASTIC' and elastic is None:
+            elastic = [float(v) for v in line.split(',') if v.strip() != '']
+
+    return nodes, elastic
+
+
+def standin_solver(argv):
+    """
+    Stand-in for ABAQUS, run as: python abqjobs.py job=name input=deck.inp
+
+    Writes name_STIF1.mtx, a diagonal stiffness matrix with Young's modulus
+    of the first material on the diagonal (3 dofs per node), name_LOAD2.mtx
+    with a unit load in the first dof, and name.sta. The options fail=n
+    (fail the first n runs in the directory) and sleep=seconds help to test
+    retries and time outs.
+    """
+
+    options = dict(arg.split('=', 1) for arg in argv if '=' in arg)
+
+    job = options['job']
+
+    time.sleep(float(options.get('sleep', 0)))
+
+    fail = int(options.get('fail', 0))
+    if fail > 0:
+        count_name = job + '.attempts'
+        count = int(open(count_name).read()) if os.path.exists(count_name) else 0
+        open(count_name, 'w').write(str(count + 1))
+        if count < fail:
+            print('stand-in solver: simulated failure %d' % (count + 1))
+            return 1
+
+    nodes, elastic = read_deck(options['input'])
+    E = elastic[0] if elastic else 1.0
+
+    stiff = open(job + '_STIF1.mtx', 'w')
+    for n in nodes:
+        for dof in range(1, 4):
+            stiff.write('%d,%d,%d,%d,%r\n' % (n, dof, n, dof, E))
+    stiff.close()
+
+    load = open(job + '_LOAD2.mtx', 'w')
+    load.write('*CLOAD, REAL\n**\n')
+    for n in nodes:
+        for dof in range(1, 4):
+            load.write('%d,%d,%r\n' % (n, dof, 1.0 if dof == 1 else 0.0))
+    load.close()
+
+    open(job + '.sta', 'w').write(' THE ANALYSIS HAS COMPLETED SUCCESSFULLY\n')
+
+    print('stand-in solver: %s, %d nodes, E = %r' % (job, len(nodes), E))
+
+    return 0
+
+
+
+# Sweep the beam model with the stand-in solver
+if __name__ == "__main__":
+
+    if len(sys.argv) > 1:
+        sys.exit(standin_solver(sys.argv[1:]))
+
+    import tempfile
+
+    import abqiface
+
+    model = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         '..', '..', 'simulations', 'beam_1', 'model')
+
+    baseDir = tempfile.mkdtemp(prefix='abqjobs_')
+
+    # One failure per job, to exercise the retries.
+    queue = JobQueue(command=STANDIN_COMMAND + ['fail=1'], tokens=12,
+                     cpus=4, retries=2, baseDir=baseDir)
+
+    def make_run(name):
+        run = abqiface.ABAQUS_run(name)
+        run.setGeometry(os.path.join(model, 'geometry.inp'))
+        run.setElements(os.path.join(model, 'elements.inp'))
+        run.setBCs(os.path.join(model, 'bcs.inp'))
+        run.setMaterials(os.path.join(model, 'materials.inp'))
+        run.setSteps(os.path.join(model, 'steps.inp'))
+        run.addWriteSteps()
+        return run
+
+    Es = [30.E6, 35.E6, 40.E6, 45.E6, 50.E6, 55.E6]
+
+    for k, E in enumerate(Es):
+        queue.submit(make_run('beam_%d' % k), cpus=1 + k % 2,
+                     outputs=['_STIF1.mtx', '_LOAD2.mtx'],
+                     setup=lambda run, E=E: run.setMatlE('STEEL', E),
+                     harvest=lambda job: float(open(job.files['_STIF1.mtx'])
+                                               .readline().split(',')[4]))
+
+    start = time.time()
+    jobs = queue.wait()
+    queue.close()
+
+    for job in jobs:
+        print('%s %s' % (job, job.result))
+
+    print('E matches: %s' % ([job.result for job in jobs] == Es))
+    print('elapsed %.2f s' % (time.time() - start))
+
+    shutil.rmtree(baseDir, ignore_errors=True)
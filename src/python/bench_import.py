@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+Import-time benchmarks and budget for the core modules.
+
+Process pool workers (bgnpar, abqjobs, bgnbeamer figure rendering) import
+these modules on every spawn, so importing them must not pull in the
+plotting, statistics or PARDISO modules, which are imported on first use
+instead (see lazyimport.py).
+
+Each benchmark imports one module in a fresh python interpreter, and
+reports the import time (excluding the interpreter start-up) in 'info'. A
+benchmark fails if the import takes longer than its budget (IMPORT_BUDGET,
+in seconds), or if it loads any of the HEAVY_MODULES.
+
+Run, e.g.,
+
+    python bench_import.py
+    python bench_import.py --filter 'import_lcsmodel' --save imports.json
+
+The exit status is 1 if a module is over budget. See benchmark.py for all
+options.
+"""
+
+import json
+import os
+import subprocess
+import sys
+
+import benchmark
+
+
+# Import-time budget of the core modules, in seconds. numpy and
+# scipy.sparse, which all of them need, take most of it.
+IMPORT_BUDGET = {'lcsmodel':  0.5,
+                 'abqiface':  0.5,
+                 'abqjobs':   0.5,
+                 'bgn':       0.5,
+                 'bgnlcs':    0.5,
+                 'bgnpar':    0.5,
+                 'bgninfo':   0.5,
+                 'bgnbeamer': 0.5}
+
+# Modules that must only be imported on first use
+HEAVY_MODULES = ['matplotlib', 'scipy.stats', 'cypardiso']
+
+# Run in the child interpreter: import the module given as argument, and
+# print the import time and the heavy modules loaded, as JSON.
+IMPORT_SCRIPT = """
+import json, sys, timeit
+start = timeit.default_timer()
+__import__(sys.argv[1])
+elapsed = timeit.default_timer() - start
+heavy = [name for name in json.loads(sys.argv[2]) if name in sys.modules]
+print(json.dumps({'import_time': elapsed, 'heavy': heavy}))
+"""
+
+
+def time_import(name):
+    """Return the import time and the heavy modules loaded by name."""
+
+    output = subprocess.check_output(
+        [sys.executable, '-c', IMPORT_SCRIPT, name, json.dumps(HEAVY_MODULES)],
+        cwd=os.path.dirname(os.path.abspath(__file__)))
+
+    # the last line, after any output of the module itself
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def import_module(name):
+
+    def bench(param, data):
+        info = time_import(name)
+        info['budget'] = IMPORT_BUDGET[name]
+
+        if info['heavy']:
+            raise AssertionError('importing %s loads %s' %
+                                 (name, ', '.join(info['heavy'])))
+        if info['import_time'] > IMPORT_BUDGET[name]:
+            raise AssertionError('importing %s takes %.3f s, budget %.3f s' %
+                                 (name, info['import_time'], IMPORT_BUDGET[name]))
+        return info
+
+    return bench
+
+
+for name in sorted(IMPORT_BUDGET):
+    benchmark.benchmark(name='import_' + name)(import_module(name))
+
+
+
+if __name__ == "__main__":
+
+    results = benchmark.main()
+
+    if any(result['status'] != 'ok' for result in results):
+        sys.exit(1)
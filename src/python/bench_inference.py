@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the inference stack: LCSModel/DC_LCSModel, bgn_lcs_solver
+and sbgn_solver, on the scalable test.Model3.
+
+The problem sizes are (n, p, d) tuples: the number of model outputs per
+load case n (10^3 to 10^6), the number of load cases p, and the number of
+parameters d. Each load case is measured by SENSORS evenly spaced sensors.
+
+The solver phases (factorization, model solution, Jacobian, objective,
+line search, posterior precision) are timed as separate benchmarks, and
+the full solver runs report the time spent in each phase, and the solver
+counters, from their trace (see bgntrace.py) in the 'info' field of their
+results. The solver benchmarks are repeated
+for each available linear solver backend (see BACKENDS).
+
+Run, e.g.,
+
+    python bench_inference.py --max-param 100000 --save inference.json
+    python bench_inference.py --filter 'bgn_lcs_solver*' --verbose
+
+See benchmark.py for all options.
+"""
+
+import numpy as np
+import scipy.sparse as sprs
+import scipy.sparse.linalg as spla
+
+import benchmark
+import bgn
+import bgnlcs
+import lcsmodel
+import test
+
+
+# Problem sizes (n, p, d): scaling in n, then in p and d at n = 10^4
+SIZES = [(10**3, 3, 4), (10**4, 3, 4), (10**5, 3, 4), (10**6, 3, 4),
+         (10**4, 1, 4), (10**4, 10, 4), (10**4, 30, 4),
+         (10**4, 3, 2), (10**4, 3, 8), (10**4, 3, 16)]
+
+# Number of sensors per load case
+SENSORS = 100
+
+
+
+#
+# Linear solver backends
+#
+
+# The backends override factor, and the untraced solve_rhs (backsolve
+# records the solves in the solver trace).
+
+class SpluSolver(lcsmodel.Solver):
+    """lcsmodel.Solver using scipy splu, with all r.h.s. solved at once."""
+
+    def factor(self, A):
+        self.m, self.n = A.shape
+        self.trace.count('factorizations')
+        with self.trace.phase('factorization'):
+            self.lu = spla.splu(sprs.csc_matrix(A))
+
+    def solve_rhs(self, b, transp='N'):
+        return self.lu.solve(np.asarray(b, dtype=np.float64), trans=transp)
+
+
+class PardisoSolver(lcsmodel.Solver):
+    """lcsmodel.Solver using pardiso.Factor."""
+
+    def factor(self, A):
+        import pardiso
+        self.m, self.n = A.shape
+        self.trace.count('factorizations')
+        with self.trace.phase('factorization'):
+            if self.A_factorized is not None:
+                self.A_factorized.free()
+            self.A_factorized = pardiso.Factor(sprs.csr_matrix(A))
+
+    def solve_rhs(self, b, transp='N'):
+        b = np.asarray(b, dtype=np.float64)
+        if b.ndim == 1:
+            return self.A_factorized.backsolve(b, trans=transp)
+        return np.column_stack([self.A_factorized.backsolve(b[:,k], trans=transp)
+                                for k in range(b.shape[1])])
+
+
+def pardiso_available():
+    import pardiso
+    return pardiso.available()
+
+
+# Solver backends by name; 'factorized' is the default lcsmodel.Solver
+# (scipy factorized, i.e., UMFPACK if scikits.umfpack is installed, and
+# SuperLU otherwise).
+BACKENDS = {'factorized': lcsmodel.Solver, 'splu': SpluSolver}
+
+if pardiso_available():
+    BACKENDS['pardiso'] = PardisoSolver
+
+
+
+#
+# Problem setup
+#
+
+def make_problem(param, backend='factorized', decoupled=True):
+    """Return a dictionary with the model, data and prior of a problem."""
+
+    n, p, d = param
+
+    TM = test.Model3(n, p, d)
+
+    if decoupled:
+        lcsModel = lcsmodel.DC_LCSModel()
+        lcsModel.eval_A = TM.eval_A
+        lcsModel.eval_b = TM.eval_b
+        lcsModel.diff_A = TM.diff_A
+        lcsModel.diff_b = TM.diff_b
+        lcsModel.A_params_mask = np.arange(d) < TM.dA
+        lcsModel.b_params_mask = np.logical_not(lcsModel.A_params_mask)
+    else:
+        lcsModel = lcsmodel.LCSModel()
+        lcsModel.eval_A_and_b = TM.eval_A_and_b
+        lcsModel.diff_A_and_b = TM.diff_A_and_b
+
+    lcsModel.solver = BACKENDS[backend]()
+
+    # Sensor selection matrices
+    m    = min(n, SENSORS)
+    rows = np.arange(m)
+    cols = np.linspace(0, n-1, m).astype(int)
+    M    = [sprs.csr_matrix((np.ones(m), (rows, cols)), shape=(m, n))
+            for k in range(p)]
+
+    theta_act = TM.theta_nominal()
+
+    rand = np.random.RandomState(1)
+    X    = lcsModel.eval(theta_act)
+    Data = np.column_stack([M[k].dot(X[:,k]) for k in range(p)])
+    Data = Data + 0.001*rand.randn(*Data.shape)
+
+    Prior = {'theta_mean':   theta_act,
+             'iSigma_theta': np.eye(d),
+             'psig':         0.1*np.ones(p),
+             'theta_o':      theta_act*(1. + 0.1*rand.randn(d))}
+
+    f_obj = bgnlcs.ObjFun(Data, M, lcsModel, Prior)
+
+    x     = lcsModel.eval(Prior['theta_o'])
+    s     = f_obj.precision_update(x)
+
+    return {'model': lcsModel, 'M': M, 'Data': Data, 'Prior': Prior,
+            'f_obj': f_obj, 'theta': Prior['theta_o'], 'x': x, 's': s,
+            'trials': 0}
+
+
+#
+# Solver phases
+#
+
+@benchmark.benchmark(params=SIZES, setup=make_problem)
+def lcs_factorization(param, P):
+    P['model'].update_A_b(P['theta'], force=True)
+
+
+@benchmark.benchmark(params=SIZES, setup=make_problem)
+def lcs_eval(param, P):
+    P['model'].eval(P['theta'])
+
+
+@benchmark.benchmark(params=SIZES, setup=make_problem)
+def lcs_jacobian_dense(param, P):
+    P['model'].jacobian(P['theta'])
+
+
+@benchmark.benchmark(params=SIZES, setup=make_problem)
+def lcs_jacobian_lazy(param, P):
+    D = P['model'].jacobian_operator(P['theta'])
+    [D.mdot(k, P['M'][k]) for k in range(D.p)]
+
+
+@benchmark.benchmark(params=SIZES, setup=make_problem)
+def lcs_jacobian_sensor(param, P):
+    P['model'].sensor_jacobian(P['theta'], P['M'])
+
+
+@benchmark.benchmark(params=SIZES, setup=make_problem)
+def objective(param, P):
+    P['f_obj'].eval(P['x'], P['theta'], P['s'])
+
+
+@benchmark.benchmark(params=SIZES, setup=make_problem)
+def line_search_step(param, P):
+    # One backtracking trial: assembly, factorization, model solution and
+    # objective. The trial theta alternates between calls, since the model
+    # skips the update when theta has not changed.
+    P['trials'] += 1
+    theta_t = P['theta']*(1.01 if P['trials'] % 2 else 0.99)
+    x_t = P['model'].eval(theta_t)
+    P['f_obj'].eval(x_t, theta_t, P['s'])
+
+
+@benchmark.benchmark(params=SIZES, setup=make_problem)
+def posterior_precision(param, P):
+    P['f_obj'].jac_theta = None
+    P['f_obj'].eval_posterior_precision(P['x'], P['theta'], P['s'])
+
+
+
+#
+# Full solvers
+#
+
+def solve_lcs(param, P):
+    factor_cnt = P['model'].factor_cnt
+    Est = bgnlcs.bgn_lcs_solver(P['Data'], P['M'], P['model'], P['Prior'],
+                                QUIET=True, MAXIT=30, TRACE=True)
+    return {'phases': Est['trace']['phases'], 'lnZ': Est['lnZ'],
+            'status': Est['status'],
+            'factor_cnt': P['model'].factor_cnt - factor_cnt,
+            'counters': Est['trace']['counters']}
+
+
+for backend in sorted(BACKENDS):
+    benchmark.benchmark(params=SIZES, repeat=1, name='bgn_lcs_solver_' + backend,
+                        setup=lambda param, backend=backend:
+                              make_problem(param, backend))(solve_lcs)
+
+
+def make_sbgn_problem(param):
+    """Sensor model of make_problem, flattened for sbgn_solver."""
+
+    P = make_problem(param)
+
+    lcsModel, M = P['model'], P['M']
+    p = len(M)
+
+    def Model(theta):
+        X = lcsModel.eval(np.ravel(theta))
+        return np.concatenate([M[k].dot(X[:,k]) for k in range(p)]).reshape((-1, 1))
+
+    def Jacobian(theta):
+        return np.vstack(lcsModel.sensor_jacobian(np.ravel(theta), M))
+
+    d = len(P['theta'])
+    P['sbgn'] = (P['Data'].T.reshape((-1, 1)), Model, Jacobian,
+                 {'x_mean':   P['Prior']['theta_mean'].reshape((d, 1)),
+                  'iSigma_x': P['Prior']['iSigma_theta'],
+                  'psig':     0.1,
+                  'xo':       P['theta'].reshape((d, 1))})
+
+    return P
+
+
+@benchmark.benchmark(params=SIZES, repeat=1, setup=make_sbgn_problem)
+def sbgn_solver(param, P):
+    Est = bgn.sbgn_solver(*P['sbgn'], QUIET=True, MAXIT=30)
+    return {'lnZ': Est['lnZ']}
+
+
+
+if __name__ == "__main__":
+
+    benchmark.main()
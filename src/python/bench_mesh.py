@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the lattice mesh generation and the ABAQUS deck I/O in
+abqiface.
+
+The problem sizes are numbers of struts (beam elements with one beam per
+strut), from 10^3 to 10^6; the .mtx and .dat inputs are synthetic files for
+a mesh of matching size (one node per two struts, 3 dofs per node). The
+lattice generators are repeated up to 3 times, within a 10 s budget, so
+that the small sizes are not timed from a single, noisy run.
+
+Run, e.g.,
+
+    python bench_mesh.py --max-param 10000 --save mesh_baseline.json
+    python bench_mesh.py --max-param 10000 --compare mesh_baseline.json
+
+See benchmark.py for all options.
+"""
+
+import math
+import os
+import shutil
+import tempfile
+
+import numpy
+
+import abqiface
+import benchmark
+
+
+# Numbers of struts
+SIZES = [10**3, 10**4, 10**5, 10**6]
+
+
+
+#
+# Lattice generation
+#
+
+@benchmark.benchmark(params=SIZES, repeat=3, repeat_budget=10.)
+def voxel_lattice(struts, data):
+    # 12 struts per voxel
+    num = max(1, int(round((struts/12.)**(1./3))))
+    mesh = abqiface.ABAQUS_mesh()
+    mesh.addVoxelLatticeMesh(num, num, num, 1, 'B31', 0., 0., 0.)
+
+
+@benchmark.benchmark(params=SIZES, repeat=3, repeat_budget=10.)
+def kagome_lattice(struts, data):
+    # 6 struts per kagome cell
+    num = max(1, int(round(math.sqrt(struts/6.))))
+    mesh = abqiface.ABAQUS_mesh()
+    mesh.addKagome1LatticeMesh(num, num, 1, 0., 0., 0., 1., 60)
+
+
+@benchmark.benchmark(params=SIZES, repeat=3, repeat_budget=10.)
+def kagome_region(struts, data):
+    # about as many cells as kagome_lattice, kept by an inclusion box from
+    # a grid with 16 times as many cells
+    num = max(1, int(round(math.sqrt(struts/6.))))
+    top = num*math.sin(math.radians(60))
+    mesh = abqiface.ABAQUS_mesh()
+    mesh.addKagome1LatticeMesh(4*num, 4*num, 1, 0., 0., 0., 1., 60,
+                               [[0., 0., -1.], [num, top, 1.]])
+
+
+@benchmark.benchmark(params=SIZES, repeat=3, repeat_budget=10.)
+def honeycomb_lattice(struts, data):
+    # 6 struts per honeycomb cell
+    num = max(1, int(round(math.sqrt(struts/6.))))
+    mesh = abqiface.ABAQUS_mesh()
+    mesh.addHoneycomb1LatticeMesh(num, num, 1, 0., 0., 0., 1.)
+
+
+
+#
+# Node and element set output
+#
+
+def make_sets(struts):
+    mesh = abqiface.ABAQUS_mesh()
+    mesh.addNset('nodes', range(struts//2))
+    mesh.addElset('elements', range(struts))
+    return mesh
+
+
+@benchmark.benchmark(params=SIZES, setup=make_sets)
+def write_nset(struts, mesh):
+    f = open(os.devnull, 'w')
+    mesh.writeNset(f, 'nodes')
+    f.close()
+
+
+@benchmark.benchmark(params=SIZES, setup=make_sets)
+def write_elset(struts, mesh):
+    f = open(os.devnull, 'w')
+    mesh.writeElset(f, 'elements')
+    f.close()
+
+
+
+#
+# Node queries
+#
+
+def make_nodes(struts):
+    """Node coordinates of a lattice of matching size, on a 1.5 pitch grid."""
+
+    nodes = struts//2
+    side  = int(math.ceil(nodes**(1./3)))
+    grid  = numpy.indices((side, side, side)).reshape((3, -1)).T[:nodes]
+    return 1.5*grid
+
+
+def make_node_index(struts):
+    coords = make_nodes(struts)
+    return (abqiface.NodeIndex(coords), coords.max())
+
+
+@benchmark.benchmark(params=SIZES, setup=make_nodes)
+def node_index_build(struts, coords):
+    abqiface.NodeIndex(coords)
+
+
+@benchmark.benchmark(params=SIZES, setup=make_node_index)
+def node_bc_sets(struts, data):
+    # boundary condition and load node sets: the six faces and a corner box
+    index, top = data
+    for axis in range(3):
+        index.planes(axis, [0., top])
+    index.box([[0., 0., 0.], [0.1*top, 0.1*top, 0.1*top]])
+
+
+def make_node_tree(struts):
+    index, top = make_node_index(struts)
+    index.kdTree()
+    return (index, top)
+
+
+@benchmark.benchmark(params=SIZES, setup=make_node_tree)
+def node_sphere(struts, data):
+    index, top = data
+    index.sphere([top/2, top/2, top/2], 3.)
+
+
+
+#
+# Crack insertion
+#
+
+def make_grid_mesh(struts):
+    """Merged square grid mesh (pitch 1.5) with struts to the x and y neighbours."""
+
+    side = max(2, int(round(math.sqrt(struts/2.))))
+    mesh = abqiface.ABAQUS_mesh()
+    for j in range(side):
+        for i in range(side):
+            mesh.addConnectionNode([1.5*i, 1.5*j, 0.])
+    for j in range(side):
+        for i in range(side):
+            n = j*side + i
+            if i + 1 < side:
+                mesh.add2Nodes_Element(n, n + 1)
+            if j + 1 < side:
+                mesh.add2Nodes_Element(n, n + side)
+    return (mesh, 1.5*(side - 1))
+
+
+@benchmark.benchmark(params=SIZES, setup=make_grid_mesh)
+def insert_crack(struts, data):
+    # an edge crack along a node row, half way across
+    mesh, top = data
+    y = 1.5*round(top/3.)
+    mesh.insertCrack([[0., y], [top/2, y]], tol=0.01)
+
+
+
+#
+# Matrix and result file input
+#
+
+def make_stiff_mtx(struts):
+    """Write a banded symmetric stiffness matrix in the ABAQUS mtx format."""
+
+    tmpdir = tempfile.mkdtemp(prefix='bench_')
+    fname  = os.path.join(tmpdir, 'bench_STIF1.mtx')
+    nodes  = struts//2
+
+    f = open(fname, 'w')
+    for n in range(1, nodes + 1):
+        # couple the dofs of each node with those of the next node
+        for dof in range(1, 4):
+            for m in range(n, min(n + 1, nodes) + 1):
+                for cdof in range(1 if m > n else dof, 4):
+                    f.write('%d,%d,%d,%d,%.15e\n' %
+                            (n, dof, m, cdof, 1.0 if (m, cdof) == (n, dof) else -0.1))
+    f.close()
+
+    return (tmpdir, fname, 3*nodes)
+
+
+def make_displacement_dat(struts):
+    """Write a node displacement table in the ABAQUS dat format."""
+
+    tmpdir = tempfile.mkdtemp(prefix='bench_')
+    fname  = os.path.join(tmpdir, 'bench.dat')
+    nodes  = struts//2
+    u      = numpy.random.randn(nodes, 3)
+
+    f = open(fname, 'w')
+    f.write('   THE FOLLOWING TABLE IS PRINTED FOR ALL NODES\n\n')
+    f.write('       NODE FOOT-       U1             U2             U3\n')
+    f.write('            NOTE\n\n')
+    for n in range(nodes):
+        f.write('%11d      %14.6E %14.6E %14.6E\n' % ((n + 1,) + tuple(u[n])))
+    f.write('\n MAXIMUM        %14.6E %14.6E %14.6E\n' % tuple(u.max(0)))
+    f.close()
+
+    return (tmpdir, fname, 3*nodes)
+
+
+def remove_input(data):
+    shutil.rmtree(data[0], ignore_errors=True)
+
+
+@benchmark.benchmark(params=SIZES, setup=make_stiff_mtx, teardown=remove_input)
+def read_stiff_mtx(struts, data):
+    abqiface.read_stiff_mtx(data[1], data[2], output_sparse=True)
+
+
+@benchmark.benchmark(params=SIZES, setup=make_displacement_dat,
+                     teardown=remove_input)
+def read_displacement_vector(struts, data):
+    abqiface.read_displacement_vector(data[1], data[2])
+
+
+
+if __name__ == "__main__":
+
+    benchmark.main()
@@ -0,0 +1,358 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark harness for the mesh generation, deck I/O and inference code.
+
+Benchmarks are registered with the benchmark decorator, each with a list
+of problem sizes (params, numbers or tuples whose first element is the
+size) and an optional setup function that builds the inputs outside the
+timed region. A benchmark may return a dict of extra measurements (e.g.
+phase timings), which is stored with its result as 'info'. Every
+(benchmark, param) pair runs in a forked child process, so that its peak
+memory (ru_maxrss) is not masked by earlier runs, and a run that takes
+longer than the time limit is stopped and reported as a time out instead
+of stalling the suite.
+
+Results are written as JSON, and can be compared against a saved baseline;
+main() exits with status 1 if a benchmark got slower (or used more memory)
+than the baseline by more than the given factor.
+
+Usage:
+-------
+
+Benchmark suites (bench_mesh.py, ...) define their benchmarks and call
+benchmark.main():
+
+    @benchmark.benchmark(params=[1000, 10000], setup=make_input)
+    def kagome(n, data):
+        ...
+
+    if __name__ == "__main__":
+        benchmark.main()
+
+and are run as, e.g.,
+
+    python bench_mesh.py --save baseline.json
+    python bench_mesh.py --compare baseline.json --threshold 1.5
+    python bench_mesh.py --compare baseline.json --min-time 0.5
+    python bench_mesh.py --filter kagome --max-param 100000
+
+Time is the minimum over the repeats, in seconds. Benchmarks with a
+repeat_budget stop repeating once their runs took that long in total, so
+the small sizes are repeated and the large ones are run once. peak_mb is the peak
+resident memory of the child process, and mem_mb the growth of the peak
+during the timed runs (i.e. excluding the setup), both in MB.
+"""
+
+import argparse
+import datetime
+import fnmatch
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import timeit
+import traceback
+
+
+# Registered benchmarks, in definition order.
+BENCHMARKS = []
+
+
+
+class Benchmark(object):
+    """A registered benchmark function with its problem sizes."""
+
+    def __init__(self, func, name, params, setup, teardown, repeat, timeout,
+                 repeat_budget):
+
+        self.func          = func
+        self.name          = name
+        self.params        = params
+        self.setup         = setup
+        self.teardown      = teardown
+        self.repeat        = repeat
+        self.timeout       = timeout
+        self.repeat_budget = repeat_budget
+
+
+
+def benchmark(params=(None,), setup=None, teardown=None, repeat=3,
+              timeout=600, name=None, repeat_budget=None):
+    """
+    Decorator that registers func(param, data) as a benchmark, where data
+    is setup(param), or None without a setup function. teardown(data) is
+    called after the timed runs, e.g. to remove input files. func is run
+    repeat times, or until the runs took repeat_budget seconds in total
+    (if given).
+    """
+
+    def register(func):
+        BENCHMARKS.append(Benchmark(func, name or func.__name__, list(params),
+                                    setup, teardown, repeat, timeout,
+                                    repeat_budget))
+        return func
+
+    return register
+
+
+def maxrss_mb():
+    """Peak resident memory of this process in MB."""
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # ru_maxrss is in bytes on Mac OS X and in kB on Linux
+    if sys.platform == 'darwin':
+        return rss/2.0**20
+
+    return rss/2.0**10
+
+
+def measure(bench, param, conn, quiet):
+    """Child process: run the benchmark and send the result through conn."""
+
+    try:
+        if quiet:
+            # Silence the print statements of the benchmarked code.
+            devnull = os.open(os.devnull, os.O_WRONLY)
+            os.dup2(devnull, 1)
+
+        data = bench.setup(param) if bench.setup is not None else None
+
+        rss   = maxrss_mb()
+        times = []
+
+        try:
+            for k in range(bench.repeat):
+                start = timeit.default_timer()
+                info  = bench.func(param, data)
+                times.append(timeit.default_timer() - start)
+                
+                if bench.repeat_budget is not None and \
+                   sum(times) >= bench.repeat_budget:
+                    break
+        finally:
+            if bench.teardown is not None:
+                bench.teardown(data)
+
+        result = {'status': 'ok', 'time': min(times), 'times': times,
+                  'peak_mb': maxrss_mb(), 'mem_mb': maxrss_mb() - rss}
+
+        # Extra measurements returned by the benchmark (last run)
+        if isinstance(info, dict):
+            result['info'] = info
+
+        conn.send(result)
+
+    except Exception:
+        conn.send({'status': 'error', 'error': traceback.format_exc()})
+
+    conn.close()
+
+
+def run_benchmark(bench, param, quiet=True, timeout=None):
+    """Run one benchmark at one problem size in a child process."""
+
+    if timeout is None:
+        timeout = bench.timeout
+
+    recv, send = multiprocessing.Pipe(False)
+
+    proc = multiprocessing.Process(target=measure,
+                                   args=(bench, param, send, quiet))
+    proc.start()
+    send.close()
+
+    if recv.poll(timeout):
+        try:
+            result = recv.recv()
+        except EOFError:
+            result = {'status': 'error', 'error': 'benchmark process died'}
+    else:
+        result = {'status': 'timeout', 'error': 'no result after %g s' % timeout}
+        proc.terminate()
+
+    proc.join()
+
+    result['name']  = bench.name
+    result['param'] = param
+
+    return result
+
+
+def param_size(param):
+    """Problem size of a param, the first element of a tuple param."""
+
+    if isinstance(param, (tuple, list)):
+        return param[0]
+
+    return param
+
+
+def result_key(result):
+
+    param = result['param']
+
+    # tuple params are saved as JSON lists
+    if isinstance(param, (tuple, list)):
+        param = ','.join(str(v) for v in param)
+
+    return '%s[%s]' % (result['name'], param)
+
+
+def run(benchmarks=None, pattern='*', max_param=None, quiet=True,
+        timeout=None, stream=sys.stdout):
+    """
+    Run the benchmarks whose name matches the glob pattern, up to problem
+    size max_param, and return the list of results.
+    """
+
+    if benchmarks is None:
+        benchmarks = BENCHMARKS
+
+    results = []
+
+    for bench in benchmarks:
+
+        if not fnmatch.fnmatch(bench.name, pattern):
+            continue
+
+        for param in bench.params:
+
+            if max_param is not None and param is not None and \
+               param_size(param) > max_param:
+                continue
+
+            result = run_benchmark(bench, param, quiet, timeout)
+            results.append(result)
+
+            if stream is not None:
+                stream.write(format_result(result) + '\n')
+                stream.flush()
+
+    return results
+
+
+def format_result(result):
+
+    if result['status'] != 'ok':
+        return '%-40s %s' % (result_key(result), result['status'])
+
+    return '%-40s %10.4f s %10.1f MB peak %10.1f MB' % (
+        result_key(result), result['time'], result['peak_mb'], result['mem_mb'])
+
+
+def save(results, fname):
+    """Save results as JSON, with the python version and platform."""
+
+    data = {'python':   platform.python_version(),
+            'platform': platform.platform(),
+            'date':     datetime.datetime.now().isoformat(),
+            'results':  results}
+
+    f = open(fname, 'w')
+    json.dump(data, f, indent=1, sort_keys=True)
+    f.close()
+
+
+def load(fname):
+    """Load the results saved by save."""
+
+    f = open(fname, 'r')
+    data = json.load(f)
+    f.close()
+
+    return data['results']
+
+
+def compare(results, baseline, threshold=1.5, mem_threshold=None, min_time=0.1):
+    """
+    Return the list of regressions (key, message) of results relative to
+    the baseline results.
+
+    A benchmark regresses if its time exceeds threshold times the baseline
+    time (times below min_time seconds are not compared, they are too
+    noisy), if its memory growth exceeds mem_threshold times the baseline
+    (if given), or if it fails or times out where the baseline did not.
+    """
+
+    base = dict((result_key(r), r) for r in baseline)
+
+    regressions = []
+
+    for result in results:
+
+        key = result_key(result)
+
+        if key not in base or base[key]['status'] != 'ok':
+            continue
+
+        old = base[key]
+
+        if result['status'] != 'ok':
+            regressions.append((key, result['status']))
+            continue
+
+        if max(result['time'], old['time']) >= min_time and \
+           result['time'] > threshold*old['time']:
+            regressions.append((key, 'time %.4f s, baseline %.4f s (x%.2f)' %
+                                (result['time'], old['time'],
+                                 result['time']/max(old['time'], 1e-12))))
+
+        if mem_threshold is not None and result['mem_mb'] > 1.0 and \
+           result['mem_mb'] > mem_threshold*max(old['mem_mb'], 1.0):
+            regressions.append((key, 'memory %.1f MB, baseline %.1f MB' %
+                                (result['mem_mb'], old['mem_mb'])))
+
+    return regressions
+
+
+def main(argv=None, benchmarks=None):
+    """Command line interface of the benchmark suites, see module docstring."""
+
+    parser = argparse.ArgumentParser(description='Run benchmarks.')
+    parser.add_argument('--filter', default='*',
+                        help='glob pattern of the benchmark names to run')
+    parser.add_argument('--max-param', type=float, default=None,
+                        help='skip problem sizes larger than this')
+    parser.add_argument('--timeout', type=float, default=None,
+                        help='time limit per benchmark and problem size, in s')
+    parser.add_argument('--save', default=None,
+                        help='save the results to this JSON file')
+    parser.add_argument('--compare', default=None,
+                        help='compare against this JSON baseline')
+    parser.add_argument('--threshold', type=float, default=1.5,
+                        help='allowed slow down factor relative to the baseline')
+    parser.add_argument('--mem-threshold', type=float, default=None,
+                        help='allowed memory growth factor relative to the baseline')
+    parser.add_argument('--min-time', type=float, default=0.1,
+                        help='do not compare times below this, in s (too noisy)')
+    parser.add_argument('--verbose', action='store_true',
+                        help='show the output of the benchmarked code')
+
+    args = parser.parse_args(argv)
+
+    results = run(benchmarks, args.filter, args.max_param,
+                  not args.verbose, args.timeout)
+
+    for result in results:
+        if result['status'] == 'error':
+            sys.stderr.write('%s failed:\n%s\n' % (result_key(result),
+                                                   result['error']))
+
+    if args.save is not None:
+        save(results, args.save)
+
+    if args.compare is not None:
+
+        regressions = compare(results, load(args.compare), args.threshold,
+                              args.mem_threshold, args.min_time)
+
+        for key, message in regressions:
+            sys.stderr.write('REGRESSION %s: %s\n' % (key, message))
+
+        if regressions:
+            sys.exit(1)
+
+    return results
@@ -31,13 +31,137 @@ operation that can be avoided when only the Model output is needed.
 
 """
 
+from collections import OrderedDict
+
 import numpy as np
 import numpy.linalg.linalg as linalg
 # linalg is needed for norm and solve
 
+import bgntrace
+import ratelog
+
+
+log = ratelog.get_logger(__name__)
+
+
+
+class SBGNState(object):
+    """
+    Iteration state for sbgn_solver.
+    
+    Memoizes the model output g, Jacobian D, and the derived products
+    D^H D and D^H b (where b = Data - g) for the most recently visited 
+    parameter vectors x, so that expensive external models (e.g., ABAQUS
+    runs) are never evaluated twice at the same x. The number of actual
+    Model and Jacobian calls is tracked in model_cnt and jacobian_cnt.
+    
+    Only the last MAXCACHE parameter vectors are kept, because the line
+    search visits many trial points that are never needed again.
+    
+    The Model and Jacobian calls are timed as the 'model_eval' and 
+    'jacobian' phases of trace (see bgntrace).
+    """
+    
+    def entry(self, x):
+        """Return the (possibly new) cache entry for x."""
+        
+        key = (x.shape, x.tostring())
+        
+        if key in self.cache:
+            return self.cache[key]
+        
+        entry = {}
+        self.cache[key] = entry
+        
+        # drop the oldest entries
+        while len(self.cache) > self.MAXCACHE:
+            self.cache.popitem(last=False)
+        
+        return entry
+        
+        
+    def model(self, x):
+        """Return Model(x)."""
+        
+        entry = self.entry(x)
+        
+        if 'g' not in entry:
+            with self.trace.phase('model_eval'):
+                entry['g'] = self.Model(x)
+            self.model_cnt += 1
+        
+        return entry['g']
+        
+    
+    def set_model(self, x, g):
+        """Store a model output g = Model(x) evaluated elsewhere."""
+        
+        entry = self.entry(x)
+        
+        if 'g' not in entry:
+            entry['g'] = g
+            self.model_cnt += 1
+        
+        
+    def jacobian(self, x):
+        """Return Jacobian(x)."""
+        
+        entry = self.entry(x)
+        
+        if 'D' not in entry:
+            with self.trace.phase('jacobian'):
+                entry['D'] = self.Jacobian(x)
+            self.jacobian_cnt += 1
+        
+        return entry['D']
+        
+    
+    def DhD(self, x):
+        """Return real(D^H D) at x."""
+        
+        entry = self.entry(x)
+        
+        if 'DhD' not in entry:
+            D = self.jacobian(x)
+            entry['DhD'] = np.real(D.conj().transpose().dot(D))
+        
+        return entry['DhD']
+        
+        
+    def Dhb(self, x):
+        """Return D^H b at x, where b = Data - Model(x)."""
+        
+        entry = self.entry(x)
+        
+        if 'Dhb' not in entry:
+            D = self.jacobian(x)
+            entry['Dhb'] = D.conj().transpose().dot(self.Data - self.model(x))
+        
+        return entry['Dhb']
+        
+    
+    def __init__(self, Data, Model, Jacobian, MAXCACHE=3, 
+                 trace=bgntrace.NULL_TRACE):
+    
+        self.Data     = Data
+        self.Model    = Model
+        self.Jacobian = Jacobian
+        self.trace    = trace
+        
+        self.MAXCACHE = MAXCACHE
+        self.cache    = OrderedDict()
+        
+        # evaluation counters
+        self.model_cnt    = 0
+        self.jacobian_cnt = 0
+        
+        return
+
+
 
 def sbgn_solver(Data, Model, Jacobian, Prior, 
-                TOL=1.0e-6, MAXIT=10, ALPHA=0.2, BETA=0.5, QUIET=False):
+                TOL=1.0e-6, MAXIT=10, ALPHA=0.2, BETA=0.5, QUIET=False,
+                POOL=None, TRACE=False, CALLBACK=None):
     """ 
     sbgn_solver - Scalar Bayesian Gauss-Newton (sbgn) solver for a 
     parameter estimation problem to fit a possibly non-linear model to
@@ -114,6 +238,20 @@ def sbgn_solver(Data, Model, Jacobian, Prior,
         MAXIT: maximum number of iterations to run
        
         QUIET: if true, progress output text is suppressed.
+        
+        POOL: optional bgnpar.TrialPool created with the Model function.
+        When given, the line search evaluates a ladder of POOL.processes
+        step sizes (t, BETA*t, BETA^2*t, ...) concurrently, and accepts 
+        the largest one that satisfies the descent condition. The result
+        is the same as the sequential line search.
+        
+        TRACE: if true (or a bgntrace.Trace to add to), the wall and CPU
+        time of the solver phases, the Model and Jacobian counts, and one
+        record per iteration are returned in Est['trace'].
+        
+        CALLBACK: optional function callback(event, info), called with 
+        event 'iteration' and the record after every iteration, and with
+        'done' and Est['trace'] at the end. Implies TRACE.
        
     
     Outputs:
@@ -137,6 +275,16 @@ def sbgn_solver(Data, Model, Jacobian, Prior,
         fo: 1x1 scalar objective value at (x_est, s_est)
                
         status: boolean status indicating convergence
+        
+        model_eval_cnt: number of Model evaluations
+        
+        jacobian_eval_cnt: number of Jacobian evaluations
+        
+        trace: solver trace summary (see bgntrace.Trace.summary), or None
+        if TRACE and CALLBACK are not set
+    
+    Note: Model and Jacobian are never called twice for the same x (see
+    SBGNState), so the counts above reflect the actual cost of the solve.
     
     Note: iSigma_est, iSigma_xs_est, and lnZ are based on a local quadratic
     approximation of the objective function at the optimal solution and 
@@ -168,8 +316,14 @@ def sbgn_solver(Data, Model, Jacobian, Prior,
     iSigma_x = Prior['iSigma_x'];
     psig     = Prior['psig'];    
     
+    # solver trace (disabled by default)
+    trace    = bgntrace.make_trace(TRACE, CALLBACK);
+    
+    # memoized model and Jacobian evaluations
+    state    = SBGNState(Data, Model, Jacobian, trace=trace);
+    
     xo       = Prior['xo'].copy();
-    go       = Model(xo);
+    go       = state.model(xo);
 
     # Setup and run the Gauss-Newton solver
     
@@ -199,14 +353,14 @@ def sbgn_solver(Data, Model, Jacobian, Prior,
     # print progress output headers
     if not QUIET:
         hbar = '-'*70;
-        print '\nBayesian Gauss-Newton Solver 2.1'
-        print hbar;
-        print '   Solving a %i-dimensional problem.\n' % np.alen(x_mean);
+        log.info('\nBayesian Gauss-Newton Solver 2.1')
+        log.info(hbar);
+        log.info('   Solving a %i-dimensional problem.\n', np.alen(x_mean));
         
         # print algorithm progress feedback headers
         headers = ('Norm(dx)', 'Objective', 'Step Size', 'Norm(gradient)');
-        print '%11s%17s%14s%18s' % headers;
-        print hbar
+        log.info('%11s%17s%14s%18s', *headers);
+        log.info(hbar)
 
     # initialize the no improvement counter
     no_imp_cnt = 0;
@@ -217,73 +371,111 @@ def sbgn_solver(Data, Model, Jacobian, Prior,
         # On entry, xo and go are initialized above,
         # On repeat, xo and go are updated below.
         
-        # update the Jacobian matrix at the current xo
-        D  = Jacobian(xo);
-        b  = Data - go;
-        c  = x_mean - xo;
+        # update the Jacobian products at the current xo
+        with trace.phase('jacobian_products'):
+            DhD = state.DhD(xo);
+            Dhb = state.Dhb(xo);
+        c   = x_mean - xo;
         
         # compute the noise update first
         so = supdate(go);
         S  = (1/so)*iSigma_x;
         
         # compute the current value of the objective function
-        objfun_o = objfun(xo,go,so);
+        with trace.phase('objective'):
+            objfun_o = objfun(xo,go,so);
         
         # solve for the optimal update
-        dx = linalg.solve(np.real(sumsq(D)) + S, 
-                          np.real(D.conj().transpose().dot(b)) + S.dot(c));
+        with trace.phase('step'):
+            dx = linalg.solve(DhD + S, np.real(Dhb) + S.dot(c));
         
         # compute the objective function gradient
-        g = -2.0*so*np.real(D.conj().transpose().dot(b)) - 2.*iSigma_x.dot(c);
+        g = -2.0*so*np.real(Dhb) - 2.*iSigma_x.dot(c);
         # note the minus sign because of definition of b and c above
         
         # line-search guard to ensure descent
         t = 1.0;
-        while True:     
+        trials = 0;
+        line_search = trace.phase('line_search').start();
+        while POOL is None:     
             xt       = xo + t*dx;
-            gt       = Model(xt); #[0];
+            gt       = state.model(xt);
             objfun_t = objfun(xt,gt,so)
+            trials  += 1;
             
             if objfun_t > objfun_o + ALPHA*t*g.transpose().dot(dx): 
                 t = BETA*t;
             else:
                 break;
+        
+        # speculative version of the same line search
+        while POOL is not None:
+            steps   = [t*BETA**j for j in range(POOL.processes)];
+            points  = [xo + tj*dx for tj in steps];
+            results = POOL.submit(points);
+            
+            for t, xt in zip(steps, points):
+                gt = next(results);
+                state.set_model(xt, gt);
+                objfun_t = objfun(xt,gt,so)
+                trials  += 1;
+                
+                if not objfun_t > objfun_o + ALPHA*t*g.transpose().dot(dx):
+                    break;
+            else:
+                # no acceptable step in this ladder, try the next one
+                t = BETA*t;
+                continue;
+            
+            # skip the remaining (smaller) trial steps
+            POOL.cancel();
+            break;
+        
+        line_search.stop();
+        trace.count('line_search_trials', trials);
 
         
         # if the objective is not improved after 3 tries, exit
         if objfun_t >= objfun_o and t<1.0:
             no_imp_cnt += 1;
             if not QUIET:  
-                print 'No improvement made to objective. Strike {}.'.\
-                format(no_imp_cnt);
+                log.info('No improvement made to objective. Strike {}.'.\
+                format(no_imp_cnt));
             if no_imp_cnt == 3:
-                print 'No improvement made to objective. Exiting.'; 
+                log.warning('No improvement made to objective. Exiting.');
                 status = False;
+                fo = objfun_o;
                 break;
         else:
             # reset the counter
             no_imp_cnt = 0;
 
         
-        # update current guess and model output.
+        # update current guess, model output and objective.
         xo = xt;
         go = gt;
+        fo = objfun_t;
         
         
         # print progress info
         if not QUIET:
-            print '%11.3f%17.7f%14.2f%18.3f' % ( linalg.norm(dx), 
-                   objfun_t, t, linalg.norm(g) );
+            log.info('%11.3f%17.7f%14.2f%18.3f', linalg.norm(dx), 
+                     objfun_t, t, linalg.norm(g));
+        
+        if trace:
+            trace.iteration(iteration=k, objective=float(np.real(objfun_t)),
+                            step=t, trials=trials, norm_dx=linalg.norm(dx),
+                            norm_gradient=linalg.norm(g));
         
         # exit conditions
         if (linalg.norm(dx)<=TOL):
             if not QUIET:
-                print "\nNorm(dx) less than TOL. Done.";
+                log.info("\nNorm(dx) less than TOL. Done.");
             break;
         # check norm of gradient
         elif (linalg.norm(g)<=TOL):
             if not QUIET:
-                print "\nGradient less than TOL. Done.";
+                log.info("\nGradient less than TOL. Done.");
             break;
         # note: if the norm of the gradient is small, than the uncertainty
         # analysis computed below should be representative, and even though
@@ -292,29 +484,36 @@ def sbgn_solver(Data, Model, Jacobian, Prior,
             
     else:
         status = False; 
-        print '\nBayesian Gauss-Newton did NOT converge after max iterations.\n';
+        log.warning('\nBayesian Gauss-Newton did NOT converge after max iterations.\n');
 
     if not QUIET: 
-        print hbar;
+        log.info(hbar);
     
     
-    # get the objective function value on exit
-    fo = objfun(xo,go,so);
+    # note: the objective function value on exit (fo) was stored when xo
+    # was last updated, so it is not recomputed here.
     
     # diagnostics
     if not QUIET: 
-        print 'Objective on exit = %0.6f' % fo;
+        log.info('Objective on exit = %0.6f', fo);
+    
+    # get the final Jacobian products at xo (only evaluates the Jacobian 
+    # if it has not already been computed at xo)
+    with trace.phase('jacobian_products'):
+        DhD = state.DhD(xo);
+        Dhb = state.Dhb(xo);
     
-    # compute the final Jacobian at xo
-    D  = Jacobian(xo);
+    posterior = trace.phase('posterior').start();
     
     # diagnostics: compute the gradient at the solution
     b  = Data - go; 
     c  = x_mean - xo;
-    g = -2.0*so*np.real(D.conj().transpose().dot(b)) - 2.0*iSigma_x.dot(c);
+    g = -2.0*so*np.real(Dhb) - 2.0*iSigma_x.dot(c);
     
     if not QUIET: 
-        print 'Norm of gradient on exit = %f\n' % linalg.norm(g);
+        log.info('Norm of gradient on exit = %f', linalg.norm(g));
+        log.info('Model evaluations = %i, Jacobian evaluations = %i\n',
+                 state.model_cnt, state.jacobian_cnt);
     
     
     #
@@ -322,13 +521,14 @@ def sbgn_solver(Data, Model, Jacobian, Prior,
     #
     
     # compute the parameter estimation error
-    iSigma_est = so*np.real(sumsq(D)) + iSigma_x - \
-                 (2.0*so**2/n)*np.real( sumsq(b.conj().transpose().dot(D)) );
+    # note: sumsq(b'*D) = (D'*b)*(D'*b)'
+    iSigma_est = so*DhD + iSigma_x - \
+                 (2.0*so**2/n)*np.real( Dhb.dot(Dhb.conj().transpose()) );
     
     
-    Dtb = np.real(D.conj().transpose().dot(b));
+    Dtb = np.real(Dhb);
     iSigma_xs_est  = np.vstack(
-                         (np.hstack((so*np.real(sumsq(D)) + iSigma_x, -Dtb)),
+                         (np.hstack((so*DhD + iSigma_x, -Dtb)),
                           np.hstack((-Dtb.transpose(), n/(2*so**2)))));
                                    
     #iSigma_est = so*real(D'*D) + iSigma_x - (2*so^2/n)*real( (D'*b)*(b'*D) );
@@ -349,6 +549,8 @@ def sbgn_solver(Data, Model, Jacobian, Prior,
     lnZ = lnK + ((d+1.)/2.)*np.log(2.*np.pi) \
                - (1./2.)*np.log(linalg.det(iSigma_xs_est));
     
+    posterior.stop();
+    
     #
     # Define outputs
     #
@@ -362,6 +564,13 @@ def sbgn_solver(Data, Model, Jacobian, Prior,
     Est['fo']             = fo[0,0];
     Est['status']         = status;
     
+    Est['model_eval_cnt']    = state.model_cnt;
+    Est['jacobian_eval_cnt'] = state.jacobian_cnt;
+    
+    trace.count('model_evaluations', state.model_cnt);
+    trace.count('jacobian_evaluations', state.jacobian_cnt);
+    Est['trace'] = trace.finish();
+    
     # note: so, lnZ, and fo by themselves 1x1 numpy arrays, which are converted
     # to scalars simply by accessing their first (and only) element.
     
@@ -371,7 +580,8 @@ def sbgn_solver(Data, Model, Jacobian, Prior,
 
 
 def lsbgn_solver(Data, D, Prior, pEst=None,
-                 TOL=1.0e-6, MAXIT=300, MAXM=None, QUIET=False):
+                 TOL=1.0e-6, MAXIT=300, MAXM=None, QUIET=False,
+                 STREAM=False, FORGET=1.0):
     """ 
     lsbgn_solver - linear scalar Bayesian Gauss-Newton (lsbgn) solver for a 
     parameter estimation problem to fit a LINEAR model to a series of scalar 
@@ -418,8 +628,18 @@ def lsbgn_solver(Data, D, Prior, pEst=None,
         TOL: exit tolerance
         
         MAXIT: maximum number of iterations to run
+        
+        MAXM: maximum number of (most recent) observations to keep when
+        accumulating data through pEst.
        
         QUIET: if true, progress output text is suppressed.
+        
+        STREAM: if true, only the sufficient statistics of the data are
+        accumulated through pEst, instead of the data itself. See 
+        rlsbgn_solver, which is called in this case.
+        
+        FORGET: exponential forgetting factor in (0,1] applied to the
+        accumulated statistics when STREAM is true (1.0 = no forgetting).
        
     
     Outputs:
@@ -453,6 +673,11 @@ def lsbgn_solver(Data, D, Prior, pEst=None,
     
        
     """
+    
+    # the streaming version keeps sufficient statistics instead of the data
+    if STREAM:
+        return rlsbgn_solver(Data, D, Prior, pEst=pEst, FORGET=FORGET,
+                             TOL=TOL, MAXIT=MAXIT, QUIET=QUIET)
 
     # convert input Data vector to a numpy array (in case it is not already)
     Data = np.array(Data);
@@ -522,14 +747,14 @@ def lsbgn_solver(Data, D, Prior, pEst=None,
     # print progress output headers
     if not QUIET:
         hbar = '-'*70;
-        print '\nLinear Bayesian Gauss-Newton Solver 2.0'
-        print hbar;
-        print '   Solving a %i-dimensional problem.\n' % np.alen(x_mean);
+        log.info('\nLinear Bayesian Gauss-Newton Solver 2.0')
+        log.info(hbar);
+        log.info('   Solving a %i-dimensional problem.\n', np.alen(x_mean));
         
         # print algorithm progress feedback headers
         headers = ('Norm(dx)', 'Objective', 'Step Size', 'Norm(gradient)');
-        print '%11s%17s%14s%18s' % headers;
-        print hbar
+        log.info('%11s%17s%14s%18s', *headers);
+        log.info(hbar)
 
 
     
@@ -584,8 +809,8 @@ def lsbgn_solver(Data, D, Prior, pEst=None,
         
         # print progress info
         if not QUIET:
-            print '%11.3f%17.7f%14.2f%18.3f' % ( linalg.norm(dx), 
-                   objfun_t, t, linalg.norm(g) );
+            log.info('%11.3f%17.7f%14.2f%18.3f', linalg.norm(dx), 
+                     objfun_t, t, linalg.norm(g));
         
         
         if linalg.norm(dx)<=TOL: 
@@ -593,10 +818,10 @@ def lsbgn_solver(Data, D, Prior, pEst=None,
             
     else:
         status = False; 
-        print '\nBayesian Gauss-Newton did NOT converge after max iterations.\n';
+        log.warning('\nBayesian Gauss-Newton did NOT converge after max iterations.\n');
 
     if not QUIET: 
-        print hbar;
+        log.info(hbar);
     
     
     # get the objective function value on exit
@@ -604,7 +829,7 @@ def lsbgn_solver(Data, D, Prior, pEst=None,
     
     # diagnostics
     if not QUIET: 
-        print 'Objective on exit = %0.6f' % fo;
+        log.info('Objective on exit = %0.6f', fo);
     
     
     # diagnostics: compute the gradient at the solution
@@ -613,7 +838,7 @@ def lsbgn_solver(Data, D, Prior, pEst=None,
     g = -2.0*so*np.real(D.conj().transpose().dot(b)) - 2.0*iSigma_x.dot(c);
     
     if not QUIET: 
-        print 'Norm of gradient on exit = %f\n' % linalg.norm(g);
+        log.info('Norm of gradient on exit = %f\n', linalg.norm(g));
     
     
     #
@@ -666,6 +891,259 @@ def lsbgn_solver(Data, D, Prior, pEst=None,
 
 
 
+def lsbgn_stats(Data, D, pStats=None, FORGET=1.0):
+    """
+    Stats = lsbgn_stats(Data, D, pStats=None, FORGET=1.0)
+    
+    Accumulate the sufficient statistics of the linear measurement model
+    
+    Data ~ D*x,
+    
+    which are all that is needed by the linear BGN update. The returned
+    dictionary has the fields
+    
+        DtD: dxd matrix D^H D
+        
+        Dty: dx1 vector D^H Data
+        
+        yty: scalar Data^H Data
+        
+        n: number of observations (real and imaginary parts counted 
+        seperately, as in lsbgn_solver)
+    
+    If pStats (the statistics from previous batches) is given, the new 
+    batch is added to it after scaling pStats by the forgetting factor 
+    FORGET, so the cost of an update is independent of the history length.
+    """
+    
+    # convert input Data vector to a numpy column vector
+    Data = np.array(Data);
+    Data.resize((np.alen(Data),1))
+    
+    # count observations the same way as lsbgn_solver
+    if np.all(np.isreal(Data)):
+        n = np.alen(Data); 
+    else:
+        n = 2.*np.alen(Data);
+    
+    Dh = D.conj().transpose();
+    
+    Stats = {'DtD': Dh.dot(D),
+             'Dty': Dh.dot(Data),
+             'yty': np.real(Data.conj().transpose().dot(Data))[0,0],
+             'n':   n}
+    
+    # add the (discounted) statistics from the previous batches
+    if pStats:
+        for key in Stats:
+            Stats[key] = FORGET*pStats[key] + Stats[key];
+    
+    return Stats;
+
+
+
+def rlsbgn_solver(Data, D, Prior, pEst=None, FORGET=1.0,
+                  TOL=1.0e-6, MAXIT=300, QUIET=False):
+    """ 
+    rlsbgn_solver - recursive (streaming) version of lsbgn_solver.
+    
+    Solves the same LINEAR estimation problem as lsbgn_solver, except that
+    data from previous calls is accumulated through the sufficient
+    statistics D^H D, D^H Data, Data^H Data, and n (see lsbgn_stats), 
+    rather than by stacking all previous Data and D rows. This makes the
+    cost of each update O(d^2) in memory and time (plus one dxd solve per
+    iteration), regardless of how many observations have been ingested, 
+    so it can be used to process a stream of sensor data in real time.
+    
+    
+    Inputs:
+    -------
+    
+    Data, D, Prior: Same as lsbgn_solver, but Data and D only need to 
+    contain the new batch of observations.
+    
+    Optional named parameters for algorithm options:
+    
+        pEst: estimation structure returned by the previous call, used to
+        accumulate the data statistics.
+        
+        FORGET: exponential forgetting factor in (0,1]. The statistics
+        from previous batches are scaled by FORGET before the new batch
+        is added, so older data is gradually discounted. The default 1.0
+        weights all data equally, and gives the same answer as 
+        lsbgn_solver with all the data stacked.
+    
+        TOL, MAXIT, QUIET: Same as lsbgn_solver.
+    
+    
+    Outputs:
+    --------
+    
+    Est: Dictionary with the same fields as returned by lsbgn_solver, 
+    except the field Data is replaced by
+    
+        Stats: accumulated sufficient statistics (see lsbgn_stats).
+        
+    Note, Est['model'] is the model output for the latest batch only.
+    
+    """
+    
+    # accumulate the sufficient statistics of the data
+    if pEst:
+        Stats = lsbgn_stats(Data, D, pEst['Stats'], FORGET);
+    else:
+        Stats = lsbgn_stats(Data, D);
+    
+    DtD = Stats['DtD'];
+    Dty = Stats['Dty'];
+    yty = Stats['yty'];
+    n   = Stats['n'];
+    
+    x_mean   = Prior['x_mean'];
+    iSigma_x = Prior['iSigma_x'];
+    psig     = Prior['psig'];    
+    
+    # set initial parameter estimate if a previous estimate is available
+    if pEst:
+        xo = pEst['x_est'];
+    elif 'xo' in Prior.keys():
+        xo = Prior['xo']; 
+    else:
+        xo = x_mean;
+    
+    
+    #
+    # Setup and run the Gauss-Newton solver
+    #
+    
+    # quadratic sum with symmetric matrix Q (for real x only)    
+    qsumsq  = lambda x, Q: x.transpose().dot(Q.dot(x));
+    
+    # sum of squared residuals ||Data - D*x||^2 from the statistics
+    rsumsq  = lambda x: np.real( yty - 2.*x.transpose().dot(Dty) \
+                                 + qsumsq(x, DtD) );
+    
+    objfun  = lambda x,s: np.real( s*rsumsq(x) - n*np.log(s) + 2.*psig*s \
+                                   + qsumsq(x-x_mean, iSigma_x) );
+                     
+    supdate = lambda x: n/(rsumsq(x) + 2.0*psig);
+    
+    # note: none of the above depend on the number of observations.
+    
+    # initialize convergence status
+    status = True;
+    
+    # print progress output headers
+    if not QUIET:
+        hbar = '-'*70;
+        log.info('\nRecursive Linear Bayesian Gauss-Newton Solver 1.0')
+        log.info(hbar);
+        log.info('   Solving a %i-dimensional problem.\n', np.alen(x_mean));
+        
+        # print algorithm progress feedback headers
+        headers = ('Norm(dx)', 'Objective', 'Step Size', 'Norm(gradient)');
+        log.info('%11s%17s%14s%18s', *headers);
+        log.info(hbar)
+    
+    
+    # solve for an optimal change in x
+    for k in range(MAXIT):
+        
+        # D^H b, where b = Data - D*xo
+        Dtb = Dty - DtD.dot(xo);
+        c   = x_mean - xo;
+        
+        # compute the noise update first
+        so = supdate(xo);
+        S  = (1/so)*iSigma_x;
+        
+        # solve for the optimal update
+        dx = linalg.solve(np.real(DtD) + S, np.real(Dtb) + S.dot(c));
+        
+        # compute the objective function gradient
+        g = -2.0*so*np.real(Dtb) - 2.*iSigma_x.dot(c);
+        
+        # full step (the model is linear)
+        t        = 1.0;
+        xo       = xo + t*dx;
+        objfun_t = objfun(xo,so);
+        
+        # print progress info
+        if not QUIET:
+            log.info('%11.3f%17.7f%14.2f%18.3f', linalg.norm(dx), 
+                     objfun_t, t, linalg.norm(g));
+        
+        if linalg.norm(dx)<=TOL: 
+            break;
+            
+    else:
+        status = False; 
+        log.warning('\nBayesian Gauss-Newton did NOT converge after max iterations.\n');
+
+    if not QUIET: 
+        log.info(hbar);
+    
+    
+    # get the objective function value on exit
+    fo = objfun(xo,so);
+    
+    # diagnostics
+    if not QUIET: 
+        log.info('Objective on exit = %0.6f', fo);
+    
+    # diagnostics: compute the gradient at the solution
+    Dtb = Dty - DtD.dot(xo);
+    c   = x_mean - xo;
+    g   = -2.0*so*np.real(Dtb) - 2.0*iSigma_x.dot(c);
+    
+    if not QUIET: 
+        log.info('Norm of gradient on exit = %f\n', linalg.norm(g));
+    
+    
+    #
+    # Compute the estimation accuarcy (covariance)
+    #
+    
+    # note: (b'*D)'*(b'*D) = (D'*b)*(D'*b)'
+    iSigma_est = so*np.real(DtD) + iSigma_x - \
+                 (2.0*so**2/n)*np.real( Dtb.dot(Dtb.conj().transpose()) );
+    
+    iSigma_xs_est  = np.vstack(
+                         (np.hstack((so*np.real(DtD) + iSigma_x, -np.real(Dtb))),
+                          np.hstack((-np.real(Dtb).transpose(), n/(2*so**2)))));
+    
+    
+    #
+    # Compute the evidence of the observed data under the BGN Model
+    #
+    
+    d   = xo.shape[0];
+    lnK = (n/2.)*np.log(so/(2.*np.pi)) - (so/2.)*rsumsq(xo) \
+          - (d/2.)*np.log(2.*np.pi) \
+          + (1./2.)*np.log(linalg.det(iSigma_x)) - (1./2.)*qsumsq(c,iSigma_x) \
+          + np.log(psig) - psig*so;
+    
+    lnZ = lnK + ((d+1.)/2.)*np.log(2.*np.pi) \
+               - (1./2.)*np.log(linalg.det(iSigma_xs_est));
+    
+    #
+    # Define outputs
+    #
+    Est={};
+    Est['x_est']          = xo;
+    Est['s_est']          = so[0,0];
+    Est['iSigma_est']     = iSigma_est;
+    Est['iSigma_xs_est']  = iSigma_xs_est;
+    Est['lnZ']            = lnZ[0,0]; 
+    Est['model']          = D.dot(xo);
+    Est['fo']             = fo[0,0];
+    Est['status']         = status;
+    Est['Stats']          = Stats;
+    
+    return Est;
+
+
+
 
 
 # Execute test code
@@ -788,4 +1266,22 @@ if __name__ == "__main__":
         print "have changed relative to the other. Note, however, there is"
         print "noise in the calculation, so try again before debugging.\n"
         
+        
+    #
+    # solve the same linear problem by streaming the data in batches
+    #
+    
+    rEst = None;
+    for inds in np.array_split(np.arange(N), 5):
+        rEst = lsbgn_solver(y[inds], D[inds], Prior, pEst=rEst, 
+                            QUIET=True, STREAM=True);
+    
+    if np.abs(lsEst['lnZ'] - rEst['lnZ'])<1e-6*np.abs(lsEst['lnZ']):
+        print '\nThe streaming solver evidence (Est[\'lnZ\']) matches the'
+        print 'batch linear solver.\n'
+    else:
+        print "************************************************************"
+        print "The streaming (STREAM=True) lsbgn_solver returned an evidence"
+        print "value different from the batch lsbgn_solver.\n"
+        
     
\ No newline at end of file
@@ -7,65 +7,411 @@ import shutil
 import os
 import errno
 import math
+import hashlib
+import json
+import multiprocessing
+import re
+import subprocess
+import threading
 
 import numpy
 import scipy.linalg as spla
 
-# matplotlib modules
-#import matplotlib
-#matplotlib.use('TkAgg');
-from mpl_toolkits.mplot3d import Axes3D
-from matplotlib import cm
-import matplotlib.pyplot as plt
-import matplotlib.tri as tri
+import lazyimport
 
 
-# Setup matplotlib to use latex
-import matplotlib
-from matplotlib import rc
-rc('font',**{'family':'sans-serif','sans-serif':['Helvetica']})
-## for Palatino and other serif fonts use:
-#rc('font',**{'family':'serif','serif':['Palatino']})
-rc('text', usetex=True);
+# matplotlib modules, imported on first use (see setup_matplotlib)
+matplotlib = lazyimport.lazy_import('matplotlib')
+plt        = lazyimport.lazy_import('matplotlib.pyplot',
+                                    setup=lambda module: setup_matplotlib())
 
-# Enable use of si parameters package in matplotlib
-matplotlib.rcParams['text.latex.preamble'] = '\usepackage{siunitx}'
+MATPLOTLIB_SETUP = False
+
+
+def setup_matplotlib():
+    """
+    Setup matplotlib to use latex. This is done once, by the first 
+    Presentation or figure, instead of on import, so that processes that
+    do not plot do not import matplotlib.
+    """
+    
+    global MATPLOTLIB_SETUP
+    
+    if MATPLOTLIB_SETUP:
+        return
+    MATPLOTLIB_SETUP = True
+    
+    rc = matplotlib.rc
+    rc('font',**{'family':'sans-serif','sans-serif':['Helvetica']})
+    ## for Palatino and other serif fonts use:
+    #rc('font',**{'family':'serif','serif':['Palatino']})
+    rc('text', usetex=True);
+    
+    # Enable use of si parameters package in matplotlib
+    matplotlib.rcParams['text.latex.preamble'] = '\usepackage{siunitx}'
 
 
 # Local imports
 import bgnlcs
 import bgninfo
 import bgnlatex
+import ratelog
+
+
+log = ratelog.get_logger(__name__)
+
+
+# pdflatex log messages that call for another pass
+RERUN_PATTERN = (r'Rerun to get|Label\(s\) may have changed|'
+                 r'No file .*\.(toc|nav|aux)')
+
+
+def run_command(cmd, cwd, build_log, timeout):
+    """
+    Run cmd in directory cwd, with the output written to the open file
+    build_log. The process is killed after timeout seconds. Returns the
+    exit code, or None if the command could not be started.
+    """
+    
+    try:
+        proc = subprocess.Popen(cmd, cwd=cwd, stdout=build_log, 
+                                stderr=subprocess.STDOUT)
+    except OSError as exception:
+        log.error("Could not run %s: %s", cmd[0], exception)
+        return None
+    
+    timer = threading.Timer(timeout, proc.kill)
+    timer.start()
+    try:
+        returncode = proc.wait()
+    finally:
+        timer.cancel()
+    
+    return returncode
+
+
+#
+# Figure rendering
+#
+# The slide methods of Presentation record a figure spec (the figure kind
+# and the few arrays needed to draw it) instead of drawing right away. The
+# specs are rendered by the module level functions below, which can run
+# in worker processes, and the output files are skipped on a rebuild when
+# the hash of their spec has not changed.
+#
+
+def render_confelp_figure(spec):
+    """Combo plot of the prior and posterior confidence ellipses."""
+    
+    inds = spec['inds']
+    
+    fig, axCnfElp, axMSPdfx, axMSPdfy = \
+    bgninfo.plot_combo(spec['PriorEst'], inds, 0.95,
+                       color='gray',
+                       linestyle='--',
+                       labelprefix='prior');
+                    
+    bgninfo.plot_combo(spec['Est'], inds, 0.95,
+                    addto=(fig, axCnfElp, axMSPdfx, axMSPdfy),
+                    color='blue',
+                    linestyle='-',
+                    labelprefix='posterior'); 
+    
+    axCnfElp.set_xlabel(spec['xlabel'], labelpad=12, fontsize=20)
+    axCnfElp.set_ylabel(spec['ylabel'], labelpad=12, fontsize=20)
+    
+    theta_actual = spec['theta_actual']
+    if theta_actual is not None:
+        axCnfElp.plot(theta_actual[0], theta_actual[1], color='red', alpha=1.0,
+                      marker='*', markersize=8, linestyle='', label='actual');
+    
+    axCnfElp.legend(loc='lower right', numpoints=1, prop={'size':10})
+    
+    return fig
+
+
+def render_confelp_matrix_figure(spec):
+    """Matrix of the prior and posterior confidence ellipses."""
+    
+    inds = spec['inds']
+    
+    fig, axes = bgninfo.plot_confellipse_matrix(spec['PriorEst'], 0.95, inds,
+                                                color='gray',
+                                                linestyle='--')
+    
+    bgninfo.plot_confellipse_matrix(spec['Est'], 0.95, inds,
+                                    addto=(fig, axes),
+                                    color='blue',
+                                    linestyle='-',
+                                    labels=spec['labels'])
+    
+    theta_actual = spec['theta_actual']
+    if theta_actual is not None:
+        for r in range(1, len(inds)):
+            for c in range(r):
+                axes[r-1,c].plot(theta_actual[c], theta_actual[r],
+                                 color='red', alpha=1.0, marker='*',
+                                 markersize=6, linestyle='')
+    
+    return fig
+
+
+def render_marginal_pdf_figure(spec):
+    """Prior and posterior marginal pdfs of one parameter."""
+    
+    fig, axpdf = \
+    bgninfo.plot_marginal_scalar_pdf(spec['PriorEst'], 0,
+                                     color='gray',
+                                     linestyle='--',
+                                     labelprefix='prior ');
+                    
+    bgninfo.plot_marginal_scalar_pdf(spec['Est'], 0,
+                                     addto=(fig, axpdf),
+                                     color='blue',
+                                     linestyle='-',
+                                     labelprefix='posterior '); 
+    
+    axpdf.set_xlabel(spec['xlabel'], labelpad=12, fontsize=20)
+    
+    theta_actual = spec['theta_actual']
+    if theta_actual is not None:
+        axpdf.plot((theta_actual,theta_actual), (0,1), color='red', alpha=0.75,
+                      marker=None, linestyle='-', linewidth=3, label='actual');
+    
+    axpdf.legend(loc='upper right', numpoints=1, prop={'size':10})
+    
+    return fig
+
+
+def render_model_est_figure(spec):
+    """Model output estimate, with the measured (and actual) data."""
+    
+    fig, ax = bgninfo.plot_model_est(spec['Est'], spec['meas_data'], 
+                                     inds=spec['inds'],
+                                     actual_data=spec['actual_data'],
+                                     model_stds=spec['model_stds'],
+                                     addto=None,
+                                     color='blue',
+                                     alpha=0.6,
+                                     linestyle='',
+                                     linewidth=2,
+                                     marker='.')
+    
+    # Set axis labels
+    ax.set_xlabel('measurement index')
+    ax.set_ylabel(spec['ylabel'])
+    
+    return fig
+
+
+def render_verification_err_figure(spec):
+    """Error between the model estimate and the truth data."""
+    
+    fig, ax = bgninfo.plot_actual_estimation_err(spec['Est'], 
+                                                 spec['actual_data'], 
+                                                 inds=spec['inds'],
+                                                 meas_data=None,
+                                                 model_stds=spec['model_stds'],
+                                                 addto=None,
+                                                 color='blue',
+                                                 alpha=0.6,
+                                                 linestyle='',
+                                                 linewidth=2,
+                                                 marker='.')
+    
+    # Set axis labels
+    ax.set_xlabel('index')
+    ax.set_ylabel(spec['ylabel'])
+    
+    return fig
+
+
+# Figure kinds handled by render_figure
+FIGURE_RENDERERS = {'confelp': render_confelp_figure,
+                    'confelp_matrix': render_confelp_matrix_figure,
+                    'marginal_pdf': render_marginal_pdf_figure,
+                    'model_est': render_model_est_figure,
+                    'verification_err': render_verification_err_figure}
+
+
+def render_figure(job):
+    """Render the figure spec of a (kind, spec, path) job to path."""
+    
+    kind, spec, path = job
+    
+    setup_matplotlib()
+    fig = FIGURE_RENDERERS[kind](spec)
+    
+    log.debug("Saving the figure as %s", path)
+    fig.savefig(path, bbox_inches='tight')
+    plt.close(fig)
+    
+    return path
+
+
+def init_render_worker():
+    """Pool initializer: use the non-interactive Agg backend."""
+    
+    plt.switch_backend('Agg')
+
+
+def spec_hash(kind, spec):
+    """Return a hex digest of the figure kind and its spec."""
+    
+    h = hashlib.sha1(kind)
+    
+    def update(v):
+        if isinstance(v, dict):
+            for name in sorted(v):
+                h.update(repr(name))
+                update(v[name])
+        elif isinstance(v, (list, tuple)):
+            h.update('[%d' % len(v))
+            for item in v:
+                update(item)
+        elif isinstance(v, numpy.ndarray):
+            h.update(str(v.dtype) + str(v.shape))
+            h.update(numpy.ascontiguousarray(v).tostring())
+        else:
+            h.update(repr(v))
+    
+    update(spec)
+    
+    return h.hexdigest()
+
+
+def minimal_est(Est):
+    """Return just the estimate and inverse covariance of Est."""
+    
+    if 'x_est' in Est:
+        return {'x_est': numpy.asarray(Est['x_est']), 
+                'iSigma_est': numpy.asarray(Est['iSigma_est'])}
+    
+    return {'theta_est': numpy.asarray(Est['theta_est']).ravel(),
+            'iSigma_theta': numpy.asarray(Est['iSigma_theta'])}
+
+
+def sub_est(Est, inds):
+    """Return the marginal estimate of the parameters in inds."""
+    
+    x_est, Sigma = bgninfo.estimate_covariance(Est)
+    inds         = list(inds)
+    
+    return {'theta_est': x_est[inds],
+            'iSigma_theta': spla.inv(Sigma[numpy.ix_(inds, inds)])}
 
     
+
 class Presentation(object):
     
-    def build(self):
+    def build(self, force=False, max_passes=3, timeout=600):
         """
         Run pdflatex on the beamer tex document.
+        
+        The run is skipped when the pdf exists and neither the .tex file 
+        nor the files it inputs or includes (tables, figures) have changed
+        since the last successful build (unless force is True). Otherwise,
+        pdflatex is run in the presentation directory, and rerun (up to 
+        max_passes times) while its log asks for it, e.g., to resolve 
+        cross-references and the table of contents. The output of all 
+        passes is captured in build.log, and a pass is stopped after 
+        timeout seconds.
+        
+        Returns True if the pdf is up to date, and False if pdflatex 
+        failed or still asks for a rerun after max_passes passes.
         """
         
-        #build_cmd = "pdflatex " + "-output-directory " + self.short_name + " " \
-        #             + self.short_name + '/' + self.short_name + '.tex'
+        key = self.build_inputs_hash()
+        pdf = self.rootdir + self.short_name + '.pdf'
+        
+        if not force and os.path.exists(pdf) and \
+           self.read_build_file(self.build_hash_name) == key:
+            log.info("%s is up to date.", pdf)
+            return True
+        
+        build_cmd = ["pdflatex", "-interaction=nonstopmode", 
+                     self.short_name + '.tex']
+        
+        with open(self.rootdir + 'build.log', 'w') as build_log:
+            for k in range(max_passes):
+                log.info("Running: %s (pass %d) in %s", " ".join(build_cmd), 
+                         k+1, self.rootdir)
+                
+                build_log.write("*** pass {}\n".format(k+1))
+                build_log.flush()
+                
+                returncode = run_command(build_cmd, self.short_name, build_log,
+                                         timeout)
+                
+                if returncode != 0:
+                    log.error("pdflatex failed (code %s), see %sbuild.log",
+                              returncode, self.rootdir)
+                    return False
+                
+                # Rerun only if latex asks for it
+                texlog = self.read_build_file(self.short_name + '.log')
+                if not re.search(RERUN_PATTERN, texlog or ''):
+                    break
+            else:
+                # Do not record the hash, so the next build reruns pdflatex
+                log.warning("pdflatex still asks for a rerun after %d passes, "
+                            "see %sbuild.log", max_passes, self.rootdir)
+                return False
+        
+        with open(self.rootdir + self.build_hash_name, 'w') as f:
+            f.write(key)
+        
+        log.info("Done.")
+        
+        return True
         
-        build_cmd = "pdflatex " + self.short_name + '.tex'
-        #build_cmd += " 1> pdflatex_out.log"
+    
+    def read_build_file(self, name):
+        """Return the contents of a file in the build directory, or None."""
         
+        try:
+            with open(self.rootdir + name, 'rb') as f:
+                return f.read()
+        except IOError:
+            return None
+    
+    
+    def build_inputs_hash(self):
+        """
+        Return a hex digest of the .tex file and the files it pulls in: the
+        \\input{} and \\include{} files (e.g., the tables written by 
+        bgnlatex), recursively, and the included figures.
+        """
         
-        os.chdir("%s" % self.short_name)
-        print "Working from directory: ", os.getcwd()
+        h = hashlib.sha1()
+        self.hash_tex_file(h, self.short_name + '.tex', set())
         
-        print "Running: {}".format(build_cmd)
-        os.system(build_cmd)
+        return h.hexdigest()
+    
+    
+    def hash_tex_file(self, h, name, seen):
+        """Add the tex file name, and the files it pulls in, to the hash h."""
         
-        print "Directory is back to:"
-        os.chdir("..")
-        print os.getcwd()
+        if name in seen:
+            return
+        seen.add(name)
         
-        print "Done."
+        tex = self.read_build_file(name) or ''
         
-        return
+        h.update(name)
+        h.update(tex)
         
+        for fname in re.findall(r'\\(?:input|include)\{([^}]*)\}', tex):
+            # as TeX: name.tex if it exists, otherwise name
+            if not os.path.splitext(fname)[1] and \
+               os.path.exists(self.rootdir + fname + '.tex'):
+                fname += '.tex'
+            self.hash_tex_file(h, fname, seen)
+        
+        graphics = r'\\includegraphics(?:\[[^\]]*\])?\{([^}]*)\}'
+        for fname in re.findall(graphics, tex):
+            h.update(fname)
+            h.update(self.read_build_file(fname) or '')
     
     
     #
@@ -145,10 +491,11 @@ class Presentation(object):
         
     def close_tex(self):
         """
-        Close the tex document.
+        Close the tex document, and render the queued figures.
         """
         self.end_document()
         self.texfile.close()
+        self.render_figures()
         return
         
     
@@ -381,39 +728,64 @@ class Presentation(object):
         PriorEst['theta_est']    = Prior['theta_mean'];
         PriorEst['iSigma_theta'] = Prior['iSigma_theta'];
         
-        # Create the figure.
-        fig, axCnfElp, axMSPdfx, axMSPdfy = \
-        bgninfo.plot_combo(PriorEst, inds, 0.95,
-                           color='gray',
-                           linestyle='--',
-                           labelprefix='prior');
-                        
-        bgninfo.plot_combo(Est, inds, 0.95,
-                        addto=(fig, axCnfElp, axMSPdfx, axMSPdfy),
-                        color='blue',
-                        linestyle='-',
-                        labelprefix='posterior'); 
-        
         # Convert parameter names to latex before assigning
         latex_names = [pn.replace("\\\\", "\\") for pn in self.parameter_names]
         latex_units = self.parameter_units
         xlab = latex_names[inds[0]] + ' [' + latex_units[inds[0]] + ']'
         ylab = latex_names[inds[1]] + ' [' + latex_units[inds[1]] + ']'
-        axCnfElp.set_xlabel(xlab, labelpad=12, fontsize=20)
-        axCnfElp.set_ylabel(ylab, labelpad=12, fontsize=20)
         
         if theta_actual is not None:
-            axCnfElp.plot(theta_actual[inds[0]], theta_actual[inds[1]], color='red', alpha=1.0,
-                          marker='*', markersize=8, linestyle='', label='actual');
+            theta_actual = [theta_actual[inds[0]], theta_actual[inds[1]]]
+        
+        # Record the figure, with the marginal 2-d estimates only
+        spec = {'Est': sub_est(Est, inds),
+                'PriorEst': sub_est(PriorEst, inds),
+                'inds': (0, 1),
+                'xlabel': xlab,
+                'ylabel': ylab,
+                'theta_actual': theta_actual}
+        
+        self.queue_figure('confelp', spec,
+                          title=title,
+                          caption=caption,
+                          fname=fname)
+        
+        return
         
-        axCnfElp.legend(loc='lower right', numpoints=1, prop={'size':10})
         
+    def make_confelp_matrix_slide(self, Est, Prior, inds=None,
+                                  theta_actual=None,
+                                  title="Confidence Ellipses",
+                                  caption=("ShortCap","Caption Text"),
+                                  fname="fig_confellipse_matrix"):
         
-        # Create the image slide
-        self.make_image_slide(fig,
-                              title=title,
-                              caption=caption,
-                              fname=fname)
+        # Create Prior Estimate dictionary from prior
+        PriorEst = {};
+        PriorEst['theta_est']    = Prior['theta_mean'];
+        PriorEst['iSigma_theta'] = Prior['iSigma_theta'];
+        
+        if inds is None:
+            inds = range(len(Prior['theta_mean']))
+        
+        # Convert parameter names to latex before assigning
+        latex_names = [pn.replace("\\\\", "\\") for pn in self.parameter_names]
+        labels = [latex_names[i] for i in inds]
+        
+        if theta_actual is not None:
+            theta_actual = [theta_actual[i] for i in inds]
+        
+        # Record the figure, all pairs are drawn at once.
+        spec = {'Est': sub_est(Est, inds),
+                'PriorEst': sub_est(PriorEst, inds),
+                'inds': range(len(inds)),
+                'labels': labels,
+                'theta_actual': theta_actual}
+        
+        self.queue_figure('confelp_matrix', spec,
+                          title=title,
+                          caption=caption,
+                          scale=0.8,
+                          fname=fname)
         
         return
         
@@ -430,38 +802,24 @@ class Presentation(object):
         PriorEst['theta_est']    = Prior['theta_mean'];
         PriorEst['iSigma_theta'] = Prior['iSigma_theta'];
         
-        # Create the figure.
-        fig, axpdf = \
-        bgninfo.plot_marginal_scalar_pdf(PriorEst, ind,
-                                         color='gray',
-                                         linestyle='--',
-                                         labelprefix='prior ');
-                        
-        bgninfo.plot_marginal_scalar_pdf(Est, ind,
-                                         addto=(fig, axpdf),
-                                         color='blue',
-                                         linestyle='-',
-                                         labelprefix='posterior '); 
-        
         # Convert parameter names to latex before assigning
         latex_names = [pn.replace("\\\\", "\\") for pn in self.parameter_names]
         latex_units = self.parameter_units
         xlab = latex_names[ind] + ' [' + latex_units[ind] + ']'
-        axpdf.set_xlabel(xlab, labelpad=12, fontsize=20)
-        
         
         if theta_actual is not None:
-            axpdf.plot((theta_actual[ind],theta_actual[ind]), (0,1), color='red', alpha=0.75,
-                          marker=None, linestyle='-', linewidth=3, label='actual');
-        
-        axpdf.legend(loc='upper right', numpoints=1, prop={'size':10})
+            theta_actual = theta_actual[ind]
         
+        # Record the figure, with the marginal scalar estimates only
+        spec = {'Est': sub_est(Est, [ind]),
+                'PriorEst': sub_est(PriorEst, [ind]),
+                'xlabel': xlab,
+                'theta_actual': theta_actual}
         
-        # Create the image slide
-        self.make_image_slide(fig,
-                              title=title,
-                              caption=caption,
-                              fname=fname)
+        self.queue_figure('marginal_pdf', spec,
+                          title=title,
+                          caption=caption,
+                          fname=fname)
         
         return   
         
@@ -474,26 +832,25 @@ class Presentation(object):
                              caption=("ShortCap","Caption Text"),
                              fname="fig_model_est"):
         
-        fig, ax = bgninfo.plot_model_est(Est, meas_data, 
-                                         inds=inds,
-                                         actual_data=actual_data,
-                                         addto=None,
-                                         color='blue',
-                                         alpha=0.6,
-                                         linestyle='',
-                                         linewidth=2,
-                                         marker='.')
-        
-        # Set axis labels
-        ax.set_xlabel('measurement index')
-        ax.set_ylabel(self.measurement_name + ' [' + self.measurement_units + ']')
-        
-        # Create the image slide
-        self.make_image_slide(fig,
-                              scale=scale,
-                              title=title,
-                              caption=caption,
-                              fname=fname)
+        # Record the figure, with the first measurement vector only, and
+        # the model standard deviations computed here (so the Jacobian 
+        # is not needed to draw it).
+        spec = {'Est': {'model': Est['model'][:,:1], 
+                        's_est': Est['s_est'][:1]},
+                'meas_data': meas_data[:,:1],
+                'inds': inds,
+                'actual_data': None,
+                'model_stds': bgninfo.compute_model_error(Est, ind=0),
+                'ylabel': self.measurement_name + ' [' + self.measurement_units + ']'}
+        
+        if actual_data is not None:
+            spec['actual_data'] = actual_data[:,:1]
+        
+        self.queue_figure('model_est', spec,
+                          scale=scale,
+                          title=title,
+                          caption=caption,
+                          fname=fname)
                               
         return
     
@@ -506,27 +863,18 @@ class Presentation(object):
                                     caption=("ShortCap","Caption Text"),
                                     fname="fig_verification_err"):
         
-        fig, ax = bgninfo.plot_actual_estimation_err(Est, actual_data, 
-                                                     inds=inds,
-                                                     meas_data=None,
-                                                     addto=None,
-                                                     color='blue',
-                                                     alpha=0.6,
-                                                     linestyle='',
-                                                     linewidth=2,
-                                                     marker='.')
-        
-        # Set axis labels
-        ax.set_xlabel('index')
-        ax.set_ylabel('error' + ' [' + self.measurement_units + ']')
-        
-        
-        # Create the image slide
-        self.make_image_slide(fig,
-                              scale=scale,
-                              title=title,
-                              caption=caption,
-                              fname=fname)
+        # Record the figure (see make_model_est_slide)
+        spec = {'Est': {'model': Est['model'][:,:1]},
+                'actual_data': actual_data[:,:1],
+                'inds': inds,
+                'model_stds': bgninfo.compute_model_error(Est, ind=0),
+                'ylabel': 'error' + ' [' + self.measurement_units + ']'}
+        
+        self.queue_figure('verification_err', spec,
+                          scale=scale,
+                          title=title,
+                          caption=caption,
+                          fname=fname)
                               
         return
     
@@ -539,21 +887,30 @@ class Presentation(object):
                          ftype="pdf"):
         """
         Add a slide with matplotlib figure, mpl_fig.
+        
+        The figure is saved right away. Use queue_figure for figures that
+        can be described by a spec, so they are rendered by render_figures.
         """
         
         if ftype=="pdf":
-            print "Saving the figure as {}".\
-            format(self.rootdir+fname+'.pdf');
+            log.info("Saving the figure as %s", self.rootdir+fname+'.pdf');
             mpl_fig.savefig(self.rootdir+fname+'.pdf', bbox_inches='tight');
         elif ftype=="png":
-            print "Saving the figure as {}".\
-            format(self.rootdir+fname+'.png');
+            log.info("Saving the figure as %s", self.rootdir+fname+'.png');
             mpl_fig.savefig(self.rootdir+fname+'.png', bbox_inches='tight');
 
         #print "\nConverting pdf to eps ..."
         #pdf2eps.pdf2eps(fname+'.pdf');
         #print "Done.\n";
         
+        self.write_image_frame(title, caption, scale, fname, ftype)
+        
+        return
+        
+    
+    def write_image_frame(self, title, caption, scale, fname, ftype):
+        """Write the beamer frame that includes the figure file fname."""
+        
         # Format the image to beamer
         self.start_centered_frame(title=title)
         self.texfile.write("\\begin{figure}[htdp]\r\n")
@@ -565,10 +922,104 @@ class Presentation(object):
         self.end_centered_frame()
         
         return
+    
+    
+    def queue_figure(self, kind, spec,
+                     title="Slide Title",
+                     caption=("ShortCap","Caption Text"),
+                     scale=0.6,
+                     fname="fig_name",
+                     ftype="pdf"):
+        """
+        Add a slide with a figure of the given kind (see FIGURE_RENDERERS),
+        drawn from spec. The slide is written right away, but the figure is
+        only recorded, and rendered later by render_figures (which is 
+        called by close_tex). If self.defer_figures is False, the figure is
+        rendered immediately.
+        """
+        
+        self.write_image_frame(title, caption, scale, fname, ftype)
+        
+        job = (kind, spec, self.rootdir+fname+'.'+ftype)
+        
+        if self.defer_figures:
+            self.render_queue.append(job)
+        else:
+            render_figure(job)
+            self.figure_hashes[job[2]] = spec_hash(kind, spec)
+            self.save_figure_hashes()
+        
+        return
+    
+    
+    def load_figure_hashes(self):
+        """Return the spec hashes of the previously rendered figures."""
+        
+        try:
+            with open(self.rootdir+self.figure_cache_name) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+    
+    
+    def save_figure_hashes(self):
+        
+        with open(self.rootdir+self.figure_cache_name, 'w') as f:
+            json.dump(self.figure_hashes, f, indent=1, sort_keys=True)
+    
+    
+    def render_figures(self, processes=None):
+        """
+        Render all queued figures, in a process pool when there is more 
+        than one to render. Figures whose output file exists and whose spec
+        hash matches the previous build are skipped.
+        """
+        
+        if processes is None:
+            processes = self.processes
+        
+        jobs = []
+        for kind, spec, path in self.render_queue:
+            key = spec_hash(kind, spec)
+            
+            if self.figure_hashes.get(path) == key and os.path.exists(path):
+                log.debug("Figure %s is up to date.", path)
+                continue
+            
+            jobs.append(((kind, spec, path), key))
+        
+        self.render_queue = []
+        
+        progress = ratelog.RateLogger(log, 'figures rendered', check=1)
+        
+        if len(jobs) > 1 and processes != 1:
+            pool = multiprocessing.Pool(processes, init_render_worker)
+            try:
+                for path in pool.imap_unordered(render_figure, 
+                                                [job for job, key in jobs]):
+                    progress.tick()
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for job, key in jobs:
+                render_figure(job)
+                progress.tick()
+        
+        progress.done()
+        
+        for job, key in jobs:
+            self.figure_hashes[job[2]] = key
+        
+        self.save_figure_hashes()
+        
+        return
         
     
     def __init__(self, name):
         
+        setup_matplotlib()
+        
         self.short_name  = name
         self.title = "Default Presentation Title"
         self.authors = ["Dude1", "Dude2"]
@@ -583,6 +1034,14 @@ class Presentation(object):
         self.texfile = None
         self.rootdir = self.short_name+'/'
         
+        # Deferred figure rendering (see queue_figure)
+        self.defer_figures     = True
+        self.render_queue      = []
+        self.processes         = None
+        self.figure_cache_name = 'figure_hashes.json'
+        self.build_hash_name   = 'build_hash.txt'
+        self.figure_hashes     = self.load_figure_hashes()
+        
         return
         
         
@@ -4,11 +4,157 @@ Analysis function module for use with BGN estimates
 """
 import numpy as np
 import scipy.linalg as spla
-import scipy.stats as sps
-import matplotlib.pyplot as plt
 
-# for plots with no lables
-from matplotlib.ticker import NullFormatter
+import lazyimport
+
+# statistics and plotting modules, imported on first use
+sps    = lazyimport.lazy_import('scipy.stats')
+plt    = lazyimport.lazy_import('matplotlib.pyplot')
+ticker = lazyimport.lazy_import('matplotlib.ticker')
+
+
+# Covariances computed by estimate_covariance, as (copy of the inverse
+# covariance, covariance) pairs, most recent last
+COV_CACHE      = []
+COV_CACHE_SIZE = 8
+
+
+def estimate_covariance(Est):
+    """
+    x_est, Sigma = estimate_covariance(Est)
+    
+    Returns the estimate (as a 1-D vector) and its full covariance matrix,
+    computed from a single Cholesky factorization of the inverse 
+    covariance in Est. The last COV_CACHE_SIZE covariances are cached
+    (outside of Est, which is left unchanged), and reused when the inverse
+    covariance is equal to one they were computed from.
+    
+    Est: estimation result structure returned by bgn_solver, or any 
+    dictionary with 'x_est' and 'iSigma_est' fields defined, or with
+    'theta_est' and 'iSigma_theta' defined.
+    """
+    
+    # extract the needed parameters from the estimation result dictionary
+    if 'x_est' in Est:
+        x_est  = Est['x_est']
+        iSigma = Est['iSigma_est']
+    elif 'theta_est' in Est:
+        x_est  = Est['theta_est']
+        iSigma = Est['iSigma_theta']
+    else:
+        raise ValueError("Function requires an estimate and inverse "
+                         "covariance in Est.")
+    
+    A = np.array(iSigma, dtype=np.float64)
+    
+    for cached in COV_CACHE:
+        if np.array_equal(cached[0], A):
+            return np.asarray(x_est).ravel(), cached[1].copy()
+    
+    I = np.eye(len(A))
+    try:
+        Sigma = spla.cho_solve(spla.cho_factor(A), I)
+    except np.linalg.LinAlgError:
+        # not positive definite, e.g., a poorly converged estimate
+        Sigma = spla.solve(A, I)
+    
+    COV_CACHE.append((A, Sigma))
+    del COV_CACHE[:-COV_CACHE_SIZE]
+    
+    return np.asarray(x_est).ravel(), Sigma.copy()
+
+
+
+def confellipses(Est, pairs=None, alpha=0.95, npts=101, tfm=None):
+    """
+    loc, E, data = confellipses(Est, pairs=None, alpha=0.95, npts=101)
+    
+    Generates confidence ellipse data for many parameter pairs at once.
+    
+    The covariance is computed once (see estimate_covariance), all 2x2 
+    blocks are extracted together, and the ellipses are generated with a
+    closed form 2x2 eigen-decomposition, vectorized over the pairs.
+    
+    Inputs:
+    -------
+    
+    Est: same as confellipse.
+    
+    pairs: P x 2 list of parameter index pairs. By default, all pairs
+    (i,j) with i<j are used.
+    
+    alpha: confidence level in interval (0,1).
+    
+    npts: number of points along the border of each ellipse.
+    
+    tfm: optional transformation function, as in confellipse.
+    
+    Outputs:
+    --------
+    
+    loc: P x 2 array of ellipse locations (at the parameter estimate)
+    
+    E: P x 2 x 2 array of ellipse matrices, (x-loc)'*inv(E)*(x-loc) <= 1
+    
+    data: P x 2 x npts array of points along the ellipse borders
+    """
+    
+    x_est, Sigma = estimate_covariance(Est)
+    
+    d = len(x_est)
+    
+    if pairs is None:
+        pairs = np.column_stack(np.triu_indices(d, 1))
+    
+    pairs = np.asarray(pairs, dtype=int).reshape((-1,2))
+    i, j  = pairs[:,0], pairs[:,1]
+    
+    # All 2x2 covariance blocks and means
+    a = Sigma[i,i]
+    b = Sigma[i,j]
+    c = Sigma[j,j]
+    
+    Sigma2d = np.empty((len(pairs),2,2), dtype=Sigma.dtype)
+    Sigma2d[:,0,0] = a
+    Sigma2d[:,0,1] = b
+    Sigma2d[:,1,0] = b
+    Sigma2d[:,1,1] = c
+    
+    loc = np.column_stack((x_est[i], x_est[j]))
+    
+    # Closed form eigen-decomposition of the symmetric 2x2 blocks, used to
+    # build the symmetric square root R = V sqrt(L) V'.
+    mid   = 0.5*(a + c)
+    rad   = np.sqrt((0.5*(a - c))**2 + b**2)
+    s1    = np.sqrt(np.maximum(mid + rad, 0.))
+    s2    = np.sqrt(np.maximum(mid - rad, 0.))
+    phi   = 0.5*np.arctan2(2.*b, a - c)
+    cs    = np.cos(phi)
+    sn    = np.sin(phi)
+    
+    R = np.empty((len(pairs),2,2))
+    R[:,0,0] = s1*cs**2 + s2*sn**2
+    R[:,0,1] = (s1 - s2)*cs*sn
+    R[:,1,0] = R[:,0,1]
+    R[:,1,1] = s1*sn**2 + s2*cs**2
+    
+    # get the confidence level for the input alpha
+    delta = sps.chi2.isf(1.0-alpha,2);
+    
+    # generate points around the perimeter of the ellipses
+    t = 2.*np.pi*np.arange(npts)/(npts - 1.)
+    X = np.sqrt(delta)*np.vstack((np.cos(t), np.sin(t)))
+    Y = np.einsum('pij,jt->pit', R, X) + loc[:,:,np.newaxis]
+    
+    # apply the optional transformation if applicable
+    if tfm is not None:
+        for q in range(len(pairs)):
+            for k in range(npts):
+                Y[q,:,k] = tfm(Y[q,:,k])
+            loc[q] = tfm(loc[q])
+    
+    return loc, delta*Sigma2d, Y
+
 
 
 def confellipse(Est, inds, alpha, tfm=None):
@@ -48,55 +194,12 @@ def confellipse(Est, inds, alpha, tfm=None):
     data: matrix with 2 rows containing the points along the 
     boarder of the confidence ellipse    
 
+    Note: this is the single pair version of confellipses.
     """
     
-    # extract the needed parameters from the estimation result dictionary
-    if 'x_est' in Est:
-        x_est  = Est['x_est']
-        iSigma = Est['iSigma_est']
-    elif 'theta_est' in Est:
-        x_est  = Est['theta_est']
-        x_est.resize((len(x_est),1))
-        iSigma = Est['iSigma_theta']
-        
-    
-    # get the problem dimension
-    d = len(x_est);
-    
-    # setup ellipse resolution parameters
-    n = 100;
-    t = np.arange(0,n+1);
-    
-    # extract the 2D covariance submatrix corresponding to the 
-    # desired parameters (specified in ind)
-    e_i = np.zeros((d,1)); e_i[inds[0]] = 1.;
-    e_j = np.zeros((d,1)); e_j[inds[1]] = 1.;
-    E2d = np.hstack((e_i,e_j));
-    
-    Sigma2d = E2d.transpose().dot(spla.solve(iSigma,E2d));
-    mean2d  = E2d.transpose().dot(x_est);
-    
-    # get the confidence level for the input alpha
-    delta = sps.chi2.isf(1.0-alpha,2);
-    
-    # generate points around the perimeter of the ellipse
-    x = np.cos(2.*np.pi*t/n);
-    y = np.sin(2.*np.pi*t/n)
-    X = np.sqrt(delta)*np.vstack((x,y));
-    Y = spla.sqrtm(Sigma2d).dot(X) + mean2d;
+    loc, E, Y = confellipses(Est, [inds], alpha, tfm=tfm)
     
-    # apply the optional transformation if applicable
-    if tfm != None:
-        for k in range(Y.shape[1]):
-            Y[:,k] = tfm(Y[:,k]);
-            
-        mean2d = tfm(mean2d);
-    
-    # scale the ellipse output correctly
-    E = delta * Sigma2d;
-    # so the ellipse is defined by: x'*inv(E)*x = 1.
-    
-    return mean2d, E, Y;
+    return loc[0].reshape((2,1)), E[0], Y[0]
     
 
 
@@ -196,49 +299,153 @@ def plot_confellipse(Est, inds, alpha, tfm=None,
     
 
 
-def marginal_scalar_pdf(Est, ind, lims=None):
+def plot_confellipse_matrix(Est, alpha=0.95, inds=None,
+                            addto=None,
+                            color='blue',
+                            linestyle='-',
+                            labels=None):
     """
-    x, y = marginal_scalar_pdf(Est, ind)
+    fig, axes = plot_confellipse_matrix(Est, alpha=0.95, inds=None)
+    
+    Plots a lower triangular matrix of confidence ellipses, one for each 
+    pair of the parameters selected by inds (all parameters by default).
+    Panel axes[r-1,c] shows parameter inds[c] (x axis) against inds[r]
+    (y axis), for c < r. All ellipses are computed in one call to 
+    confellipses.
+    
+    addto: (optional) (fig, axes) tuple returned by an earlier call, to 
+    overlay another estimate, e.g., the prior.
+    
+    labels: optional list of axis labels, one for each selected parameter.
+    """
+    
+    x_est, _ = estimate_covariance(Est)
+    
+    if inds is None:
+        inds = np.arange(len(x_est))
+    
+    inds = np.asarray(inds)
+    k    = len(inds)
+    
+    # Index pairs (column, row) of the lower triangle panels
+    cols, rows = np.triu_indices(k, 1)
+    
+    loc, _, Y = confellipses(Est, np.column_stack((inds[cols], inds[rows])),
+                             alpha)
+    
+    if addto==None:
+        fig, axes = plt.subplots(k-1, k-1, squeeze=False,
+                                 figsize=(2.5*(k-1), 2.5*(k-1)))
+        
+        # hide the unused upper triangle
+        for r in range(1, k):
+            for c in range(r, k):
+                if c < k-1:
+                    axes[r-1,c].set_visible(False)
+    else:
+        fig, axes = addto
+    
+    for q in range(len(cols)):
+        ax = axes[rows[q]-1, cols[q]]
+        ax.plot(Y[q,0,:], Y[q,1,:],
+                color=color,
+                alpha=0.6,
+                marker='',
+                linestyle=linestyle,
+                linewidth=1.5)
+        ax.plot(loc[q,0], loc[q,1],
+                color=color, alpha=0.6,
+                marker='o',
+                markersize=3,
+                linestyle='')
+        
+        if labels is not None:
+            if rows[q] == k-1:
+                ax.set_xlabel(labels[cols[q]])
+            if cols[q] == 0:
+                ax.set_ylabel(labels[rows[q]])
+    
+    return fig, axes
 
-    Returns the data required to plot the marginal scalar pdf
-    that corresponds to the parameter specified by ind.
+
+
+def marginal_pdfs(Est, inds=None, lims=None, npts=200, quantiles=None):
     """
+    x, y = marginal_pdfs(Est, inds=None, lims=None, npts=200)
+    q    = marginal_pdfs(Est, inds=None, quantiles=[0.025, 0.5, 0.975])
     
-    # extract the needed parameters from the estimation result dictionary
-    # extract the needed parameters from the estimation result dictionary
-    if 'x_est' in Est:
-        x_est  = Est['x_est']
-        iSigma = Est['iSigma_est']
-    elif 'theta_est' in Est:
-        x_est  = Est['theta_est']
-        x_est.resize((len(x_est),1))
-        iSigma = Est['iSigma_theta']
+    Returns the marginal scalar pdfs of all the parameters selected by 
+    inds (all parameters by default) in one broadcast evaluation. The
+    covariance diagonal comes from the cached covariance of Est (see 
+    estimate_covariance).
+    
+    Inputs:
+    -------
     
-    # get the problem dimension
-    d = len(x_est);
+    Est: same as confellipse.
     
-    # extract the scalar variance
-    e_i   = np.zeros((d,1)); e_i[ind] = 1.;  
-    sigsq = e_i.transpose().dot(spla.solve(iSigma,e_i))[0,0];
-    sig   = np.sqrt(sigsq);
-    mu    = e_i.transpose().dot(x_est)[0,0];
+    inds: parameter indices, or None for all parameters.
     
+    lims: None for a +/- 5 sigma range around each estimate, a (lo, hi)
+    pair used for all parameters, or a k x 2 array of ranges, one for each
+    selected parameter.
+    
+    npts: number of points in each pdf grid.
+    
+    quantiles: optional list of probabilities. When given, only the k x q
+    array of marginal quantiles is returned.
+    
+    Outputs:
+    --------
     
-    # setup the parameter range
-    if lims==None:
-        x = np.linspace(mu - 5.*sig, mu + 5.*sig, 
-                        num=200, endpoint=True);
+    x, y: k x npts arrays of parameter values and pdf values.
+    """
+    
+    x_est, Sigma = estimate_covariance(Est)
+    
+    if inds is None:
+        inds = np.arange(len(x_est))
+    
+    inds = np.atleast_1d(inds)
+    
+    mu  = x_est[inds].real
+    sig = np.sqrt(np.diag(Sigma)[inds].real)
+    
+    if quantiles is not None:
+        return mu[:,np.newaxis] + \
+               sig[:,np.newaxis]*sps.norm.ppf(np.asarray(quantiles))
+    
+    # setup the parameter ranges
+    if lims is None:
+        lo = mu - 5.*sig
+        hi = mu + 5.*sig
     else:
-        x = np.linspace(lims[0], lims[1], 
-                        num=200, endpoint=True);
+        lims = np.asarray(lims, dtype=float)
+        lo   = lims[...,0]*np.ones(len(inds))
+        hi   = lims[...,1]*np.ones(len(inds))
+    
+    u = np.linspace(0., 1., num=npts, endpoint=True)
+    x = lo[:,np.newaxis] + (hi - lo)[:,np.newaxis]*u
+    
+    y = sps.norm.pdf(x, loc=mu[:,np.newaxis], scale=sig[:,np.newaxis])
     
+    return x, y
+
+
+
+def marginal_scalar_pdf(Est, ind, lims=None):
+    """
+    x, y = marginal_scalar_pdf(Est, ind)
+
+    Returns the data required to plot the marginal scalar pdf
+    that corresponds to the parameter specified by ind.
     
-    #y = (1./(np.sqrt(2.*np.pi*sigsq)))*\
-    #     np.exp( -0.5 * (x-mu)**2/(sigsq) );
+    Note: this is the single parameter version of marginal_pdfs.
+    """
     
-    y = sps.norm.pdf(x,loc=mu,scale=sig);
+    x, y = marginal_pdfs(Est, [ind], lims=lims)
     
-    return x, y;
+    return x[0], y[0];
    
    
    
@@ -311,7 +518,7 @@ def plot_combo(Est, inds, alpha, tfm=None,
     #
     
     if addto==None:
-        nullfmt   = NullFormatter()         # no labels
+        nullfmt   = ticker.NullFormatter()  # no labels
 
         # definitions for the axes
         #left, width = 0.1, 0.65
@@ -398,7 +605,7 @@ def plot_combo(Est, inds, alpha, tfm=None,
     
     
 
-def compute_model_error(Est,ind=0):
+def compute_model_error(Est, ind=0, out=None, CHUNK=65536):
     """
     Use the parameter estimates to determine the standard deviation
     for each model ouput, given the parameter variation.
@@ -406,31 +613,75 @@ def compute_model_error(Est,ind=0):
     In the generalized measurement model, there are p Jacobian matrices
     in Est['D'], one for each output vector measurement. The ind input
     specifies which output vector to compute the model error for.
+    
+    Inputs:
+    -------
+    
+    Est: Estimation result dictionary returned from bgnlcs module. 
+    Est['D'] can be a p x n x d array (or memmap), or a lazily evaluated 
+    lcsmodel.LCSJacobian, in which case D[k] is materialized once for each
+    load case (d residuals and one backsolve with d right-hand sides).
+    
+    ind: load case index, a list of indices, or None for all load cases.
+    
+    out: optional file name or open file. The standard deviations are
+    written to it as text, one row per model output and one column per
+    load case.
+    
+    CHUNK: number of model outputs (rows of D) processed at a time.
+    
+    Outputs:
+    --------
+    
+    stds: n vector of standard deviations if ind is an integer, otherwise
+    a (len(ind) x n) array.
     """
     if 'theta_est' and 'D' in Est:
-        D      = Est['D'][ind];
-        iSigma = Est['iSigma_theta']
+        D = Est['D']
     else:
         raise ValueError("Function requires inverse Sigma_theta "
                          "and Jacobian matrices in Est.")
     
+    # Number of output vectors, model outputs, parameters
+    p,n,d = D.shape
     
-    # Number of output vectors, parameters, model outputs       
-    n,d = D.shape
+    if ind is None:
+        inds = np.arange(p)
+    else:
+        inds = np.atleast_1d(ind)
     
-    # Inverse iSigma_theta, to get covariance matrix
-    I = np.eye(d)
-    #Sigma = np.linalg.solve(iSigma, I)
-    Sigma = spla.solve(iSigma, I)
+    # Covariance matrix (see estimate_covariance)
+    Sigma = estimate_covariance(Est)[1]
     
-    M = Sigma.dot(D.T)
+    stds = np.zeros((len(inds), n))
     
-    #stds = np.zeros(n);
-    #for i in range(n):
-        #stds[i] = np.sqrt(D[i,:].dot(M[:,i]))
+    for i, k in enumerate(inds):
+        Dk = D[k]
         
-    mstd = np.vectorize(lambda i: np.sqrt(D[i,:].dot(M[:,i])))
-    stds = mstd(np.arange(n))
+        for start in range(0, n, CHUNK):
+            rows = slice(start, min(start + CHUNK, n))
+            
+            # Row-wise quadratic forms D_r Sigma D_r^T for the chunk
+            Dc = np.asarray(Dk[rows], dtype=np.float64)
+            stds[i,rows] = np.sqrt(np.einsum('ij,ij->i', Dc.dot(Sigma), Dc))
+    
+    if isinstance(out, basestring):
+        out = open(out, 'w')
+        close_out = True
+    else:
+        close_out = False
+    
+    try:
+        if out is not None:
+            for start in range(0, n, CHUNK):
+                rows = slice(start, min(start + CHUNK, n))
+                np.savetxt(out, stds[:,rows].T, fmt='%.8e')
+    finally:
+        if close_out:
+            out.close()
+    
+    if np.ndim(ind) == 0 and ind is not None:
+        return stds[0]
     
     return stds
         
@@ -441,6 +692,7 @@ def plot_model_est(Est, meas_data,
                    inds=None,
                    meas_ind=0,
                    actual_data=None,
+                   model_stds=None,
                    addto=None,
                    color='blue',
                    alpha=0.6,
@@ -470,6 +722,9 @@ def plot_model_est(Est, meas_data,
     
     actual_data: If specified, actual data added to the plot.
     
+    model_stds: Model output standard deviations for meas_ind. If not 
+    given, they are computed with compute_model_error.
+    
     The number of columns in meas_data, and actual_data must match
     the number of measurement vectors used to obtain Est, from
     the bgnlcs routine.
@@ -483,7 +738,8 @@ def plot_model_est(Est, meas_data,
         fig, ax = addto;
         
     model_est  = Est['model'][:,meas_ind]
-    model_stds = compute_model_error(Est,ind=meas_ind)
+    if model_stds is None:
+        model_stds = compute_model_error(Est,ind=meas_ind)
     meas_std   = np.sqrt(1./(Est['s_est'][meas_ind]))
     
     if inds is None:
@@ -530,6 +786,7 @@ def plot_actual_estimation_err(Est, actual_data,
                                inds=None,
                                meas_ind=0,
                                meas_data=None,
+                               model_stds=None,
                                addto=None,
                                color='blue',
                                alpha=0.6,
@@ -547,6 +804,9 @@ def plot_actual_estimation_err(Est, actual_data,
     
     actual_data: Underlying truth data to be compared with model estimate
     
+    model_stds: Model output standard deviations for meas_ind. If not 
+    given, they are computed with compute_model_error.
+    
     
     TODO: options below not yet implemented.
     
@@ -573,7 +833,8 @@ def plot_actual_estimation_err(Est, actual_data,
         fig, ax = addto;
         
     model_est  = Est['model'][:,meas_ind]
-    model_stds = compute_model_error(Est,ind=meas_ind)
+    if model_stds is None:
+        model_stds = compute_model_error(Est,ind=meas_ind)
     #meas_std   = np.sqrt(1./(Est['s_est'][meas_ind]))
     
     if inds is None:
@@ -2,10 +2,89 @@
 """
 Module for formatting bgn/bdynsid estimation results to 
 output LaTeX .tex files
+
+Numeric cells are formatted a whole array at a time (see format_cells), and
+each file is written with a single write call, so large matrices, e.g., the
+covariance of a few hundred parameters, export quickly. The matrix writers
+can also split wide matrices into column blocks, and blank out entries 
+below a threshold.
 """
+import re
+
 import numpy as np
 
 
+# Simple '{:spec}' format strings that have an identical printf style
+# '%spec' form, which numpy can apply to a whole array at once.
+FMT_PATTERN = re.compile(r'^\{:([-+ #0]*\d*(?:\.\d+)?[eEfFgG])\}$')
+
+# Row terminator used in all tables and arrays
+ENDROW = ' \\\ \n'
+
+
+def format_cells(x, fmtstr='{:1.3f}'):
+    """
+    Return an object array of strings, with fmtstr applied to each element
+    of the numeric array x.
+    
+    Format strings with a printf equivalent (e.g. '{:1.3f}') are applied
+    with numpy.char.mod in one call. Others (e.g. '{:1.2}', which has no
+    exact printf equivalent) fall back to str.format for each cell.
+    """
+    
+    x = np.asarray(x)
+    
+    match = FMT_PATTERN.match(fmtstr)
+    
+    if match and x.dtype.kind in 'fiu':
+        cells = np.char.mod('%' + match.group(1), x.astype(np.float64))
+    else:
+        cells = np.array([fmtstr.format(v) for v in x.ravel()]).reshape(x.shape)
+    
+    return cells.astype(object)
+
+
+def column_blocks(numcols, blocksize=None):
+    """Return the (start, stop) column ranges of the matrix blocks."""
+    
+    if blocksize is None or blocksize >= numcols:
+        return [(0, numcols)]
+    
+    return [(j, min(j + blocksize, numcols)) 
+            for j in range(0, numcols, blocksize)]
+
+
+def array_tex(cells, x_name, align, blocksize=None):
+    """
+    Return the latex for the matrix of formatted cells, as one or more
+    x_name = \\left[ \\begin{array} ... \\end{array} \\right] blocks.
+    """
+    
+    numcols = cells.shape[1]
+    blocks  = column_blocks(numcols, blocksize)
+    
+    lines = []
+    
+    for start, stop in blocks:
+        
+        if len(blocks) == 1:
+            lines.append(x_name + " = " + "\\left[ \n")
+        else:
+            # label the block with its (1-based) column range
+            lines.append("{%s}_{\\cdot,%d:%d} = \\left[ \n" % 
+                         (x_name, start+1, stop))
+        
+        lines.append("\\begin{array}" + "{" + align*(stop-start) + "}\n")
+        
+        for row in cells[:,start:stop]:
+            lines.append(' & '.join(row) + ENDROW)
+        
+        lines.append("\\end{array}\n")
+        lines.append("\\right]\n")
+    
+    return ''.join(lines)
+
+
 
 def write_estresults_table(x_est, col_names, file_name):
     
@@ -78,44 +157,47 @@ def write_table(row_data, row_names, col_names, file_name, fmtstr=['{:1.2}']):
     
     # If needed copy format string for each column
     if len(fmtstr)==1:
-        for k in range(n-1):
-            fmtstr.append(fmtstr[0]);
+        fmtstr = fmtstr*n
     
-    fid = open(file_name, "wb");
-
-    fid.write("\\begin{tabular}" + "{" + "|r|" + "|c"*(n) + "|}\n");
-    fid.write("\\hline \n");
+    lines = []
     
-    fid.write(" & " + ("{} & "*(n-1) + "{} \\\ \n" ).format(*col_names));
-    fid.write("\\hline \\hline \n");
+    lines.append("\\begin{tabular}" + "{" + "|r|" + "|c"*(n) + "|}\n");
+    lines.append("\\hline \n");
+    
+    lines.append(" & " + ("{} & "*(n-1) + "{} \\\ \n" ).format(*col_names));
+    lines.append("\\hline \\hline \n");
+    
+    # Format the numeric rows one column at a time
+    numeric = [k for k in range(m) 
+               if not isinstance(row_data[k][0], basestring)]
+    
+    if numeric:
+        data  = np.array([row_data[k] for k in numeric])
+        cells = np.column_stack([format_cells(data[:,j], fmtstr[j]) 
+                                 for j in range(n)])
+        cells = dict(zip(numeric, cells))
     
     for k in range(m):
         #fid.write("\\textsc{%s} & " % row_names[k])
-        fid.write("\\textsc{{{}}} & ".format(row_names[k]))
+        row = "\\textsc{{{}}} & ".format(row_names[k])
         
         # If the list elements are strings
         if isinstance(row_data[k][0], basestring):
-            fid.write(('{} & '*(n-1) + '{} \\\ \n').format(*row_data[k]));
+            row += ('{} & '*(n-1) + '{} \\\ \n').format(*row_data[k]);
             
         # Otherwise format as number
         else:
-            #fid.write(('{:1.2} & '*(n-1) + '{:1.2} \\\ \n').format(*row_data[k]));
-            #fid.write(( (fmtstr + ' & ')*(n-1) + fmtstr + ' \\\ \n' ).format(*row_data[k]));
-            #fid.write(( (fmtstr[0] + ' & ')*(n-1) + fmtstr[0] + ' \\\ \n' ).format(*row_data[k]));
-            str=''
-            for j in range(n-1):
-                str += fmtstr[j] + ' & '
-            str += fmtstr[n-1] + '\\\ \n'
-            fid.write(str.format(*row_data[k]))
-
-            
-        fid.write("\\hline \n");
+            row += ' & '.join(cells[k]) + '\\\ \n'
+        
+        lines.append(row)
+        lines.append("\\hline \n");
     
     
-    fid.write("\\end{tabular}\n")
+    lines.append("\\end{tabular}\n")
 
     
-
+    fid = open(file_name, "wb");
+    fid.write(''.join(lines))
     fid.close();
     
     
@@ -130,7 +212,7 @@ def write_vector(x, x_name, file_name, fmtstr='{:1.3f}'):
     bgstr   = x_name + " = " + "\\left[ \n";
     
     #namestr = ("{:1.2}, "*(d-1) + "{:1.2} \n" ).format(*x);
-    namestr = ( (fmtstr + ", ")*(d-1) + fmtstr + " \n" ).format(*x);
+    namestr = ", ".join(format_cells(np.ravel(x), fmtstr)) + " \n";
     
     edstr   = "\\right]\n"
 
@@ -142,68 +224,59 @@ def write_vector(x, x_name, file_name, fmtstr='{:1.3f}'):
 
 
 
-def write_matrix(x, x_name, file_name, fmtstr='{:1.3f}'):
-
-    fid = open(file_name, "wb");
+def write_matrix(x, x_name, file_name, fmtstr='{:1.3f}',
+                 blocksize=None, threshold=None):
+    """
+    Write the matrix x as a latex array.
     
-    numrows = len(x);
-    numcols = len(x[0]);
-
-    bgstr   = x_name + " = " + "\\left[ \n";
-    fid.write(bgstr);
+    blocksize: if given, the columns are split into blocks of at most
+    blocksize columns, each written as a separate array.
     
-    srtary = "\\begin{array}" + "{" + "r"*numcols + "}\n";
-    fid.write(srtary);
+    threshold: if given, entries with absolute value below threshold are
+    written as \cdot.
+    """
     
-    # write out each row
-    for row in x:
-        #rowstr = ("{:1.2f} & "*(numcols-1) + "{:1.2f} \\\ \n" ).format(*row);
-        rowstr = ((fmtstr + ' & ')*(numcols-1) + fmtstr + ' \\\ \n' ).format(*row)
-        fid.write(rowstr);
+    x = np.asarray(x)
     
-    edary   = "\\end{array}\n";
-    fid.write(edary);
+    cells = format_cells(x, fmtstr)
     
-    edstr   = "\\right]\n"
-    fid.write(edstr);
-
+    if threshold is not None:
+        cells[np.abs(x) < threshold] = '\\cdot'
+    
+    fid = open(file_name, "wb");
+    fid.write(array_tex(cells, x_name, 'r', blocksize))
     fid.close();
 
 
 
 # this version writes the diagonal matrix elements in square root form
-def write_cov_matrix(x, x_name, file_name):
-
-    fid = open(file_name, "wb");
+def write_cov_matrix(x, x_name, file_name, fmtstr='{:1.3f}',
+                     blocksize=None, threshold=None):
+    """
+    Write the covariance matrix x as a latex array, with the diagonal
+    elements in square root (standard deviation) form.
     
-    numrows = len(x);
-    numcols = len(x[0]);
-
-    bgstr   = x_name + " = " + "\\left[ \n";
-    fid.write(bgstr);
+    blocksize: as in write_matrix.
     
-    srtary = "\\begin{array}" + "{" + "c"*numcols + "}\n";
-    fid.write(srtary);
-    
-    # write out each row
-    for i in range(numrows):
-        rowstr = "";
-        for j in range(numcols):
-            if i==j:
-                rowstr += "{:1.3f}^2 & ".format(np.sqrt(x[i][j]));
-            else:
-                rowstr += "{:1.3f} & ".format(x[i][j]);
-        
-        # remove the final '&' and append an endline
-        rowstr = rowstr[:-2] + "\\\ \n";
-        fid.write(rowstr);
+    threshold: if given, only the significant correlations are written,
+    i.e., off-diagonal entries with |x_ij|/sqrt(x_ii x_jj) < threshold 
+    are written as \cdot.
+    """
     
-    edary   = "\\end{array}\n";
-    fid.write(edary);
+    x = np.asarray(x)
     
-    edstr   = "\\right]\n"
-    fid.write(edstr);
-
+    cells = format_cells(x, fmtstr)
+    
+    stds = np.sqrt(np.diag(x))
+    np.fill_diagonal(cells, format_cells(stds, fmtstr) + '^2')
+    
+    if threshold is not None:
+        corr = np.abs(x) / np.outer(stds, stds)
+        np.fill_diagonal(corr, 1.)
+        cells[corr < threshold] = '\\cdot'
+    
+    fid = open(file_name, "wb");
+    fid.write(array_tex(cells, x_name, 'c', blocksize))
     fid.close();
 
 
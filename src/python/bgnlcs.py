@@ -30,12 +30,18 @@ import numpy.linalg as linalg
 import scipy.sparse as sprs
 # linalg is needed for norm and solve
 
+import bgntrace
 import blasym
 import lcsmodel
+import ratelog
+
+
+log = ratelog.get_logger(__name__)
 
 
 def bgn_lcs_solver(Data, M, lcsModel, Prior,
-                   TOL=1.0e-6, MAXIT=10, ALPHA=0.2, BETA=0.1, QUIET=False):
+                   TOL=1.0e-6, MAXIT=10, ALPHA=0.2, BETA=0.1, QUIET=False,
+                   POOL=None, SENSOR_JACOBIAN=False, TRACE=False, CALLBACK=None):
     """ 
     bgn_lcs_solver - Bayesian Gauss-Newton (bgn) linear constrained system
     solver for a parameter estimation problem to fit a possibly non-linear 
@@ -114,6 +120,29 @@ def bgn_lcs_solver(Data, M, lcsModel, Prior,
         MAXIT: maximum number of iterations to run
        
         QUIET: if true, progress output text is suppressed.
+        
+        POOL: optional bgnpar.TrialPool created with lcsModel.eval. When
+        given, the line search evaluates a ladder of POOL.processes step
+        sizes concurrently, and accepts the largest one that satisfies 
+        the descent condition, exactly as the sequential line search 
+        would. Note, the accepted model output is computed in a worker 
+        process, so lcsModel itself is only updated (refactored) when the 
+        Jacobian is needed at the new parameter vector.
+        
+        SENSOR_JACOBIAN: if true, only the sensor restricted Jacobian 
+        products M[k] D[k] are computed (see 
+        lcsmodel.LCSModel.sensor_jacobian), so memory scales with the
+        number of sensors instead of the number of model outputs n. 
+        Est['D'] is then only evaluated when it is used.
+        
+        TRACE: if true (or a bgntrace.Trace to add to), the wall and CPU
+        time of the solver phases, the factorization, backsolve and r.h.s.
+        counts of lcsModel, and one record per iteration (including the
+        number of line search trials) are returned in Est['trace'].
+        
+        CALLBACK: optional function callback(event, info), called with 
+        event 'iteration' and the record after every iteration, and with
+        'done' and Est['trace'] at the end. Implies TRACE.
        
     
     Outputs:
@@ -133,10 +162,19 @@ def bgn_lcs_solver(Data, M, lcsModel, Prior,
         lnZ: estimated log evidence of the observed data
               
         model: nx1 vector containing the model output at theta_est
+        
+        D: p x n x d model Jacobian at theta_est, as a lazily evaluated 
+        lcsmodel.LCSJacobian. Use D[k] for the Jacobian of load case k, 
+        or np.asarray(D) for the full array.
+        
+        MD: list of the p, m x d sensor Jacobians M[k] D[k] at theta_est
             
         fo: Scalar objective value at (theta_est, s_est)
                
         status: boolean status indicating convergence
+        
+        trace: solver trace summary (see bgntrace.Trace.summary), or None
+        if TRACE and CALLBACK are not set
     
     Note: iSigma_theta, iSigma, and lnZ are based on a local quadratic 
     approximation of the objective function at the optimal solution
@@ -159,166 +197,234 @@ def bgn_lcs_solver(Data, M, lcsModel, Prior,
     if Data.ndim != 2:
         raise ValueError("Input Data must have Data.ndim==2.")
     
-    # Set starting parameter guess, and compute model output
-    theta_o = Prior['theta_o'].copy()
-    x_o     = lcsModel.eval(theta_o)
+    # Solver trace (disabled by default)
+    trace = bgntrace.make_trace(TRACE, CALLBACK)
+    model_trace = lcsModel.trace
+    lcsModel.set_trace(trace)
     
-    # Initialize the Objective Function evaluation object
-    f_obj = ObjFun(Data, M, lcsModel, Prior)
-    
-    # Initialize convergence status
-    status = True
-    # note: this starts as true and is set to false if there is a problem.
-    
-    # Print progress output headers
-    if not QUIET:
-        hbar = '-'*70;
-        print '\nBayesian Gauss-Newton LCS Solver 1.0'
-        print hbar
-        print '   Solving a %i-dimensional problem.\n' % np.alen(theta_o)
+    try:
+        # Set starting parameter guess, and compute model output
+        theta_o = Prior['theta_o'].copy()
+        with trace.phase('model_eval'):
+            x_o = lcsModel.eval(theta_o)
         
-        # print algorithm progress feedback headers
-        headers = ('Norm(dtheta)', 'Objective', 'Step Size', 'Norm(gradient)')
-        print '%11s%17s%14s%18s' % headers
-        print hbar
-
-    # Initialize the no improvement counter
-    no_imp_cnt = 0
-    
-    # Initialize progress data list
-    progress_data = []
-    
-    # Run the main BGN loop
-    for k in range(MAXIT):
-        
-        # On entry, theta_o and x_o are initialized above,
-        # On repeat, theta_o and x_o are updated below.
+        # Initialize the Objective Function evaluation object
+        f_obj = ObjFun(Data, M, lcsModel, Prior, SENSOR_JACOBIAN)
         
-        # Compute the noise update first
-        s_o = f_obj.precision_update(x_o)
+        # Initialize convergence status
+        status = True
+        # note: this starts as true and is set to false if there is a problem.
         
-        # Compute the current value of the objective function
-        objfun_o    = f_obj.eval(x_o, theta_o, s_o)
+        # Progress output headers
+        headers = ('Norm(dtheta)', 'Objective', 'Step Size', 'Norm(gradient)')
         
-        # Evaluate the gradient and approximate Hessian
-        g, H = f_obj.eval_grad_hess_theta(x_o, theta_o, s_o)
+        # Print progress output headers
+        if not QUIET:
+            hbar = '-'*70;
+            log.info('\nBayesian Gauss-Newton LCS Solver 1.0')
+            log.info(hbar)
+            log.info('   Solving a %i-dimensional problem.\n', np.alen(theta_o))
+            
+            # print algorithm progress feedback headers
+            log.info('%11s%17s%14s%18s', *headers)
+            log.info(hbar)
+
+        # Initialize the no improvement counter
+        no_imp_cnt = 0
         
-        # Solve for the parameter update
-        dtheta = linalg.solve(H, -g)
+        # Initialize progress data list
+        progress_data = []
         
-        # Line-search guard to ensure descent
-        t = 1.0
-        objfun_t = objfun_o
-        while True:
-            # Store the previous objective function calculation.
-            prev_objfun_t = objfun_t
+        # Run the main BGN loop
+        for k in range(MAXIT):
             
-            theta_t   = theta_o + t*dtheta
-            x_t       = lcsModel.eval(theta_t)
-            objfun_t  = f_obj.eval(x_t, theta_t, s_o)
+            # On entry, theta_o and x_o are initialized above,
+            # On repeat, theta_o and x_o are updated below.
             
-            if objfun_t==prev_objfun_t:
-                print "No change to Objfun evaluated at parameter increment."
-                break
+            # Compute the noise update first
+            s_o = f_obj.precision_update(x_o)
+            
+            # Compute the current value of the objective function
+            with trace.phase('objective'):
+                objfun_o = f_obj.eval(x_o, theta_o, s_o)
+            
+            # Evaluate the gradient and approximate Hessian
+            with trace.phase('gradient_hessian'):
+                g, H = f_obj.eval_grad_hess_theta(x_o, theta_o, s_o)
+            
+            # Solve for the parameter update
+            dtheta = linalg.solve(H, -g)
             
-            #if t<TOL:
-            #    print "t<TOL in backtrack. That's a problem."
-            #    break
+            # Line-search guard to ensure descent
+            t = 1.0
+            objfun_t = objfun_o
+            trials = 0
+            line_search = trace.phase('line_search').start()
+            while POOL is None:
+                # Store the previous objective function calculation.
+                prev_objfun_t = objfun_t
                 
-            if objfun_t > objfun_o + ALPHA*t*g.dot(dtheta):
-                t = BETA*t
+                theta_t   = theta_o + t*dtheta
+                with trace.phase('model_eval'):
+                    x_t   = lcsModel.eval(theta_t)
+                objfun_t  = f_obj.eval(x_t, theta_t, s_o)
+                trials   += 1
+                
+                if objfun_t==prev_objfun_t:
+                    log.warning("No change to Objfun evaluated at parameter increment.")
+                    break
+                
+                #if t<TOL:
+                #    print "t<TOL in backtrack. That's a problem."
+                #    break
+                    
+                if objfun_t > objfun_o + ALPHA*t*g.dot(dtheta):
+                    t = BETA*t
+                    if stopping_criterion_satisfied(dtheta, H, TOL, quiet=QUIET):
+                        t = TOL*t
+                    #
+                    # note: if the stopping criterion is satisfied, then we don't
+                    # want to spend time dividing down the step size. Setting 
+                    # t=TOL*t, rapidly accelerates this phase while still allowing
+                    # a very small step if it decreases the objective.
+                    
+                else:
+                    break
+            
+            # Speculative version of the same line search
+            if POOL is not None:
+                # Backtracking factor (constant for the current dtheta)
+                step_fac = BETA
                 if stopping_criterion_satisfied(dtheta, H, TOL, quiet=QUIET):
-                    t = TOL*t
-                #
-                # note: if the stopping criterion is satisfied, then we don't
-                # want to spend time dividing down the step size. Setting 
-                # t=TOL*t, rapidly accelerates this phase while still allowing
-                # a very small step if it decreases the objective.
+                    step_fac = TOL*BETA
+            
+            while POOL is not None:
+                steps   = [t*step_fac**j for j in range(POOL.processes)]
+                points  = [theta_o + tj*dtheta for tj in steps]
+                results = POOL.submit(points)
                 
-            else:
+                for t, theta_t in zip(steps, points):
+                    prev_objfun_t = objfun_t
+                    
+                    x_t       = next(results)
+                    objfun_t  = f_obj.eval(x_t, theta_t, s_o)
+                    trials   += 1
+                    
+                    if objfun_t==prev_objfun_t:
+                        log.warning("No change to Objfun evaluated at parameter increment.")
+                        break
+                    
+                    if not objfun_t > objfun_o + ALPHA*t*g.dot(dtheta):
+                        break
+                else:
+                    # No acceptable step in this ladder, try the next one
+                    t = step_fac*t
+                    continue
+                
+                # Skip the remaining (smaller) trial steps
+                POOL.cancel()
                 break
+            
+            line_search.stop()
+            trace.count('line_search_trials', trials)
 
-        
-        # If the objective is not improved after 3 tries, exit
-        if objfun_t >= objfun_o and t<BETA**3:
-            no_imp_cnt += 1
-            #if not QUIET:
-            #    print 'No improvement made to objective. Strike {}.'.\
-            #    format(no_imp_cnt)
-            if no_imp_cnt == 3:
-                print 'No improvement made to objective. Exiting.'; 
-                status = False
+            
+            # If the objective is not improved after 3 tries, exit
+            if objfun_t >= objfun_o and t<BETA**3:
+                no_imp_cnt += 1
+                #if not QUIET:
+                #    print 'No improvement made to objective. Strike {}.'.\
+                #    format(no_imp_cnt)
+                if no_imp_cnt == 3:
+                    log.warning('No improvement made to objective. Exiting.');
+                    status = False
+                    break
+            else:
+                # Reset the counter
+                no_imp_cnt = 0
+
+            
+            # Update current guess and model output.
+            theta_o = theta_t
+            x_o     = x_t
+            
+            
+            # Print progress info
+            if not QUIET:
+                progress_data.append( (linalg.norm(dtheta), objfun_t, t, linalg.norm(g) ))
+                log.info('%11.3f%17.7f%14.2f%18.3f', *progress_data[-1])
+            
+            if trace:
+                trace.iteration(iteration=k, objective=float(objfun_t), step=t,
+                                trials=trials, norm_dtheta=linalg.norm(dtheta),
+                                norm_gradient=linalg.norm(g))
+            
+            
+            # Check exit condition
+            if stopping_criterion_satisfied(dtheta, H, TOL, quiet=QUIET):
+                if not QUIET: 
+                    log.info('Stopping criterion satisfied. Done.')
                 break
+                
         else:
-            # Reset the counter
-            no_imp_cnt = 0
+            status = False
+            log.warning('\nBayesian Gauss-Newton did NOT converge after max iterations.\n')
 
+        if not QUIET: 
+            log.info(hbar)
         
-        # Update current guess and model output.
-        theta_o = theta_t
-        x_o     = x_t
         
+        # Get the objective function value on exit
+        fo = f_obj.eval(x_o, theta_o, s_o)
         
-        # Print progress info
-        if not QUIET:
-            progress_data.append( (linalg.norm(dtheta), objfun_t, t, linalg.norm(g) ))
-            print '%11.3f%17.7f%14.2f%18.3f' % progress_data[-1]
+        # Diagnostics
+        if not QUIET: 
+            log.info('Objective on exit = %0.6f', fo)
         
-        
-        # Check exit condition
-        if stopping_criterion_satisfied(dtheta, H, TOL, quiet=QUIET):
-            if not QUIET: 
-                print 'Stopping criterion satisfied. Done.'
-            break
-            
-    else:
-        status = False
-        print '\nBayesian Gauss-Newton did NOT converge after max iterations.\n'
-
-    if not QUIET: 
-        print hbar
-    
-    
-    # Get the objective function value on exit
-    fo = f_obj.eval(x_o, theta_o, s_o)
-    
-    # Diagnostics
-    if not QUIET: 
-        print 'Objective on exit = %0.6f' % fo
-    
-    # Compute the posterior PDF inverse covariance terms
-    g, iSigma, iSigma_theta, D = f_obj.eval_posterior_precision(x_o, theta_o, s_o)
+        # Compute the posterior PDF inverse covariance terms
+        with trace.phase('posterior'):
+            g, iSigma, iSigma_theta, D = f_obj.eval_posterior_precision(x_o, theta_o, s_o)
+        MD = f_obj.jacobian_products(theta_o)[1]
+        if D is None:
+            # sensor Jacobians only; the full Jacobian is evaluated lazily
+            D = lcsModel.jacobian_operator(theta_o)
 
-    if not QUIET: 
-        print 'Norm of gradient on exit = %f\n' % linalg.norm(g)
+        if not QUIET: 
+            log.info('Norm of gradient on exit = %f\n', linalg.norm(g))
 
-    # Compute the log evidence.
-    lnZ = -fo - 0.5 * blasym.logdet(iSigma/(2.*pi))
-    
-    # Evaluate the model and Jacobian at the parameter estimate
-    #x_o = lcsModel.eval(theta_o)
-    #D_o = lcsModel.jacobian(theta_o)
-    #
-    # note: lcsModel is in charge of tracking theta, and preventing
-    # recomputation when theta does not change. (DELETE THIS ITS REDUNDANT)
+        # Compute the log evidence.
+        lnZ = -fo - 0.5 * blasym.logdet(iSigma/(2.*pi))
+        
+        # Evaluate the model and Jacobian at the parameter estimate
+        #x_o = lcsModel.eval(theta_o)
+        #D_o = lcsModel.jacobian(theta_o)
+        #
+        # note: lcsModel is in charge of tracking theta, and preventing
+        # recomputation when theta does not change. (DELETE THIS ITS REDUNDANT)
 
-    #
-    # Define outputs
-    #
+        #
+        # Define outputs
+        #
 
-    Est={};
-    Est['theta_est']    = theta_o
-    Est['s_est']        = s_o
-    Est['model']        = x_o
-    Est['fo']           = fo
-    Est['D']            = D
-    Est['status']       = status
-    Est['iSigma_theta'] = iSigma_theta
-    Est['iSigma']       = iSigma
-    Est['lnZ']          = lnZ
-    
+        Est={};
+        Est['theta_est']    = theta_o
+        Est['s_est']        = s_o
+        Est['model']        = x_o
+        Est['fo']           = fo
+        Est['D']            = D
+        Est['MD']           = MD
+        Est['status']       = status
+        Est['iSigma_theta'] = iSigma_theta
+        Est['iSigma']       = iSigma
+        Est['lnZ']          = lnZ
+        
+        
+        Est['progress_info'] = {'headers': headers, 'data': progress_data}
+    finally:
+        # also on errors, so the model does not keep the trace of this solve
+        lcsModel.set_trace(model_trace)
     
-    Est['progress_info'] = {'headers': headers, 'data': progress_data}
+    Est['trace'] = trace.finish()
     
     return Est
     
@@ -333,13 +439,13 @@ def stopping_criterion_satisfied(dtheta, H, tol, quiet=True):
     if (linalg.norm(dtheta)<=tol):
         #if np.sqrt(f_obj.quadsum(dtheta, P=H)) <= TOL:
         if not quiet:
-            print "\nNorm(dtheta) less than TOL."
+            log.info("\nNorm(dtheta) less than TOL.")
             
         return True
         
     elif (dtheta.dot(H.dot(dtheta))<=tol):
         if not quiet:
-            print "\nH-norm less than TOL."
+            log.info("\nH-norm less than TOL.")
         
         return True
         
@@ -359,6 +465,9 @@ class ObjFun(object):
     
     in accordance with the LCS model. This is to prevent unnecessary 
     computation of the model output.
+    
+    If sensor is true, only the products M[k] D[k] are computed from the
+    model, and the full Jacobian D is never formed.
     """
 
     def quadsum(self, x, P=None):
@@ -370,6 +479,40 @@ class ObjFun(object):
             return x.dot(P.dot(x))
             
     
+    def jacobian_products(self, theta):
+        """
+        Return the lazy model Jacobian D (None in sensor mode) and the list
+        of M[k] D[k] products at theta. The result for the most recent theta
+        is kept, since the same products are needed for both the gradient
+        and the posterior precision.
+        """
+        
+        theta = np.asarray(theta)
+        
+        if self.jac_theta is not None and np.array_equal(theta, self.jac_theta):
+            return self.jac_cache
+        
+        with self.model.trace.phase('jacobian'):
+            if self.sensor:
+                D  = None
+                MD = self.model.sensor_jacobian(theta, self.M)
+            else:
+                D  = self.model.jacobian_operator(theta)
+                MD = [D.mdot(k, self.M[k]) for k in range(self.p)]
+        #
+        # note: D is an lcsmodel.LCSJacobian, so only the M[k] D[k] 
+        # products are computed here. The slices of D are evaluated later,
+        # if and when they are needed.
+        #
+        # note: self.model is in charge of tracking theta, and preventing
+        # recomputation of A and b when theta does not change.
+        
+        self.jac_theta = theta.copy()
+        self.jac_cache = (D, MD)
+        
+        return self.jac_cache
+    
+    
     def eval(self, x, theta, s):
         """
         Return the objective function at theta
@@ -404,14 +547,10 @@ class ObjFun(object):
     def eval_grad_hess_theta(self, x, theta, s):
         """Return the exact gradient, and approx Hessian w.r.t theta."""
     
-        # Evaluate the model output and Jacobain at theta
-        D = self.model.jacobian(theta)
-        #
-        # note: self.model is in charge of tracking theta, and preventing
-        # recomputation when theta does not change.
-    
         # Compute list of M_k D_k products used for both gradiant
         # and Hessian calculations
+        D, MDs = self.jacobian_products(theta)
+        
         H = self.iSigma_theta.copy()
         g = H.dot(theta - self.theta_mean)
         #
@@ -420,7 +559,7 @@ class ObjFun(object):
         # iSigma_theta.
         
         for k in range(self.p):
-            MD = self.M[k].dot(D[k])
+            MD = MDs[k]
             H += s[k] * MD.T.dot(MD)
             g += s[k] * MD.T.dot( self.M[k].dot(x[:,k]) - self.Y[:,k] )
 
@@ -436,14 +575,10 @@ class ObjFun(object):
     def eval_posterior_precision(self, x, theta, s):
         """Retrieve posterior information matrices."""
     
-        # Evaluate the model output and Jacobain at theta
-        D = self.model.jacobian(theta)
-        #
-        # note: self.model is in charge of tracking theta, and preventing
-        # recomputation when theta does not change.
-    
         # Compute list of M_k D_k products used for both gradiant
         # and Hessian calculations
+        D, MDs = self.jacobian_products(theta)
+        
         H_theta   = self.iSigma_theta.copy()
         g         = self.iSigma_theta.dot(theta - self.theta_mean)
         H_theta_s = np.zeros((self.d, self.p))
@@ -453,7 +588,7 @@ class ObjFun(object):
         # iSigma_theta.
         
         for k in range(self.p):
-            MD              = self.M[k].dot(D[k])
+            MD              = MDs[k]
             MDe             = MD.T.dot( self.M[k].dot(x[:,k]) - self.Y[:,k] )
             g              += s[k] * MDe
             H_theta        += s[k] * MD.T.dot(MD)
@@ -486,7 +621,7 @@ class ObjFun(object):
 
     
     
-    def __init__(self, Data, M, lcsModel, Prior):
+    def __init__(self, Data, M, lcsModel, Prior, sensor=False):
 
         self.theta_mean   = Prior['theta_mean']
         self.iSigma_theta = Prior['iSigma_theta']
@@ -495,6 +630,11 @@ class ObjFun(object):
         self.model = lcsModel
         self.Y     = Data
         self.M     = M
+        
+        # Sensor restricted Jacobian mode, and cached Jacobian products
+        self.sensor    = sensor
+        self.jac_theta = None
+        self.jac_cache = None
 
         self.d         = len(self.theta_mean)
         self.m, self.p = Data.shape
@@ -0,0 +1,390 @@
+# -*- coding: utf-8 -*-
+"""
+Parallel evaluation helpers for the Bayesian Gauss Newton (BGN) solvers.
+
+TrialPool enables speculative line searches: instead of evaluating the
+backtracking step sizes t, BETA*t, BETA^2*t, ... one after the other, a
+ladder of candidate steps is evaluated concurrently in a process pool, and
+the solver picks the largest step that satisfies the descent condition.
+This is useful when each model evaluation is an expensive external run,
+e.g., an ABAQUS finite element analysis.
+
+Usage:
+-------
+
+pool = bgnpar.TrialPool(Model, processes=4)
+Est  = bgn.sbgn_solver(Data, Model, Jacobian, Prior, POOL=pool)
+pool.close()
+
+or, for a linear constrained system model,
+
+pool = bgnpar.TrialPool(lcsModel.eval, processes=4)
+Est  = bgnlcs.bgn_lcs_solver(Data, M, lcsModel, Prior, POOL=pool)
+pool.close()
+
+The multistart_lcs and multistart_sbgn drivers run the solvers from many
+initial guesses in a process pool, and return all distinct local modes
+ranked by their log evidence lnZ.
+
+Note: the worker processes are forked from the calling process when the
+pool is created, so the model function (and for the multi-start drivers,
+the data, prior and measurement matrices) are inherited through shared
+copy-on-write memory rather than pickled for every task. On platforms 
+without fork, these inputs must be picklable.
+"""
+
+import multiprocessing
+import traceback
+
+import numpy as np
+
+import bgn
+import bgnlcs
+import ratelog
+
+
+log = ratelog.get_logger(__name__)
+
+
+# Trial function and shared cancellation counter for the worker processes,
+# assigned by init_trial_worker when the pool starts.
+trial_fun    = None
+trial_cancel = None
+
+
+def init_trial_worker(fun, cancel):
+    """Pool initializer: store the trial function in the worker."""
+
+    global trial_fun, trial_cancel
+
+    trial_fun    = fun
+    trial_cancel = cancel
+
+
+def eval_trial(x, ladder_id):
+    """Evaluate the trial function at x, unless its ladder was cancelled."""
+
+    # Skip trials that belong to a ladder that has already been resolved.
+    if trial_cancel.value >= ladder_id:
+        return None
+
+    return trial_fun(x)
+
+
+
+class TrialPool(object):
+    """
+    Process pool for concurrent evaluation of line-search trial points.
+
+    Each call to submit() starts a new ladder of trial points. Trials are
+    queued in the order given, so the most promising (largest) steps are
+    evaluated first. Once the solver has found an acceptable step it calls
+    cancel(), and any trials of that ladder that have not yet started are
+    skipped by the workers. Trials that are already running are allowed to
+    finish (an external model run can not be interrupted safely), but their
+    results are discarded.
+    """
+
+    def submit(self, points):
+        """
+        Start evaluating the trial function at each point in the list.
+
+        Returns a generator that yields the results in the same order as
+        points, waiting for each one only when it is requested.
+        """
+
+        self.ladder_cnt += 1
+
+        results = [self.pool.apply_async(eval_trial, (x, self.ladder_cnt))
+                   for x in points]
+
+        self.trial_cnt += len(points)
+
+        return (r.get() for r in results)
+
+
+    def cancel(self):
+        """Skip all queued trials of the current ladder."""
+
+        self.cancel_cnt.value = self.ladder_cnt
+
+
+    def close(self):
+        """Shut down the worker processes."""
+
+        if self.pool is not None:
+            self.cancel()
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+    def __init__(self, fun, processes=None):
+
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+
+        # Number of trial points evaluated concurrently.
+        self.processes = processes
+
+        # Ladder counters; the shared value holds the id of the most
+        # recently cancelled ladder.
+        self.ladder_cnt = 0
+        self.trial_cnt  = 0
+        self.cancel_cnt = multiprocessing.Value('i', 0)
+
+        self.pool = multiprocessing.Pool(processes, init_trial_worker,
+                                         (fun, self.cancel_cnt))
+
+        return
+
+
+
+
+#
+# Multi-start drivers
+#
+
+# Solver function for the multi-start worker processes, assigned by
+# init_multistart_worker when the pool starts.
+start_solver = None
+
+
+def init_multistart_worker(solver):
+    """Pool initializer: store the solver function in the worker."""
+
+    global start_solver
+
+    start_solver = solver
+
+
+def run_start(start):
+    """
+    Run the solver from the initial guess start. Returns (Est, None), or
+    (None, the formatted exception) if the solver failed, e.g., because a
+    poor initial guess produced a singular system.
+    """
+
+    try:
+        return start_solver(start), None
+    except Exception:
+        return None, traceback.format_exc()
+
+
+def find_mode(modes, x, keys, radius):
+    """
+    Return the index of the first mode whose basin contains x, or None.
+
+    A point belongs to the basin of a mode if its Mahalanobis distance to
+    the mode, under the posterior precision at that mode, is at most
+    radius. keys gives the (estimate, precision) field names in Est.
+    """
+
+    x = np.ravel(x)
+
+    for i, Est in enumerate(modes):
+        dx = x - np.ravel(Est[keys[0]])
+        if dx.dot(np.asarray(Est[keys[1]]).dot(dx)) <= radius**2:
+            return i
+
+    return None
+
+
+def prior_starts(x_mean, iSigma, num, spread):
+    """Draw num initial guesses from the (spread scaled) prior."""
+
+    d = len(x_mean)
+    L = np.linalg.cholesky(np.linalg.solve(iSigma, np.eye(d)))
+
+    return [x_mean + spread*L.dot(np.random.randn(d)).reshape(x_mean.shape)
+            for k in range(num)]
+
+
+def mode_rank(Est):
+    """Sort key for the modes: converged first, then by lnZ (nan last)."""
+
+    lnZ = Est['lnZ']
+
+    if np.isnan(lnZ):
+        lnZ = -np.inf
+
+    return (bool(Est['status']), lnZ)
+
+
+def multistart(solver, starts, keys, processes=None, RADIUS=3.0):
+    """
+    modes = multistart(solver, starts, keys, processes=None, RADIUS=3.0)
+
+    Generic multi-start driver used by multistart_lcs and multistart_sbgn.
+
+    The initial guesses are run in waves of processes starts at a time.
+    Before each wave, starts that already lie in the basin of a known
+    mode are pruned (see find_mode), and after each wave, results that
+    converged to a known basin are merged into it, keeping the estimate
+    with the highest lnZ.
+
+    Each returned estimate has the extra fields
+
+        hits: number of starts that converged to this mode
+
+        pruned: number of starts skipped because they were in this basin
+
+        start: the initial guess that produced the estimate
+
+        failed: number of starts (of the whole run) for which the solver
+        raised an exception; each failure is logged as a warning.
+
+    A RuntimeError is raised if the solver failed for every start. The
+    modes are ranked by lnZ, largest (most probable) first, with the
+    converged estimates ahead of those that did not converge.
+    """
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+
+    modes   = []
+    pending = list(starts)
+    failed  = 0
+    error   = None
+
+    pool = multiprocessing.Pool(processes, init_multistart_worker, (solver,))
+
+    try:
+        while pending:
+
+            # Prune starts inside an already found basin.
+            remaining = []
+            for x0 in pending:
+                i = find_mode(modes, x0, keys, RADIUS)
+                if i is None:
+                    remaining.append(x0)
+                else:
+                    modes[i]['pruned'] += 1
+
+            wave, pending = remaining[:processes], remaining[processes:]
+
+            # Run the wave and merge the results into the known modes.
+            for x0, (Est, error_k) in zip(wave, pool.map(run_start, wave)):
+
+                if Est is None:
+                    failed += 1
+                    error   = error_k
+                    log.warning('Start %s failed:\n%s', np.ravel(x0), error)
+                    continue
+
+                Est['start']  = x0
+                Est['hits']   = 1
+                Est['pruned'] = 0
+
+                i = find_mode(modes, Est[keys[0]], keys, RADIUS)
+
+                if i is None:
+                    modes.append(Est)
+                else:
+                    if Est['lnZ'] > modes[i]['lnZ']:
+                        Est['hits']   += modes[i]['hits']
+                        Est['pruned'] += modes[i]['pruned']
+                        modes[i] = Est
+                    else:
+                        modes[i]['hits'] += 1
+
+    finally:
+        pool.close()
+        pool.join()
+
+    if failed and not modes:
+        raise RuntimeError('The solver failed for all %d starts, the last '
+                           'error was:\n%s' % (failed, error))
+
+    for Est in modes:
+        Est['failed'] = failed
+
+    modes.sort(key=mode_rank, reverse=True)
+
+    return modes
+
+
+def multistart_lcs(Data, M, lcsModel, Prior, starts=8,
+                   processes=None, RADIUS=3.0, SPREAD=2.0, **options):
+    """
+    modes = multistart_lcs(Data, M, lcsModel, Prior, starts=8, ...)
+
+    Run bgnlcs.bgn_lcs_solver from several initial guesses in parallel and
+    return all distinct local modes ranked by lnZ (see multistart).
+
+    Inputs:
+    -------
+
+    Data, M, lcsModel, Prior: Same as bgnlcs.bgn_lcs_solver. Prior['theta_o']
+    is ignored.
+
+    starts: either a list of initial guesses, or the number of initial
+    guesses to draw from the prior, theta_mean + SPREAD*randn (scaled by
+    the prior covariance).
+
+    processes: number of worker processes (default: number of cpus).
+
+    RADIUS: basin radius in posterior standard deviations.
+
+    Additional named options (TOL, MAXIT, ...) are passed to the solver.
+
+    Note: the lazy Jacobian Est['D'] refers to the model in the worker 
+    process, so it is recreated in the calling process for each returned
+    mode.
+    """
+
+    if not hasattr(starts, '__len__'):
+        starts = prior_starts(Prior['theta_mean'], Prior['iSigma_theta'],
+                              starts, SPREAD)
+
+    options['QUIET'] = True
+
+    def solver(theta_o):
+        StartPrior = dict(Prior)
+        StartPrior['theta_o'] = theta_o
+        Est = bgnlcs.bgn_lcs_solver(Data, M, lcsModel, StartPrior, **options)
+        Est['D'] = None
+        return Est
+
+    modes = multistart(solver, starts, ('theta_est', 'iSigma_theta'),
+                       processes=processes, RADIUS=RADIUS)
+
+    for Est in modes:
+        Est['D'] = lcsModel.jacobian_operator(Est['theta_est'])
+
+    return modes
+
+
+def multistart_sbgn(Data, Model, Jacobian, Prior, starts=8,
+                    processes=None, RADIUS=3.0, SPREAD=2.0, **options):
+    """
+    modes = multistart_sbgn(Data, Model, Jacobian, Prior, starts=8, ...)
+
+    Run bgn.sbgn_solver from several initial guesses in parallel and return
+    all distinct local modes ranked by lnZ (see multistart).
+
+    The inputs are the same as for multistart_lcs, except the starts are
+    drawn around Prior['x_mean'], and Prior['xo'] is ignored.
+    """
+
+    if not hasattr(starts, '__len__'):
+        starts = prior_starts(Prior['x_mean'], Prior['iSigma_x'],
+                              starts, SPREAD)
+
+    options['QUIET'] = True
+
+    def solver(xo):
+        StartPrior = dict(Prior)
+        StartPrior['xo'] = xo
+        return bgn.sbgn_solver(Data, Model, Jacobian, StartPrior, **options)
+
+    return multistart(solver, starts, ('x_est', 'iSigma_est'),
+                      processes=processes, RADIUS=RADIUS)
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+Phase timing and counter instrumentation for the BGN solvers and LCSModel.
+
+A Trace accumulates, for each named phase, the wall time, CPU time and
+number of calls, plus named counters (factorizations, backsolves, r.h.s.
+vectors, ...) and one record per solver iteration (objective, step size,
+number of line search trials, ...). Optional callback hooks receive each
+iteration record as it is made, and the final summary.
+
+The solvers take the named options TRACE and CALLBACK:
+
+Est = bgnlcs.bgn_lcs_solver(Data, M, lcsModel, Prior, TRACE=True)
+print Est['trace']['phases']['factorization']
+
+def progress(event, info):
+    print event, info
+
+Est = bgn.sbgn_solver(Data, Model, Jacobian, Prior, CALLBACK=progress)
+
+When neither is given, the solvers use NULL_TRACE, whose methods do
+nothing, and Est['trace'] is None. Code paths that compute values only for
+the trace are guarded with "if trace:", since NULL_TRACE is false.
+"""
+
+import os
+import time
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+
+
+class Phase(object):
+    """
+    Context manager that adds the time spent in a block to a phase. For
+    blocks that do not fit a with statement, call start() and stop().
+    """
+
+    def start(self):
+        self.wall = time.time()
+        self.cpu  = time.clock()
+        return self
+
+    def stop(self):
+        stats = self.stats
+        stats['wall']  += time.time() - self.wall
+        stats['cpu']   += time.clock() - self.cpu
+        stats['calls'] += 1
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def __init__(self, stats):
+        self.stats = stats
+
+
+
+class NullPhase(object):
+    """Phase that records nothing."""
+
+    def start(self):
+        return self
+
+    def stop(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+NULL_PHASE = NullPhase()
+
+
+
+class Trace(object):
+    """
+    Structured solver trace (see module documentation).
+
+    Use "with trace.phase(name):" to time a block, trace.count(name, k) to
+    increment a counter, and trace.iteration(**record) to add an iteration
+    record. summary() returns the trace as a dictionary of plain python
+    types, which is what the solvers store in Est['trace'].
+
+    callback(event, info) is called with event 'iteration' and the record
+    for each iteration, and with event 'done' and the summary at the end.
+    """
+
+    def phase(self, name):
+        stats = self.phases.get(name)
+        if stats is None:
+            stats = self.phases[name] = {'wall': 0., 'cpu': 0., 'calls': 0}
+        return Phase(stats)
+
+
+    def count(self, name, k=1):
+        self.counters[name] = self.counters.get(name, 0) + k
+
+
+    def iteration(self, **record):
+        record['wall'] = time.time() - self.start
+        self.iterations.append(record)
+        if self.callback is not None:
+            self.callback('iteration', record)
+
+
+    def summary(self):
+        """Return the trace as a dictionary."""
+
+        return {'phases':     dict((k, dict(v)) for k, v in self.phases.items()),
+                'counters':   dict(self.counters),
+                'iterations': list(self.iterations),
+                'wall':       time.time() - self.start,
+                'peak_mb':    peak_memory_mb()}
+
+
+    def finish(self):
+        """Return the summary, and pass it to the callback."""
+
+        info = self.summary()
+        if self.callback is not None:
+            self.callback('done', info)
+        return info
+
+
+    def __nonzero__(self):
+        return True
+
+
+    def __init__(self, callback=None):
+
+        self.callback   = callback
+        self.phases     = {}
+        self.counters   = {}
+        self.iterations = []
+        self.start      = time.time()
+
+
+
+class NullTrace(object):
+    """Disabled trace: all methods do nothing, and the trace is false."""
+
+    def phase(self, name):
+        return NULL_PHASE
+
+    def count(self, name, k=1):
+        pass
+
+    def iteration(self, **record):
+        pass
+
+    def summary(self):
+        return None
+
+    def finish(self):
+        return None
+
+    def __nonzero__(self):
+        return False
+
+
+NULL_TRACE = NullTrace()
+
+
+
+def make_trace(TRACE=False, CALLBACK=None):
+    """
+    Return the trace for the TRACE and CALLBACK solver options: TRACE may
+    be a Trace object (e.g., to accumulate over several solves), or true
+    to create one. A CALLBACK alone also enables the trace.
+    """
+
+    if isinstance(TRACE, Trace):
+        if CALLBACK is not None:
+            TRACE.callback = CALLBACK
+        return TRACE
+
+    if TRACE or CALLBACK is not None:
+        return Trace(CALLBACK)
+
+    return NULL_TRACE
+
+
+def peak_memory_mb():
+    """Peak resident memory of this process in MB (None if unknown)."""
+
+    if resource is None:
+        return None
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # ru_maxrss is in bytes on Mac OS X and in kB on Linux
+    if os.uname()[0] == 'Darwin':
+        return rss/2.0**20
+
+    return rss/2.0**10
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+Deferred imports of heavy optional modules (matplotlib, scipy.stats,
+cypardiso).
+
+A module that needs the plotting stack only in some functions binds it
+with
+
+plt = lazyimport.lazy_import('matplotlib.pyplot')
+
+and uses plt as before; matplotlib.pyplot is imported on the first
+attribute access (plt.figure), not when the module is imported. This keeps
+the import of the core modules (lcsmodel, bgnlcs, abqiface, ...) cheap,
+which matters for process pool workers that import them on every spawn
+(see bench_import.py for the import-time budget).
+
+An optional setup(module) function is called once, right after the
+import, e.g. to set matplotlib rc parameters. The proxy's own methods are
+underscore prefixed, so they do not hide attributes of the module.
+"""
+
+import importlib
+
+
+
+class LazyModule(object):
+    """Module proxy that imports the module on first attribute access."""
+
+    def _lazy_load(self):
+        """Import the module (once) and return it."""
+
+        module = self.__dict__['_lazy_module']
+
+        if module is None:
+            module = importlib.import_module(self.__dict__['_lazy_name'])
+            self.__dict__['_lazy_module'] = module
+
+            setup = self.__dict__['_lazy_setup']
+            if setup is not None:
+                setup(module)
+
+        return module
+
+
+    def _lazy_loaded(self):
+        """True if the module has been imported."""
+
+        return self.__dict__['_lazy_module'] is not None
+
+
+    def __getattr__(self, attr):
+        return getattr(self._lazy_load(), attr)
+
+
+    def __setattr__(self, attr, value):
+        setattr(self._lazy_load(), attr, value)
+
+
+    def __repr__(self):
+        return '<lazy module %r (%s)>' % (self.__dict__['_lazy_name'],
+                                          'loaded' if self._lazy_loaded() else 'not loaded')
+
+
+    def __init__(self, name, setup=None):
+
+        self.__dict__['_lazy_name']   = name
+        self.__dict__['_lazy_setup']  = setup
+        self.__dict__['_lazy_module'] = None
+
+
+
+def lazy_import(name, setup=None):
+    """Return a LazyModule for the module name (e.g. 'scipy.stats')."""
+
+    return LazyModule(name, setup)
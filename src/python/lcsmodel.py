@@ -59,10 +59,19 @@ LCS.diff_b = user defined function of the form
 """
 
 #import pardiso
+import copy
+import tempfile
+
 import numpy
 import scipy
 import scipy.sparse as sprs
 import scipy.sparse.linalg as spla
+
+import bgntrace
+import ratelog
+
+
+log = ratelog.get_logger(__name__)
 #import pardiso
 
 
@@ -78,17 +87,26 @@ class Solver(object):
     boolean like -- there's a bug in numpy 1.6.2 that produces
     an issue with this. For this reason, all backsolve steps
     in this class recast b to numpy.float64.
+    
+    The factorization and backsolve calls are recorded in the trace (see
+    bgntrace), which is disabled unless a solver sets it.
     """
     
+    # Solver trace, see LCSModel.set_trace
+    trace = bgntrace.NULL_TRACE
+    
     def factor(self, A):
         """Compute internal factorization of A."""
     
         self.m, self.n = A.shape
         
-        if self.use_sub_factor:
-            self.sub_factor(A)
-        else:
-            self.A_factorized = spla.factorized(A)
+        self.trace.count('factorizations')
+        
+        with self.trace.phase('factorization'):
+            if self.use_sub_factor:
+                self.sub_factor(A)
+            else:
+                self.A_factorized = spla.factorized(A)
             
             #if self.A_factorized is not None:
             #    self.A_factorized.free()    
@@ -98,6 +116,19 @@ class Solver(object):
     def backsolve(self, b, transp='N'):
         """Return solution to Ax=b. Must be called AFTER factor()."""
         
+        if not self.trace:
+            return self.solve_rhs(b, transp)
+        
+        self.trace.count('backsolves')
+        self.trace.count('rhs', 1 if b.ndim == 1 else b.shape[1])
+        
+        with self.trace.phase('backsolve'):
+            return self.solve_rhs(b, transp)
+    
+    
+    def solve_rhs(self, b, transp='N'):
+        """Untraced backsolve."""
+        
         if self.use_sub_factor:
             return self.sub_backsolve(b, transp=transp)
         
@@ -122,7 +153,7 @@ class Solver(object):
             b_m, b_n = b.shape
             
             if b_m != self.m:
-                print "b_m:{}, b_n:{}, m:{}".format(b_m, b_n, self.m)
+                log.error("b_m:%d, b_n:%d, m:%d", b_m, b_n, self.m)
                 raise ValueError("Length of b_m does not equal m in backsolve b.ndim==2.")
             #assert b_m == self.m
 
@@ -146,7 +177,7 @@ class Solver(object):
         # out2 = M.tocsr()[indices,:] # for row slices
         #
         
-        print "Running subfactor routine."
+        log.debug("Running subfactor routine.")
         
         self.m, self.n = A.shape
         
@@ -174,7 +205,7 @@ class Solver(object):
         #        self.Asub_factorized.free()         
         #self.Asub_factorized = pardiso.Factor(Asub.tocsr())
         
-        print "Done with subfactor routine."
+        log.debug("Done with subfactor routine.")
     
     
     def sub_backsolve(self, b, transp='N'):
@@ -183,7 +214,7 @@ class Solver(object):
         # Case where b, and xsol are 1-D arrays
         if b.ndim==1:
             
-            print "Running sub_backsolve routine b.ndim=1."
+            log.debug("Running sub_backsolve routine b.ndim=1.")
         
             # b must have m elements or this doesn't make sense
             if len(b)!=self.m:
@@ -208,7 +239,7 @@ class Solver(object):
         # Case where b is an m x p matrix, and xsol is an n x p matrix
         elif b.ndim==2:
             
-            print "Running sub_backsolve routine b.ndim=2."
+            log.debug("Running sub_backsolve routine b.ndim=2.")
             
             b_m, b_p = b.shape
             
@@ -228,7 +259,7 @@ class Solver(object):
                 x[self.unknown_inds,k]  = xsub;
                 x[self.xinds,k]         = self.xsol[:,k]
                 
-        print "Done with sub_backsolve."
+        log.debug("Done with sub_backsolve.")
 
         return x
 
@@ -262,6 +293,209 @@ class Solver(object):
         return
 
 
+class LCSJacobian(object):
+    """
+    Lazily evaluated p x n x d Jacobian of an LCS model.
+    
+    The object holds a snapshot of the model state (theta, A, b, x and the
+    factorization of A) at the time it was created, so it stays valid after
+    the model moves on to a new theta. Nothing is solved up front, and the
+    Jacobian can be used in three ways:
+    
+        D[k], D[k,:,j], ...: slices are materialized one load case at a 
+        time (d backsolves each), and kept in memory, in an on-disk
+        memmap when spill_dir is given, or not at all if cache is False.
+        
+        numpy.asarray(D): the full p x n x d array, as returned by
+        LCSModel.compute_jacobian.
+        
+        D.matvec(k, v), D.rmatvec(k, w), D.mdot(k, M_k): operator 
+        products D[k] v, D[k]^T w and M_k D[k], which never form D[k].
+    
+    Each column of the Jacobian is 
+    
+    D[k][:,j] = - A^{-1} (A_j x[:,k] - b_j[:,k]),
+    
+    where A_j and b_j are the derivatives of A and b w.r.t. theta_j.
+    """
+    
+    def residual(self, k, j):
+        """Return A_j x[:,k] - b_j[:,k]."""
+        
+        A_j, b_j = self.model.get_diff_A_b(j, state=self)
+        
+        return A_j.dot(self.x[:,k]) - b_j[:,k]
+    
+    
+    def residuals(self, k):
+        """Return the n x d matrix of residuals for load case k."""
+        
+        R = numpy.zeros((self.n, self.d))
+        
+        for j in range(self.d):
+            R[:,j] = self.residual(k, j)
+        
+        return R
+    
+    
+    def slice(self, k):
+        """Return the n x d Jacobian of load case k."""
+        
+        if self.done[k]:
+            return self.store[k]
+        
+        Dk = - self.solver.backsolve(self.residuals(k)).astype(self.dtype)
+        
+        if self.store is not None:
+            self.store[k] = Dk
+            self.done[k]  = True
+            
+        return Dk
+    
+    
+    def matvec(self, k, v):
+        """Return D[k] v, using one backsolve."""
+        
+        v = numpy.asarray(v, dtype=numpy.float64).ravel()
+        
+        if self.done[k]:
+            return self.store[k].dot(v)
+        
+        r = numpy.zeros(self.n)
+        for j in range(self.d):
+            if v[j] != 0.0:
+                r += v[j] * self.residual(k, j)
+        
+        return - self.solver.backsolve(r)
+    
+    
+    def rmatvec(self, k, w):
+        """Return D[k]^T w, using one transposed backsolve."""
+        
+        w = numpy.asarray(w, dtype=numpy.float64).ravel()
+        
+        if self.done[k]:
+            return self.store[k].T.dot(w)
+        
+        lmbda = self.solver.backsolve(w, transp='T')
+        
+        # one residual column at a time, to not form the n x d residuals
+        g = numpy.zeros(self.d)
+        for j in range(self.d):
+            g[j] = - self.residual(k, j).dot(lmbda)
+        
+        return g
+    
+    
+    def mdot(self, k, M_k):
+        """
+        Return the m x d product M_k D[k].
+        
+        When there are fewer rows in M_k than parameters (m < d), the 
+        adjoint solutions A^{-T} M_k^T are used (m transposed backsolves, 
+        shared between load cases with the same M_k). Otherwise, each 
+        column of D[k] is solved for and immediately reduced by M_k.
+        """
+        
+        if self.done[k]:
+            return M_k.dot(self.store[k])
+        
+        m  = M_k.shape[0]
+        MD = numpy.zeros((m, self.d))
+        
+        if m < self.d:
+            if id(M_k) not in self.adjoints:
+                MT = M_k.T
+                if sprs.issparse(MT):
+                    MT = MT.toarray()
+                self.adjoints[id(M_k)] = self.solver.backsolve(
+                                            numpy.asarray(MT), transp='T')
+            
+            Lmbda = self.adjoints[id(M_k)]
+            
+            for j in range(self.d):
+                MD[:,j] = - Lmbda.T.dot(self.residual(k, j))
+        else:
+            for j in range(self.d):
+                MD[:,j] = - M_k.dot(self.solver.backsolve(self.residual(k, j)))
+        
+        return MD
+    
+    
+    def toarray(self):
+        """Return the full p x n x d Jacobian as a numpy array."""
+        
+        D = numpy.zeros(self.shape, dtype=self.dtype)
+        
+        for k in range(self.p):
+            D[k] = self.slice(k)
+        
+        return D
+    
+    
+    def __array__(self, dtype=None):
+        
+        if dtype is None:
+            return self.toarray()
+        
+        return self.toarray().astype(dtype)
+    
+    
+    def __getitem__(self, key):
+        
+        if not isinstance(key, tuple):
+            key = (key,)
+        
+        # Integer load case index: only one slice is needed.
+        if isinstance(key[0], (int, long, numpy.integer)):
+            return self.slice(key[0])[key[1:]]
+        
+        return self.toarray()[key]
+    
+    
+    def __len__(self):
+        return self.p
+    
+    
+    def __init__(self, model, dtype=numpy.float64, spill_dir=None, 
+                 cache=True):
+        
+        if model.x is None:
+            raise ValueError('Can not compute Jacobian. model.x is None.')
+        
+        # Snapshot of the model state
+        self.model  = model
+        self.theta  = model.theta.copy()
+        self.A      = model.A
+        self.b      = model.b
+        self.x      = model.x
+        self.solver = copy.copy(model.solver)
+        # note: the model replaces (rather than modifies) these attributes
+        # when theta changes, so references are enough here.
+        
+        self.d         = len(self.theta)
+        self.n, self.p = self.b.shape
+        self.shape     = (self.p, self.n, self.d)
+        self.dtype     = numpy.dtype(dtype)
+        
+        # Storage for the materialized slices
+        if not cache:
+            self.store = None
+        elif spill_dir is not None:
+            # The temporary file is deleted when the memmap is released.
+            self.spill = tempfile.TemporaryFile(dir=spill_dir)
+            self.store = numpy.memmap(self.spill, dtype=self.dtype, 
+                                      mode='w+', shape=self.shape)
+        else:
+            self.store = {}
+        
+        self.done     = numpy.zeros(self.p, dtype=bool)
+        self.adjoints = {}
+        
+        return
+
+
+
 class LCSModel(object):
     """
     Class for working with Linear Constrained Systems (LCS).
@@ -294,8 +528,21 @@ class LCSModel(object):
     x(theta) ~= x(theta_o) + J(theta_o)*(theta - theta_o)
     
     for all theta sufficiently close to theta_o.
+    
+    Use set_trace to record the time spent in the assembly of A and b, 
+    the factorization, and the backsolves (see bgntrace).
     """
     
+    # Model trace, see set_trace
+    trace = bgntrace.NULL_TRACE
+    
+    
+    def set_trace(self, trace):
+        """Record the model and solver phases in trace (a bgntrace.Trace)."""
+        
+        self.trace        = trace
+        self.solver.trace = trace
+        
             
     def eval(self, theta, force=False):
         """Return the solution for x, at the input theta."""
@@ -325,6 +572,20 @@ class LCSModel(object):
         # Run the internal jacobian calculation
         return self.compute_jacobian()
     
+    
+    def jacobian_operator(self, theta, force=False):
+        """Return the lazily evaluated Jacobian (LCSJacobian) at theta."""
+        
+        # Update the internal solution
+        self.solution_update(theta, force)
+        
+        if not self.quiet:
+            log.info("Creating lazy jacobian at theta.")
+        
+        return LCSJacobian(self, dtype=self.jacobian_dtype,
+                           spill_dir=self.jacobian_spill_dir,
+                           cache=self.jacobian_cache)
+    
         
     def solution_update(self, theta, force=False):
         """Update internal solution at input theta."""
@@ -334,9 +595,16 @@ class LCSModel(object):
         return
         
         
-    def get_diff_A_b(self, k):
+    def get_diff_A_b(self, k, state=None):
+        """
+        Return the derivatives of A and b w.r.t. theta_k, at the internal 
+        state, or at the state of the LCSJacobian snapshot when given.
+        """
+        
+        if state is None:
+            state = self
         
-        A_k, b_k = self.diff_A_and_b(self.A, self.b, self.theta, k)
+        A_k, b_k = self.diff_A_and_b(state.A, state.b, state.theta, k)
         
         return A_k, b_k
         
@@ -348,8 +616,8 @@ class LCSModel(object):
         n,p = self.b.shape
         
         if not self.quiet:
-            print "Running jacobian computation."
-            print "D will be a {}x{}x{} array".format(p,n,d)
+            log.info("Running jacobian computation.")
+            log.info("D will be a %dx%dx%d array", p, n, d)
         
         if self.x is None:
             raise ValueError('Can not compute Jacobian. self.x is None.')
@@ -366,8 +634,47 @@ class LCSModel(object):
                 D[i,:,k] = - self.solver.backsolve(A_k.dot(self.x[:,i]) - b_k[:,i])
                
         return D
-    
-        
+
+
+    def sensor_jacobian(self, theta, M, force=False):
+        """Return the list of M[k] D[k] products evaluated at theta."""
+
+        # Update the internal solution
+        self.solution_update(theta, force)
+
+        # Run the internal sensor jacobian calculation
+        return self.compute_sensor_jacobian(M)
+
+
+    def compute_sensor_jacobian(self, M):
+        """
+        Return the sensor restricted Jacobian, MD[k] = M[k] D[k], for each
+        load case k, evaluated at the internal theta and x.
+
+        M is a list (or 3-D array) of p, m x n measurement matrices. Only
+        the m x d products are formed, so the full p x n x d Jacobian is
+        never stored. When there are fewer sensors than parameters (m < d),
+        the adjoint solutions
+
+        Lmbda[k] = A^{-T} M[k]^T,
+
+        are computed with m transposed backsolves, such that
+
+        M[k] D[k][:,j] = - Lmbda[k]^T (A_j x[:,k] - b_j[:,k]).
+
+        Otherwise, each column of D[k] is computed with a regular backsolve
+        and immediately reduced to M[k] D[k][:,j] (see LCSJacobian.mdot).
+        """
+
+        D = LCSJacobian(self, cache=False)
+
+        if not self.quiet:
+            log.info("Running sensor jacobian computation.")
+            log.info("MD will be a %dx%dx%d array", D.p, M[0].shape[0], D.d)
+
+        return [D.mdot(k, M[k]) for k in range(D.p)]
+
+
 #    def get_nlls_gradient(self, y, D):
 #        """
 #        Return non-linear least squares objective gradient.
@@ -395,7 +702,8 @@ class LCSModel(object):
             numpy.any( (theta - self.theta) != 0.0 ):
         
             self.theta = theta
-            self.A, self.b = self.eval_A_and_b(self.theta)
+            with self.trace.phase('assembly'):
+                self.A, self.b = self.eval_A_and_b(self.theta)
             
             self.solver.factor(self.A)
             
@@ -404,12 +712,12 @@ class LCSModel(object):
             self.factor_cnt += 1
             
             if not self.quiet:
-                print "A matrix and b vector parameter update."
+                log.info("A matrix and b vector parameter update.")
     
         else:
         
             if not self.quiet:
-                print "No update computation necessary."
+                log.info("No update computation necessary.")
             
         return
         
@@ -511,6 +819,11 @@ class LCSModel(object):
         self.factor_cnt = 0
         self.quiet=True
         
+        # Jacobian container options (see jacobian_operator)
+        self.jacobian_dtype     = numpy.float64
+        self.jacobian_spill_dir = None
+        self.jacobian_cache     = True
+        
         return
 
 
@@ -549,10 +862,13 @@ class DC_LCSModel(LCSModel):
     """
     
             
-    def get_diff_A_b(self, k):
+    def get_diff_A_b(self, k, state=None):
         
-        A_k = self.diff_A(self.A, self.theta, k)
-        b_k = self.diff_b(self.b, self.theta, k)
+        if state is None:
+            state = self
+        
+        A_k = self.diff_A(state.A, state.theta, k)
+        b_k = self.diff_b(state.b, state.theta, k)
         
         return A_k, b_k
         
@@ -563,7 +879,8 @@ class DC_LCSModel(LCSModel):
         
         Does not include logic to see if A should be updated.
         """
-        self.A = self.eval_A(self.theta)
+        with self.trace.phase('assembly'):
+            self.A = self.eval_A(self.theta)
         self.solver.factor(self.A)
         self.A_eval_cnt += 1
         self.factor_cnt += 1
@@ -575,7 +892,8 @@ class DC_LCSModel(LCSModel):
         
         Does not include logic to see if b should be updated.
         """
-        self.b = self.eval_b(self.theta)
+        with self.trace.phase('assembly'):
+            self.b = self.eval_b(self.theta)
         self.b_eval_cnt += 1
     
       
@@ -596,7 +914,7 @@ class DC_LCSModel(LCSModel):
             self.update_b(self.theta)
             
             if not self.quiet:
-                print "Initializing or forcing updates to both A and b."
+                log.info("Initializing or forcing updates to both A and b.")
             
             # At this point we're done. No need to check anything else.
             return
@@ -619,7 +937,7 @@ class DC_LCSModel(LCSModel):
             self.update_A(self.theta)
             
             if not self.quiet:
-                print "A matrix parameter update."
+                log.info("A matrix parameter update.")
     
         if update_b_flag:
             
@@ -627,13 +945,13 @@ class DC_LCSModel(LCSModel):
             self.update_b(self.theta)
         
             if not self.quiet:
-                print "b matrix parameter update."
+                log.info("b matrix parameter update.")
         
         
         if update_A_flag==False and update_b_flag==False:
         
             if not self.quiet:
-                print "No update to parameter vector."
+                log.info("No update to parameter vector.")
             
         return
         
@@ -687,6 +1005,11 @@ class DC_LCSModel(LCSModel):
         self.factor_cnt = 0
         self.quiet=True
         
+        # Jacobian container options (see jacobian_operator)
+        self.jacobian_dtype     = numpy.float64
+        self.jacobian_spill_dir = None
+        self.jacobian_cache     = True
+        
         return
 
 
@@ -997,6 +1320,57 @@ def test_dc_lcsmodel_class():
 
 
 
+def test_lcs_jacobian():
+    """Test the lazy Jacobian container against the dense Jacobian."""
+
+    import shutil
+
+    n = 1000
+    p = 3
+
+    TM = test.Model1(n,p)
+
+    LCS        = DC_LCSModel()
+    LCS.eval_A = TM.eval_A
+    LCS.eval_b = TM.eval_b
+    LCS.diff_A = TM.diff_A
+    LCS.diff_b = TM.diff_b
+
+    theta = numpy.array((1., 0.1, 0.2, 0.1))
+    D     = LCS.jacobian(theta)
+    J     = LCS.jacobian_operator(theta)
+
+    # The snapshot must not be affected by moving the model.
+    LCS.eval(theta + 0.5)
+
+    v = numpy.array((1., -2., 0.5, 3.))
+    w = numpy.random.randn(n)
+    M = sprs.eye(n).tocsr()[[1, 10, 100]]
+
+    for k in range(p):
+        print "Operator products for D_{} all close: {}".format(k,
+            numpy.allclose(J.matvec(k, v), D[k].dot(v)) and \
+            numpy.allclose(J.rmatvec(k, w), D[k].T.dot(w)) and \
+            numpy.allclose(J.mdot(k, M), M.dot(D[k])))
+
+    print "Full array all close: {}".format(numpy.allclose(numpy.asarray(J), D))
+    print "Indexed column all close: {}".format(numpy.allclose(J[1,:,2], D[1,:,2]))
+
+    # Single precision, spilled to disk
+    spill_dir = tempfile.mkdtemp()
+    try:
+        LCS.jacobian_dtype     = numpy.float32
+        LCS.jacobian_spill_dir = spill_dir
+        J = LCS.jacobian_operator(theta)
+        print "Spilled float32 slice all close: {}".format(
+            J[2].dtype == numpy.float32 and \
+            numpy.allclose(J[2], D[2], rtol=1e-5, atol=1e-6))
+        del J
+    finally:
+        shutil.rmtree(spill_dir)
+
+
+
 if __name__ == "__main__":
 
     import sys
@@ -1031,6 +1405,10 @@ if __name__ == "__main__":
     test_dc_lcsmodel_class()
     print "Done with DC_LCSModel class test.\n"
 
+    print "Testing LCSJacobian class ..."
+    test_lcs_jacobian()
+    print "Done with LCSJacobian class test.\n"
+
 
 
 
@@ -11,7 +11,22 @@ Stefan Schuet
 import os;
 import numpy as np;
 import scipy.sparse as sp
-import cypardiso as cp;
+
+import lazyimport
+
+# the compiled PARDISO interface, imported on first use
+cp = lazyimport.lazy_import('cypardiso');
+
+
+def available():
+    """True if the cypardiso extension can be imported."""
+    
+    try:
+        cp._lazy_load();
+    except ImportError:
+        return False;
+    
+    return True;
 
 
 
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+Leveled logging for the mesh, deck and solver modules.
+
+Each module gets its logger with
+
+log = ratelog.get_logger(__name__)
+
+and reports through it instead of print: DEBUG for per-item detail (shared
+nodes per voxel, node set contents, solver internals), INFO for the usual
+progress output, WARNING for problems. The loggers are standard logging
+loggers, so log.debug('%d nodes', n) costs little more than a level check
+when DEBUG is disabled, because the message is only formatted when it is
+emitted.
+
+Until the application configures logging (e.g., with logging.basicConfig),
+INFO and above are written as plain messages to sys.stdout, as the print
+statements were. The levels are changed with
+
+ratelog.set_level('DEBUG')             # all modules
+ratelog.set_level('WARNING', 'abqiface')
+
+For loops over many items, a RateLogger reports throttled rate summaries
+("12000 voxels (4100.3/s)") at most every interval seconds, and a total
+when the loop is done, instead of one line per item.
+"""
+
+import logging
+import sys
+import time
+
+
+# Level of the loggers made by get_logger
+DEFAULT_LEVEL = logging.INFO
+
+# Names of the loggers made by get_logger
+LOGGER_NAMES = []
+
+
+
+class DefaultHandler(logging.Handler):
+    """
+    Write plain messages to sys.stdout, unless the root logger has
+    handlers (i.e., the application has configured logging).
+    """
+
+    def emit(self, record):
+        if logging.getLogger().handlers:
+            return
+        try:
+            sys.stdout.write(self.format(record) + '\n')
+        except Exception:
+            self.handleError(record)
+
+
+DEFAULT_HANDLER = DefaultHandler()
+DEFAULT_HANDLER.setFormatter(logging.Formatter('%(message)s'))
+
+
+
+def get_logger(name):
+    """Return the logger name, with the default handler and level."""
+
+    logger = logging.getLogger(name)
+
+    if name not in LOGGER_NAMES:
+        LOGGER_NAMES.append(name)
+        logger.addHandler(DEFAULT_HANDLER)
+        logger.setLevel(DEFAULT_LEVEL)
+
+    return logger
+
+
+def set_level(level, name=None):
+    """
+    Set the level (a number or a name like 'DEBUG') of the logger name,
+    or of all loggers made by get_logger (and later ones) if name is None.
+    """
+
+    global DEFAULT_LEVEL
+
+    if isinstance(level, basestring):
+        level = logging.getLevelName(level.upper())
+
+    if name is not None:
+        get_logger(name).setLevel(level)
+        return
+
+    DEFAULT_LEVEL = level
+    for name in LOGGER_NAMES:
+        logging.getLogger(name).setLevel(level)
+
+
+
+class RateLogger(object):
+    """
+    Throttled progress of a loop over items: call tick() for each item (or
+    tick(n) for n items), and done() at the end. A summary line with the
+    count and rate is logged at most every interval seconds, and the total
+    by done(). When level is disabled, tick only increments the count.
+    """
+
+    def tick(self, n=1):
+
+        self.count += n
+
+        if self.enabled and self.count >= self.next_check:
+            self.next_check = self.count + self.check
+            now = time.time()
+            if now - self.last >= self.interval:
+                self.last = now
+                self.logger.log(self.level, '%d %s (%.1f/s)', self.count,
+                                self.noun, self.count/(now - self.start))
+
+
+    def done(self):
+        """Log the total count and rate."""
+
+        if self.enabled:
+            elapsed = time.time() - self.start
+            self.logger.log(self.level, '%d %s in %.2f s (%.1f/s)', self.count,
+                            self.noun, elapsed, self.count/max(elapsed, 1e-9))
+
+
+    def __init__(self, logger, noun, interval=10.0, level=logging.INFO, check=100):
+        """
+        Log the progress in units of noun (e.g., 'voxels') to logger. The
+        time is only looked at every check items.
+        """
+
+        self.logger     = logger
+        self.noun       = noun
+        self.interval   = interval
+        self.level      = level
+        self.check      = check
+        self.enabled    = logger.isEnabledFor(level)
+        self.count      = 0
+        self.next_check = check
+        self.start      = self.last = time.time()
@@ -3,8 +3,8 @@
 Standalone Test models for Parameter Estimation and UQ.
 """
 
-#import numpy
-#import scipy.sparse as sprs
+import numpy
+import scipy.sparse as sprs
 
 class Model1(object):
     """
@@ -131,3 +131,84 @@ class Model2(object):
 
 
 
+
+class Model3(object):
+    """
+    Scalable version of model 1, with d parameters where:
+    A(theta) = theta[0]*A0 + ... + theta[dA-1]*A(dA-1)
+    b(theta) = theta[dA]*B0 + ... + theta[d-1]*B(d-dA-1),
+    
+    where A(theta) is n x n, b(theta) is n x p, and dA = d//2.
+    
+    A0 is the identity, and Aj (j > 0) has ones on the j-th super 
+    diagonal, so A(theta) is diagonally dominant for the nominal
+    parameters returned by theta_nominal. The Bj are fixed pseudo 
+    random n x p matrices.
+    
+    Both the decoupled (DC_LCSModel) and the coupled (LCSModel) 
+    evaluation methods are provided. This model is used to benchmark
+    the methods in lcsmodel.py and bgnlcs.py at scale.
+    """
+
+    def basis_vec(self, k):
+        """Return natural basis vector k."""
+        e_k = numpy.zeros(self.d)
+        e_k[k] = 1.
+        return e_k
+    
+    
+    def theta_nominal(self):
+        """Return a parameter vector with a well conditioned A(theta)."""
+        theta = 0.5*numpy.ones(self.d)/self.dA
+        theta[0] = 1.
+        return theta
+    
+    
+    def eval_A(self, theta):
+        A = sprs.csc_matrix((self.n,self.n))
+        for j in range(self.dA):
+            A = A + theta[j]*self.A[j]
+        
+        return A
+    
+    
+    def diff_A(self, A, theta, k):
+        if k < self.dA:
+            return self.A[k]
+        return sprs.csc_matrix((self.n,self.n))
+    
+    
+    def eval_b(self, theta):
+        b = numpy.zeros((self.n, self.p))
+        for j in range(self.d - self.dA):
+            b += theta[self.dA+j]*self.B[j]
+        
+        return b
+    
+    
+    def diff_b(self, A, theta, k):
+        if k < self.dA:
+            return numpy.zeros((self.n, self.p))
+        return self.B[k-self.dA]
+    
+    
+    def eval_A_and_b(self, theta):
+        return self.eval_A(theta), self.eval_b(theta)
+    
+    
+    def diff_A_and_b(self, A, b, theta, k):
+        return self.diff_A(A, theta, k), self.diff_b(A, theta, k)
+        
+
+    def __init__(self, n=1000, p=3, d=4, seed=0):
+
+        self.n  = n
+        self.p  = p
+        self.d  = d
+        self.dA = max(1, d//2)
+        
+        self.A = [sprs.diags([numpy.ones(n-j)], [j], format='csc')
+                  for j in range(self.dA)]
+        
+        rand   = numpy.random.RandomState(seed)
+        self.B = [rand.rand(n,p) for j in range(d - self.dA)]